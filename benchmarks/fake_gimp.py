@@ -0,0 +1,467 @@
+"""In-memory stand-in for the parts of GIMP used by the plug-in analysis.
+
+Calling `install` places a fake ``gi`` package in `sys.modules`, so that the
+plug-in modules can be imported without GIMP and its typelibs installed.
+Drawables are backed by NumPy arrays and count the calls made to them, most
+notably to `Gimp.Drawable.histogram`, which scans all pixels on each call just
+like GIMP does.
+
+Only the functionality required for analyzing drawables and applying levels
+to them is implemented. Everything else (e.g. procedure registration) is
+replaced with inert stubs.
+"""
+
+import enum
+import itertools
+import math
+import sys
+import types
+
+import numpy as np
+
+
+class _Stub:
+  """Object accepting any attribute access, call or operator, used in place
+  of GIMP functionality that is irrelevant for the analysis.
+  """
+
+  def __init__(self, name='stub'):
+    self._name = name
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return _Stub(f'{self._name}.{name}')
+
+  def __call__(self, *args, **kwargs):
+    return _Stub(f'{self._name}()')
+
+  def __or__(self, other):
+    return self
+
+  __ror__ = __or__
+
+  def __neg__(self):
+    return self
+
+  def __repr__(self):
+    return f'<{self._name}>'
+
+
+class _FakeModule(types.ModuleType):
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return _Stub(f'{self.__name__}.{name}')
+
+
+class HistogramChannel(enum.IntEnum):
+  VALUE = 0
+  RED = 1
+  GREEN = 2
+  BLUE = 3
+  ALPHA = 4
+  LUMINANCE = 5
+
+
+class Precision(enum.IntEnum):
+  U8_LINEAR = 100
+  U8_NON_LINEAR = 150
+  U8_PERCEPTUAL = 175
+  U16_LINEAR = 200
+  U16_NON_LINEAR = 250
+  U16_PERCEPTUAL = 275
+  U32_LINEAR = 300
+  U32_NON_LINEAR = 350
+  U32_PERCEPTUAL = 375
+  HALF_LINEAR = 500
+  HALF_NON_LINEAR = 550
+  HALF_PERCEPTUAL = 575
+  FLOAT_LINEAR = 600
+  FLOAT_NON_LINEAR = 650
+  FLOAT_PERCEPTUAL = 675
+  DOUBLE_LINEAR = 700
+  DOUBLE_NON_LINEAR = 750
+  DOUBLE_PERCEPTUAL = 775
+
+
+PRECISIONS = {
+  'u8': (Precision.U8_LINEAR, np.uint8),
+  'u16': (Precision.U16_LINEAR, np.uint16),
+  'float': (Precision.FLOAT_LINEAR, np.float32),
+}
+"""Mapping of supported component types to GIMP precisions and NumPy types."""
+
+TILE_WIDTH = 128
+TILE_HEIGHT = 64
+
+
+class Counters:
+  """Number of calls made to the fake GIMP backend."""
+
+  def __init__(self):
+    self.histogram_calls = 0
+    self.buffer_reads = 0
+
+  def reset(self):
+    self.histogram_calls = 0
+    self.buffer_reads = 0
+
+
+counters = Counters()
+
+
+class Rectangle:
+
+  def __init__(self, x, y, width, height):
+    self.x = x
+    self.y = y
+    self.width = width
+    self.height = height
+
+  @classmethod
+  def new(cls, x, y, width, height):
+    return cls(x, y, width, height)
+
+
+class Buffer:
+  """Fake `Gegl.Buffer` converting pixels to the requested babl format on each
+  read, as GEGL does.
+  """
+
+  def __init__(self, pixels, component_type, on_set=None):
+    self.pixels = pixels
+    self.component_type = component_type
+    self.on_set = on_set
+
+  def get_property(self, name):
+    if name == 'tile-width':
+      return TILE_WIDTH
+    elif name == 'tile-height':
+      return TILE_HEIGHT
+    else:
+      raise ValueError(f'unsupported property: {name}')
+
+  def get(self, rect, _scale, pixel_format, _abyss_policy):
+    counters.buffer_reads += 1
+
+    pixels = self.pixels[rect.y:rect.y + rect.height, rect.x:rect.x + rect.width]
+
+    if pixel_format is None:
+      return pixels.tobytes()
+
+    layout, component_type = pixel_format.split(' ')
+
+    if layout == 'RGB' and pixels.shape[2] == 4:
+      pixels = pixels[..., :3]
+
+    return _convert(pixels, self.component_type, component_type).tobytes()
+
+  def set(self, rect, pixel_format, data):
+    layout, component_type = pixel_format.split(' ')
+    num_components = 3 if layout == 'RGB' else self.pixels.shape[2]
+
+    pixels = np.frombuffer(data, dtype=PRECISIONS[component_type][1]).reshape(
+      rect.height, rect.width, num_components)
+
+    self.pixels[rect.y:rect.y + rect.height, rect.x:rect.x + rect.width, :num_components] = (
+      _convert(pixels, component_type, self.component_type))
+
+    if self.on_set is not None:
+      self.on_set()
+
+  def flush(self):
+    pass
+
+
+class Node:
+  """Fake `Gegl.Node` processing a chain of ``gegl:buffer-source``,
+  ``gegl:levels`` and ``gegl:write-buffer`` operations in linear light.
+  """
+
+  def __init__(self, operation=None):
+    self.operation = operation
+    self.properties = {}
+
+    self._input_node = None
+
+  def create_child(self, operation):
+    return Node(operation)
+
+  def set_property(self, name, value):
+    self.properties[name] = value
+
+  def link(self, node):
+    node._input_node = self
+
+  def process(self):
+    buffer = self.properties['buffer']
+    buffer.set(
+      Rectangle(0, 0, buffer.pixels.shape[1], buffer.pixels.shape[0]),
+      'RGBA float',
+      self._input_node._get_output().astype(np.float32).tobytes())
+
+  def _get_output(self):
+    if self.operation == 'gegl:buffer-source':
+      buffer = self.properties['buffer']
+      return _convert(buffer.pixels, buffer.component_type, 'float').astype(np.float64)
+    elif self.operation == 'gegl:levels':
+      pixels = self._input_node._get_output()
+      # As in GEGL, the alpha channel is kept intact and values are not clamped.
+      num_color_components = pixels.shape[2] - 1 if pixels.shape[2] in [2, 4] else pixels.shape[2]
+      color_components = pixels[..., :num_color_components]
+      color_components -= self.properties['in-low']
+      color_components /= max(self.properties['in-high'] - self.properties['in-low'], 1e-10)
+      color_components *= self.properties['out-high'] - self.properties['out-low']
+      color_components += self.properties['out-low']
+      return pixels
+    else:
+      raise ValueError(f'unsupported operation: {self.operation}')
+
+
+def _convert(pixels, source_type, target_type):
+  if source_type == target_type:
+    return np.ascontiguousarray(pixels)
+
+  _precision, source_dtype = PRECISIONS[source_type]
+  _precision, target_dtype = PRECISIONS[target_type]
+
+  if source_dtype == np.float32:
+    values = pixels
+  else:
+    values = pixels / np.iinfo(source_dtype).max
+
+  if target_dtype == np.float32:
+    return values.astype(np.float32)
+  else:
+    max_value = np.iinfo(target_dtype).max
+    return np.rint(np.clip(values, 0.0, 1.0) * max_value).astype(target_dtype)
+
+
+class Image:
+
+  def __init__(self, precision):
+    self.precision = precision
+    self.selection = None
+
+  def get_precision(self):
+    return self.precision
+
+  def get_selection(self):
+    return self.selection
+
+
+class Selection:
+
+  @staticmethod
+  def is_empty(image):
+    return image.selection is None
+
+
+class Drawable:
+  pass
+
+
+class Layer(Drawable):
+  pass
+
+
+class Channel(Drawable):
+  pass
+
+
+class PlugIn:
+  __gtype__ = None
+
+
+_drawable_ids = itertools.count(1)
+
+
+class _FakeDrawableMixin:
+
+  def __init__(self, pixels, component_type, name='Drawable'):
+    """``pixels`` is a NumPy array of shape (height, width, components) and the
+    type corresponding to ``component_type``.
+    """
+    self.pixels = pixels
+    self.component_type = component_type
+    self.name = name
+
+    self._id = next(_drawable_ids)
+    self._image = Image(PRECISIONS[component_type][0])
+    self._shadow_pixels = None
+
+    self._update_values()
+
+  def get_id(self):
+    return self._id
+
+  def get_name(self):
+    return self.name
+
+  def get_image(self):
+    return self._image
+
+  def get_width(self):
+    return self.pixels.shape[1]
+
+  def get_height(self):
+    return self.pixels.shape[0]
+
+  def get_bpp(self):
+    return self.pixels.shape[2] * self.pixels.itemsize
+
+  def get_offsets(self):
+    return True, 0, 0
+
+  def has_alpha(self):
+    return self.pixels.shape[2] == 4
+
+  def is_gray(self):
+    return False
+
+  def mask_intersect(self):
+    return True, 0, 0, self.get_width(), self.get_height()
+
+  def get_buffer(self):
+    return Buffer(self.pixels, self.component_type, on_set=self._update_values)
+
+  def get_shadow_buffer(self):
+    if self._shadow_pixels is None:
+      self._shadow_pixels = self.pixels.copy()
+    return Buffer(self._shadow_pixels, self.component_type)
+
+  def merge_shadow(self, _push_undo):
+    if self._shadow_pixels is not None:
+      self.pixels[...] = self._shadow_pixels
+      self._shadow_pixels = None
+      self._update_values()
+
+  def update(self, _x, _y, _width, _height):
+    pass
+
+  def levels(
+        self,
+        histogram_channel,
+        low_input,
+        high_input,
+        _clamp_input,
+        _gamma,
+        low_output,
+        high_output,
+        _clamp_output):
+    """Maps [``low_input``, ``high_input``] to [``low_output``,
+    ``high_output``] in the color channels selected by ``histogram_channel``,
+    like `Gimp.Drawable.levels` with a gamma of 1.0.
+    """
+    if histogram_channel == HistogramChannel.VALUE:
+      components = slice(0, 1) if isinstance(self, Channel) else slice(0, 3)
+    else:
+      component_index = int(histogram_channel) - 1
+      components = slice(component_index, component_index + 1)
+
+    values = _convert(self.pixels[..., components], self.component_type, 'float').astype(
+      np.float64)
+    values = (values - low_input) / max(high_input - low_input, 1e-10)
+    values = low_output + values * (high_output - low_output)
+
+    self.pixels[..., components] = _convert(
+      values.astype(np.float32), 'float', self.component_type)
+    self._update_values()
+
+    return True
+
+  def _update_values(self):
+    self._values = _convert(self.pixels, self.component_type, 'float').astype(np.float64)
+
+  def histogram(self, histogram_channel, start_range, end_range):
+    """Returns pixel counts within the range like `Gimp.Drawable.histogram`,
+    scanning all pixels of the drawable on each call.
+    """
+    counters.histogram_calls += 1
+
+    if histogram_channel == HistogramChannel.VALUE and isinstance(self, Channel):
+      values = self._values[..., 0]
+    elif histogram_channel == HistogramChannel.VALUE:
+      values = self._values[..., :3].max(axis=2)
+    else:
+      values = self._values[..., int(histogram_channel) - 1]
+
+    if self.has_alpha():
+      weights = self._values[..., 3]
+    else:
+      weights = np.ones(values.shape)
+
+    # As in GIMP, pixels are counted in 256 bins for 8-bit drawables and in
+    # 1024 bins otherwise, and the range is rounded to whole bins.
+    max_bin = (256 if self.component_type == 'u8' else 1024) - 1
+    values = np.clip(np.floor(values * max_bin + 0.5), 0, max_bin)
+    start_range = math.floor(start_range * max_bin + 0.5)
+    end_range = math.floor(end_range * max_bin + 0.5)
+
+    in_range = (values >= start_range) & (values <= end_range)
+    pixels = float(weights.sum())
+    count = float(weights[in_range].sum())
+
+    return types.SimpleNamespace(
+      mean=0.0,
+      std_dev=0.0,
+      median=0.0,
+      pixels=pixels,
+      count=count,
+      percentile=count / pixels if pixels > 0 else 0.0,
+    )
+
+
+class FakeLayer(_FakeDrawableMixin, Layer):
+  pass
+
+
+class FakeChannel(_FakeDrawableMixin, Channel):
+  pass
+
+
+def install():
+  """Places the fake ``gi`` package in `sys.modules`.
+
+  Must be called before importing any plug-in module.
+  """
+  gi = _FakeModule('gi')
+  gi.require_version = lambda *args: None
+
+  repository = _FakeModule('gi.repository')
+  gi.repository = repository
+
+  gimp = _FakeModule('gi.repository.Gimp')
+  for name, value in [
+        ('HistogramChannel', HistogramChannel),
+        ('Precision', Precision),
+        ('Image', Image),
+        ('Selection', Selection),
+        ('Drawable', Drawable),
+        ('Layer', Layer),
+        ('Channel', Channel),
+        ('PlugIn', PlugIn),
+        ('main', lambda *args: 0)]:
+    setattr(gimp, name, value)
+
+  gegl = _FakeModule('gi.repository.Gegl')
+  gegl.Rectangle = Rectangle
+  gegl.Node = Node
+  gegl.AbyssPolicy = types.SimpleNamespace(NONE=0)
+
+  glib = _FakeModule('gi.repository.GLib')
+  glib.MAXINT = 2 ** 31 - 1
+  glib.MAXDOUBLE = sys.float_info.max
+
+  modules = {'Gimp': gimp, 'Gegl': gegl, 'GLib': glib}
+  for name in ['GimpUi', 'GObject', 'Gio', 'Gtk', 'GdkPixbuf']:
+    modules[name] = _FakeModule(f'gi.repository.{name}')
+
+  for name, module in modules.items():
+    setattr(repository, name, module)
+    sys.modules[f'gi.repository.{name}'] = module
+
+  sys.modules['gi'] = gi
+  sys.modules['gi.repository'] = repository
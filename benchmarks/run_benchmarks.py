@@ -0,0 +1,284 @@
+"""Benchmarks of the Color Clip analysis on synthetic images.
+
+The benchmarks run without GIMP, using the in-memory backend from
+`fake_gimp`. For each combination of image size, precision, histogram shape
+and analysis backend, the following is recorded:
+* wall time of determining the black and white points (the best of several
+  repeats),
+* number of calls to `Gimp.Drawable.histogram` (PDB calls) and of pixel reads
+  from the drawable buffer,
+* peak memory allocated during the analysis, as reported by `tracemalloc`
+  (for the ``'pdb'`` backend, this is dominated by the fake
+  `Gimp.Drawable.histogram` standing in for GIMP),
+* the obtained black and white points, so that changes in results show up as
+  well.
+
+Results are written as JSON. Passing a previous result file via
+``--baseline`` reports cases that became slower or changed their results.
+
+Example:
+
+  python3 benchmarks/run_benchmarks.py --sizes 512 2048 --output results.json
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import fake_gimp
+
+
+PLUGIN_DIRPATH = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'color-clip')
+
+_PLUGIN_MODULE_NAME = 'color_clip_plugin'
+
+SHAPES = ['uniform', 'gaussian', 'bimodal', 'low-key', 'posterized', 'cutout']
+"""Supported histogram shapes of synthetic images."""
+
+BACKENDS = ['numpy', 'pdb']
+"""Supported analysis backends. ``'pdb'`` forces the analysis to query
+histograms via `Gimp.Drawable.histogram` as if NumPy was not installed.
+"""
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the Color Clip analysis.')
+  parser.add_argument(
+    '--sizes', type=int, nargs='+', default=[256, 1024], help='image widths and heights')
+  parser.add_argument(
+    '--precisions', nargs='+', default=list(fake_gimp.PRECISIONS),
+    choices=list(fake_gimp.PRECISIONS))
+  parser.add_argument('--shapes', nargs='+', default=SHAPES, choices=SHAPES)
+  parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+  parser.add_argument(
+    '--clip-percent', type=float, default=1.0, help='black and white clip percentage')
+  parser.add_argument('--threads', type=int, default=1, help='number of analysis threads')
+  parser.add_argument('--repeat', type=int, default=3, help='number of runs per case')
+  parser.add_argument('--output', default='benchmark_results.json', help='output JSON file')
+  parser.add_argument('--baseline', help='JSON file with previous results to compare against')
+  parser.add_argument(
+    '--slowdown-threshold', type=float, default=1.25,
+    help='wall time ratio above which a case is reported as slower than the baseline')
+
+  args = parser.parse_args()
+
+  color_clip = load_plugin()
+
+  results = []
+
+  for size in args.sizes:
+    for precision in args.precisions:
+      for shape in args.shapes:
+        drawable = create_drawable(size, size, precision, shape)
+
+        for backend in args.backends:
+          result = run_case(
+            color_clip, drawable, backend, args.clip_percent, args.threads, args.repeat)
+          result.update(size=size, precision=precision, shape=shape, backend=backend)
+          results.append(result)
+
+          print(
+            f"{get_case_name(result):40} {result['wall_time_seconds']:9.4f} s"
+            f" {result['pdb_calls']:6} PDB calls"
+            f" {result['peak_memory_bytes'] / (1024 * 1024):8.2f} MiB")
+
+  output = {
+    'metadata': {
+      'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'clip_percent': args.clip_percent,
+      'threads': args.threads,
+      'repeat': args.repeat,
+    },
+    'results': results,
+  }
+
+  with open(args.output, 'w', encoding='utf-8') as file:
+    json.dump(output, file, indent=2)
+
+  if args.baseline:
+    with open(args.baseline, 'r', encoding='utf-8') as file:
+      baseline = json.load(file)
+
+    if report_regressions(baseline['results'], results, args.slowdown_threshold):
+      sys.exit(1)
+
+
+def load_plugin():
+  """Imports the plug-in script with the fake GIMP backend installed and
+  returns it as a module.
+
+  The script is executed only once, as its procedures can be registered only
+  once per process.
+  """
+  if _PLUGIN_MODULE_NAME in sys.modules:
+    return sys.modules[_PLUGIN_MODULE_NAME]
+
+  fake_gimp.install()
+
+  sys.path.insert(0, PLUGIN_DIRPATH)
+
+  spec = importlib.util.spec_from_file_location(
+    _PLUGIN_MODULE_NAME, os.path.join(PLUGIN_DIRPATH, 'color-clip.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+
+  sys.modules[_PLUGIN_MODULE_NAME] = module
+
+  return module
+
+
+def create_drawable(width, height, precision, shape, seed=0):
+  """Returns a fake layer of the given size, precision and histogram shape with
+  an alpha channel.
+  """
+  rng = np.random.default_rng(seed)
+  num_pixels = width * height * 3
+
+  if shape == 'uniform':
+    values = rng.random(num_pixels)
+  elif shape == 'gaussian':
+    values = rng.normal(0.5, 0.12, num_pixels)
+  elif shape == 'bimodal':
+    values = np.where(
+      rng.random(num_pixels) < 0.6,
+      rng.normal(0.2, 0.05, num_pixels),
+      rng.normal(0.75, 0.08, num_pixels))
+  elif shape == 'low-key':
+    values = rng.beta(1.2, 6.0, num_pixels)
+  elif shape == 'posterized':
+    values = rng.integers(0, 6, num_pixels) / 5 * 0.8 + 0.1
+  elif shape == 'cutout':
+    values = rng.normal(0.5, 0.12, num_pixels)
+  else:
+    raise ValueError(f'unsupported shape: {shape}')
+
+  values = np.clip(values, 0.0, 1.0).reshape(height, width, 3)
+  alpha = np.where(rng.random((height, width, 1)) < 0.1, 0.5, 1.0)
+
+  if shape == 'cutout':
+    # An object in the middle of a mostly transparent layer.
+    rows, columns = np.mgrid[0:height, 0:width]
+    radius = min(width, height) / 4
+    is_object = (rows - height / 2) ** 2 + (columns - width / 2) ** 2 < radius ** 2
+    values[~is_object] = 0.0
+    alpha[~is_object] = 0.0
+
+  pixels = np.concatenate([values, alpha], axis=2)
+
+  _gimp_precision, dtype = fake_gimp.PRECISIONS[precision]
+  if dtype == np.float32:
+    pixels = pixels.astype(np.float32)
+  else:
+    pixels = np.rint(pixels * np.iinfo(dtype).max).astype(dtype)
+
+  return fake_gimp.FakeLayer(pixels, precision, name=f'{shape} {width}x{height} {precision}')
+
+
+def run_case(color_clip, drawable, backend, clip_percent, num_threads, num_repeats):
+  """Determines the black and white points of the drawable ``num_repeats``
+  times and returns a dictionary of measurements.
+  """
+  # Importable once `load_plugin` added the plug-in directory to `sys.path`.
+  import histograms
+
+  orig_np = histograms.np
+
+  precision = drawable.get_image().get_precision()
+  max_point = color_clip.get_max_point(precision)
+  use_sketch = color_clip.is_floating_point_precision(precision)
+
+  wall_times = []
+  color_clips = None
+
+  if backend == 'pdb':
+    histograms.np = None
+
+  try:
+    for _unused in range(num_repeats):
+      histograms.clear_histogram_cache()
+      fake_gimp.counters.reset()
+
+      tracemalloc.start()
+      start_time = time.perf_counter()
+
+      color_clips = color_clip._get_color_clips(
+        [drawable],
+        clip_percent,
+        clip_percent,
+        max_point,
+        histograms.DEFAULT_MEMORY_BUDGET,
+        num_threads=num_threads,
+        use_sketch=use_sketch,
+      )
+
+      wall_times.append(time.perf_counter() - start_time)
+      _current_memory, peak_memory = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+  finally:
+    histograms.np = orig_np
+
+  black_point, white_point = color_clips[0]
+
+  return {
+    'wall_time_seconds': min(wall_times),
+    'pdb_calls': fake_gimp.counters.histogram_calls,
+    'buffer_reads': fake_gimp.counters.buffer_reads,
+    'peak_memory_bytes': peak_memory,
+    'black_point': black_point,
+    'white_point': white_point,
+  }
+
+
+def get_case_name(result):
+  return f"{result['backend']}/{result['precision']}/{result['shape']}/{result['size']}"
+
+
+def report_regressions(baseline_results, results, slowdown_threshold):
+  """Prints cases that are slower than in the baseline by more than
+  ``slowdown_threshold`` or whose points differ. Returns ``True`` if any such
+  case was found.
+  """
+  baseline_results_by_name = {get_case_name(result): result for result in baseline_results}
+
+  has_regressions = False
+
+  for result in results:
+    baseline_result = baseline_results_by_name.get(get_case_name(result))
+    if baseline_result is None:
+      continue
+
+    ratio = result['wall_time_seconds'] / max(baseline_result['wall_time_seconds'], 1e-9)
+    if ratio > slowdown_threshold:
+      print(f'SLOWER {get_case_name(result)}: {ratio:.2f}x the baseline wall time')
+      has_regressions = True
+
+    if result['pdb_calls'] > baseline_result['pdb_calls']:
+      print(
+        f"MORE PDB CALLS {get_case_name(result)}:"
+        f" {baseline_result['pdb_calls']} -> {result['pdb_calls']}")
+      has_regressions = True
+
+    points = (result['black_point'], result['white_point'])
+    baseline_points = (baseline_result['black_point'], baseline_result['white_point'])
+    if not np.allclose(points, baseline_points):
+      print(f'CHANGED POINTS {get_case_name(result)}: {baseline_points} -> {points}')
+      has_regressions = True
+
+  return has_regressions
+
+
+if __name__ == '__main__':
+  main()
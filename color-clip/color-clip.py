@@ -1,59 +1,673 @@
 #! /usr/bin/env python
 
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import json
+import os
+import time
+
 import gi
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp
-gi.require_version('GimpUi', '3.0')
-from gi.repository import GimpUi
+from gi.repository import Gio
+from gi.repository import GLib
 from gi.repository import GObject
 
+# `histograms`, `levels`, `progress` and `preview` load NumPy, GEGL or GTK
+# and are imported only by the functions using them, so that GIMP querying the
+# plug-in at startup does not pay for loading them.
+import color_clip
 import procedure
+import stats
 
 
 def python_fu_color_clip(proc, run_mode, image, drawables, config, _data):
+  import histograms
+  import progress
+
   dialog = None
 
   if run_mode == Gimp.RunMode.INTERACTIVE:
+    # The user interface libraries are loaded only when needed so that
+    # non-interactive runs start faster and use less memory.
+    gi.require_version('GimpUi', '3.0')
+    from gi.repository import GimpUi
+    import preview
+
     dialog = GimpUi.ProcedureDialog(procedure=proc, config=config, title=None)
-    dialog.fill(['clip-percent-black', 'clip-percent-white'])
+    dialog.fill([
+      'clip-percent-black',
+      'clip-percent-white',
+      'process-drawables-only',
+      'non-destructive',
+      'per-channel',
+      'analysis-region',
+      'region-x',
+      'region-y',
+      'region-width',
+      'region-height',
+      'sequence-mode',
+      'smoothing-window',
+    ])
+
+    if drawables:
+      color_clip_preview = preview.ColorClipPreview(
+        drawables[0], config, functools.partial(_analyze_drawables, image, drawables[:1], config))
+      dialog.get_content_area().pack_start(color_clip_preview.widget, True, True, 0)
+    else:
+      color_clip_preview = None
 
     is_ok_pressed = dialog.run()
+
+    if color_clip_preview is not None:
+      preview_histogram_lists = color_clip_preview.stop()
+    else:
+      preview_histogram_lists = None
+
     if not is_ok_pressed:
       dialog.destroy()
       return Gimp.PDBStatusType.CANCEL
 
-  linear_and_other_precisions = {
-    Gimp.Precision.U8_NON_LINEAR: Gimp.Precision.U8_LINEAR,
-    Gimp.Precision.U8_PERCEPTUAL: Gimp.Precision.U8_LINEAR,
-    Gimp.Precision.U16_NON_LINEAR: Gimp.Precision.U16_LINEAR,
-    Gimp.Precision.U16_PERCEPTUAL: Gimp.Precision.U16_LINEAR,
-    Gimp.Precision.U32_NON_LINEAR: Gimp.Precision.U32_LINEAR,
-    Gimp.Precision.U32_PERCEPTUAL: Gimp.Precision.U32_LINEAR,
-    Gimp.Precision.HALF_NON_LINEAR: Gimp.Precision.HALF_LINEAR,
-    Gimp.Precision.HALF_PERCEPTUAL: Gimp.Precision.HALF_LINEAR,
-    Gimp.Precision.FLOAT_NON_LINEAR: Gimp.Precision.FLOAT_LINEAR,
-    Gimp.Precision.FLOAT_PERCEPTUAL: Gimp.Precision.FLOAT_LINEAR,
-    Gimp.Precision.DOUBLE_NON_LINEAR: Gimp.Precision.DOUBLE_LINEAR,
-    Gimp.Precision.DOUBLE_PERCEPTUAL: Gimp.Precision.DOUBLE_LINEAR,
+  # The first drawable need not be analyzed again if the preview already did
+  # so. PDB histograms are not reused as they are queried in the image
+  # precision, which may be converted by the run.
+  if dialog is not None and preview_histogram_lists is not None and histograms.np is not None:
+    histogram_lists = preview_histogram_lists + [None] * (len(drawables) - 1)
+  else:
+    histogram_lists = None
+
+  run_stats = stats.RunStats()
+  run_progress = progress.Progress('Color Clip')
+
+  def _clip():
+    _clip_drawables(
+      image,
+      drawables,
+      config,
+      run_stats=run_stats,
+      run_progress=run_progress,
+      histogram_lists=histogram_lists)
+
+  try:
+    if dialog is not None:
+      # The dialog stays open while the drawables are processed so that the
+      # run can be canceled.
+      progress.run_in_dialog(dialog, run_progress, _clip)
+    else:
+      _clip()
+  except progress.Canceled:
+    return Gimp.PDBStatusType.CANCEL
+  except ValueError as e:
+    return Gimp.PDBStatusType.CALLING_ERROR, str(e)
+  finally:
+    run_progress.end()
+    if dialog is not None:
+      dialog.destroy()
+
+  _record_pdb_call_memo_counts(run_stats)
+  run_stats.finish()
+
+  run_record = run_stats.to_dict()
+
+  log_filepath = config.get_property('log-file')
+  if log_filepath:
+    stats.write_log(log_filepath, run_record)
+
+  return Gimp.PDBStatusType.SUCCESS, json.dumps(run_record)
+
+
+def python_fu_color_clip_batch(_proc, config, _data):
+  import histograms
+
+  input_patterns = config.get_property('input-files') or []
+  output_dirpath = config.get_property('output-directory')
+
+  if not output_dirpath:
+    return Gimp.PDBStatusType.CALLING_ERROR, 'Output directory must be specified'
+
+  try:
+    input_and_output_filepaths = _get_batch_filepaths(input_patterns, output_dirpath)
+  except ValueError as e:
+    return Gimp.PDBStatusType.CALLING_ERROR, str(e)
+
+  input_filepaths = list(input_and_output_filepaths)
+
+  os.makedirs(output_dirpath, exist_ok=True)
+
+  num_workers = config.get_property('num-workers')
+  if num_workers <= 0:
+    num_workers = histograms.get_num_workers()
+  num_workers = max(min(num_workers, len(input_filepaths)), 1)
+
+  num_threads_per_worker = max(histograms.get_num_workers() // num_workers, 1)
+
+  log_filepath = config.get_property('log-file')
+
+  def _clip_file(input_filepath):
+    output_filepath = input_and_output_filepaths[input_filepath]
+    run_stats = stats.RunStats()
+    error = None
+
+    try:
+      os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+
+      with run_stats.measure('load'), histograms.gimp_lock:
+        image = Gimp.file_load(Gimp.RunMode.NONINTERACTIVE, Gio.File.new_for_path(input_filepath))
+        drawables = image.get_selected_drawables() or image.get_layers()
+
+      try:
+        _clip_drawables(
+          image, drawables, config, num_threads=num_threads_per_worker, run_stats=run_stats)
+
+        with run_stats.measure('save'), histograms.gimp_lock:
+          Gimp.file_save(
+            Gimp.RunMode.NONINTERACTIVE, image, Gio.File.new_for_path(output_filepath), None)
+      finally:
+        with histograms.gimp_lock:
+          image.delete()
+    except Exception as e:
+      error = f'{input_filepath}: {e}'
+
+    run_stats.finish()
+
+    file_record = {'file': input_filepath, 'error': error, **run_stats.to_dict()}
+    if log_filepath:
+      stats.write_log(log_filepath, file_record)
+
+    return file_record
+
+  start_time = time.perf_counter()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    file_records = list(executor.map(_clip_file, input_filepaths))
+
+  errors = [
+    file_record['error'] for file_record in file_records if file_record['error'] is not None]
+
+  elapsed_time = time.perf_counter() - start_time
+
+  num_processed_files = len(input_filepaths) - len(errors)
+  files_per_second = num_processed_files / elapsed_time if elapsed_time > 0 else 0.0
+
+  Gimp.message(
+    f'Color Clip: processed {num_processed_files} of {len(input_filepaths)} file(s)'
+    f' in {elapsed_time:.2f} s ({files_per_second:.2f} files/s)')
+
+  if errors:
+    return Gimp.PDBStatusType.EXECUTION_ERROR, 'Failed to process files:\n' + '\n'.join(errors)
+
+  batch_record = {
+    'total_seconds': elapsed_time,
+    'files_per_second': files_per_second,
+    'num_workers': num_workers,
+    'files': file_records,
   }
 
-  image.undo_group_start()
+  return (
+    Gimp.PDBStatusType.SUCCESS, num_processed_files, files_per_second, json.dumps(batch_record))
+
+
+def python_fu_color_clip_points(_proc, _run_mode, image, drawables, config, _data):
+  import histograms
+  import progress
+
+  per_channel = config.get_property('per-channel')
+  run_stats = stats.RunStats()
+  histogram_lists = []
+
+  if config.get_property('mode') == 'apply':
+    with histograms.gimp_lock:
+      precision = image.get_precision()
+
+    # Points outside [0, 1] are applied in linear light to floating-point
+    # images, but rejected by `Gimp.Drawable.levels` otherwise.
+    allow_out_of_range = (
+      is_floating_point_precision(precision) and (histograms.np is not None or not per_channel))
+
+    try:
+      color_clips = _get_given_color_clips(
+        drawables,
+        _get_double_array(config, 'black-points'),
+        _get_double_array(config, 'white-points'),
+        per_channel,
+        allow_out_of_range,
+      )
+    except ValueError as e:
+      return Gimp.PDBStatusType.CALLING_ERROR, str(e)
+
+    _clip_drawables(image, drawables, config, run_stats=run_stats, color_clips=color_clips)
+  else:
+    with histograms.gimp_lock:
+      drawable_stats = _add_drawable_stats(run_stats, drawables)
+
+    run_progress = progress.Progress('Color Clip: analyzing')
+
+    try:
+      color_clips, histogram_lists = _analyze_drawables(
+        image,
+        drawables,
+        config,
+        drawable_stats=drawable_stats,
+        drawable_progress=[run_progress.add_task() for _unused in drawables],
+        return_histograms=True)
+    except ValueError as e:
+      return Gimp.PDBStatusType.CALLING_ERROR, str(e)
+    finally:
+      run_progress.end()
+
+  cumulative_histogram = []
+  histogram_size = config.get_property('histogram-size')
+  if histogram_size > 0:
+    for drawable_histograms in histogram_lists:
+      for histogram in drawable_histograms:
+        cumulative_histogram.extend(histogram.get_cumulative_fractions(histogram_size))
+
+  _record_pdb_call_memo_counts(run_stats)
+  run_stats.finish()
+
+  run_record = run_stats.to_dict()
+
+  log_filepath = config.get_property('log-file')
+  if log_filepath:
+    stats.write_log(log_filepath, run_record)
+
+  channel_color_clips = []
+  for drawable_color_clip in color_clips:
+    channel_color_clips.extend(drawable_color_clip if per_channel else [drawable_color_clip])
+
+  return (
+    Gimp.PDBStatusType.SUCCESS,
+    _get_double_array_value([black_point for black_point, _unused in channel_color_clips]),
+    _get_double_array_value([white_point for _unused, white_point in channel_color_clips]),
+    _get_double_array_value(cumulative_histogram),
+    json.dumps(run_record),
+  )
+
+
+def _get_batch_filepaths(input_patterns, output_dirpath):
+  """Returns a dictionary of files matching the glob patterns and the paths
+  of the corresponding output files in ``output_dirpath``, in the order of
+  the patterns.
+
+  Each output file keeps the path of the input file relative to the
+  directory of its pattern preceding the first wildcard, e.g. files matching
+  ``photos/**/*.jpg`` keep their subdirectories of ``photos``. Files matched
+  by multiple patterns are processed only once.
+
+  `ValueError` is raised if multiple input files would be exported to the
+  same output file or if an output file would overwrite an input file.
+  """
+  input_and_output_filepaths = {}
+  real_input_filepaths = set()
+
+  for pattern in input_patterns:
+    pattern = os.path.expanduser(pattern)
+    pattern_dirpath = _get_pattern_dirpath(pattern)
+
+    for input_filepath in sorted(glob.glob(pattern, recursive=True)):
+      real_input_filepath = os.path.realpath(input_filepath)
+      if not os.path.isfile(input_filepath) or real_input_filepath in real_input_filepaths:
+        continue
+
+      real_input_filepaths.add(real_input_filepath)
+      input_and_output_filepaths[input_filepath] = os.path.join(
+        output_dirpath, os.path.relpath(input_filepath, pattern_dirpath))
+
+  errors = []
+  input_filepaths_per_output_filepath = {}
+
+  for input_filepath, output_filepath in input_and_output_filepaths.items():
+    real_output_filepath = os.path.realpath(output_filepath)
+
+    if real_output_filepath in real_input_filepaths:
+      errors.append(f'{input_filepath}: output file would overwrite an input file')
+    elif real_output_filepath in input_filepaths_per_output_filepath:
+      errors.append(
+        f'{input_filepath}: output file would overwrite the output file of'
+        f' {input_filepaths_per_output_filepath[real_output_filepath]}')
+    else:
+      input_filepaths_per_output_filepath[real_output_filepath] = input_filepath
+
+  if errors:
+    raise ValueError('Output files collide:\n' + '\n'.join(errors))
+
+  return input_and_output_filepaths
+
+
+def _get_pattern_dirpath(pattern):
+  """Returns the longest directory of the glob pattern without wildcards."""
+  dirpath = os.path.dirname(pattern)
+  while any(char in dirpath for char in '*?['):
+    dirpath = os.path.dirname(dirpath)
+
+  return dirpath or os.curdir
+
+
+def _record_pdb_call_memo_counts(run_stats):
+  pdb_call_memo_counts = procedure.get_pdb_call_memo_counts()
+  if pdb_call_memo_counts is not None:
+    run_stats.count('pdb_memo_hits', pdb_call_memo_counts['hits'])
+    run_stats.count('pdb_memo_misses', pdb_call_memo_counts['misses'])
+
+
+def _get_given_color_clips(
+      drawables, black_points, white_points, per_channel, allow_out_of_range=False):
+  """Returns points given as procedure arguments in the format returned by
+  `_get_color_clips`.
+
+  A single pair of points is applied to all drawables (and all their channels
+  if ``per_channel`` is ``True``). Otherwise, one pair is expected for each
+  drawable, or for each channel of each drawable if ``per_channel`` is
+  ``True``, in the order returned by the analysis.
+
+  `ValueError` is raised if the number of points does not match or if
+  ``allow_out_of_range`` is ``False`` and a point lies outside [0, 1].
+  """
+  import histograms
+
+  if len(black_points) != len(white_points):
+    raise ValueError('The number of black points and white points must be the same')
+
+  if not allow_out_of_range and any(
+        not 0.0 <= point <= 1.0 for point in [*black_points, *white_points]):
+    raise ValueError(
+      'Black and white points must be within [0, 1] unless applied to a floating-point image')
+
+  if per_channel:
+    with histograms.gimp_lock:
+      num_channels = [histograms.get_num_color_components(drawable) for drawable in drawables]
+  else:
+    num_channels = [1] * len(drawables)
+
+  points = list(zip(black_points, white_points))
+
+  if len(points) == 1:
+    points *= sum(num_channels)
+
+  if len(points) != sum(num_channels):
+    raise ValueError(
+      f'Expected 1 or {sum(num_channels)} pairs of black and white points, got {len(points)}')
+
+  color_clips = []
+  index = 0
+
+  for drawable_num_channels in num_channels:
+    drawable_points = points[index:index + drawable_num_channels]
+    color_clips.append(drawable_points if per_channel else drawable_points[0])
+    index += drawable_num_channels
+
+  return color_clips
+
+
+def _get_double_array(config, name):
+  array = config.get_property(name)
+  if array is None:
+    return []
+  else:
+    return list(Gimp.double_array_get_values(array))
+
+
+def _get_double_array_value(values):
+  value = GObject.Value(Gimp.DoubleArray)
+  Gimp.value_set_double_array(value, values)
+  return value
+
+
+def _clip_drawables(
+      image,
+      drawables,
+      config,
+      num_threads=None,
+      run_stats=None,
+      color_clips=None,
+      run_progress=None,
+      histogram_lists=None,
+):
+  """Applies color clip to the drawables according to the procedure
+  configuration and returns the applied points as returned by
+  `_get_color_clips`.
+
+  ``num_threads`` is the maximum number of threads used to analyze the
+  drawables, defaulting to the number of CPU cores.
+
+  If ``run_stats`` is a `stats.RunStats` object, durations of individual
+  stages and counts of PDB calls and buffer reads are recorded in it.
+
+  If ``color_clips`` is not ``None``, the drawables are not analyzed and the
+  given points are applied instead. ``color_clips`` must have the same format
+  as the return value of `_get_color_clips`.
+
+  If ``run_progress`` is a `progress.Progress` object, the analysis and the
+  application of levels to each drawable are reported as its tasks. The run
+  can be canceled until the first drawable is modified, in which case
+  `progress.Canceled` is raised. With NumPy, the drawables are analyzed before
+  the image is modified at all, hence a canceled run leaves no trace in the
+  undo history. Without NumPy, the drawables are analyzed after converting
+  the image precision, which is converted back if the run is canceled. Both
+  conversions then remain in the undo history as a single undo step.
+
+  ``histogram_lists`` contains histograms of the drawables computed
+  beforehand as returned by `_get_color_clips`, with ``None`` for each
+  drawable to analyze. The histograms must match the analysis arguments in
+  ``config`` and, for `histograms.PdbHistogram` objects, the image precision
+  during the analysis.
+  """
+  import histograms
+
+  if run_stats is None:
+    run_stats = stats.RunStats()
+
+  per_channel = config.get_property('per-channel')
+  non_destructive = config.get_property('non-destructive') and not per_channel
+  # Drawable filters are applied in linear light, hence the image precision
+  # does not have to be converted either.
+  process_drawables_only = config.get_property('process-drawables-only') or non_destructive
+
+  with histograms.gimp_lock:
+    drawable_stats = _add_drawable_stats(run_stats, drawables)
+
+  # Tasks are added upfront so that the overall progress never decreases.
+  if run_progress is not None:
+    if color_clips is None:
+      analysis_progress = [run_progress.add_task() for _unused in drawables]
+    else:
+      analysis_progress = None
+    levels_progress = [run_progress.add_task() for _unused in drawables]
+  else:
+    analysis_progress = None
+    levels_progress = [None] * len(drawables)
+
+  memory_budget = config.get_property('memory-budget') * 1024 * 1024
+
+  tile_summaries = [None] * len(drawables)
+
+  def _analyze():
+    color_clips_, histogram_lists_ = _analyze_drawables(
+      image,
+      drawables,
+      config,
+      num_threads=num_threads,
+      drawable_stats=drawable_stats,
+      drawable_progress=analysis_progress,
+      return_histograms=True,
+      histogram_lists=histogram_lists)
+
+    # Tiles found to be uniform during the analysis need not be read again
+    # when applying levels.
+    tile_summaries_ = [
+      drawable_histograms[0].tile_summary if drawable_histograms else None
+      for drawable_histograms in histogram_lists_]
+
+    sampling_tolerance = config.get_property('sampling-tolerance')
+    if sampling_tolerance > 0:
+      _report_estimated_color_clips(drawables, color_clips_, sampling_tolerance, per_channel)
+
+    return color_clips_, tile_summaries_
+
+  # Pixel histograms are computed in linear light regardless of the image
+  # precision, hence the drawables can be analyzed before the image is
+  # modified. PDB histograms are queried in the image precision and require
+  # the precision to be converted first.
+  if color_clips is None and histograms.np is not None:
+    color_clips, tile_summaries = _analyze()
+
+  with histograms.gimp_lock:
+    image.undo_group_start()
+
+    orig_precision = None
+    if (not process_drawables_only
+        and image.get_precision() not in _linear_and_other_precisions.values()):
+      orig_precision = image.get_precision()
+      with run_stats.measure('precision_conversion'):
+        procedure.modify_pdb(
+          image.convert_precision, _linear_and_other_precisions[orig_precision])
+
+    precision = image.get_precision()
+
+  use_sketch = is_floating_point_precision(precision)
+
+  # Points are in linear light. Without NumPy, channels are adjusted by
+  # `Gimp.Drawable.levels`, which works in the TRC of the image, hence the
+  # points must be encoded with the TRC if the precision was not converted.
+  if (per_channel
+      and histograms.np is None
+      and precision not in _linear_and_other_precisions.values()):
+    get_applied_color_clips = lambda color_clips_: _map_color_clips(
+      color_clips_, color_clip.linear_to_srgb, per_channel)
+  else:
+    get_applied_color_clips = lambda color_clips_: color_clips_
+
+  try:
+    if color_clips is None:
+      color_clips, tile_summaries = _analyze()
 
-  orig_precision = None
-  if image.get_precision() not in linear_and_other_precisions.values():
-    orig_precision = image.get_precision()
-    image.convert_precision(linear_and_other_precisions[orig_precision])
+    with histograms.gimp_lock:
+      for drawable, drawable_color_clip, stats_, tile_summary, task_progress in zip(
+            drawables,
+            get_applied_color_clips(color_clips),
+            drawable_stats,
+            tile_summaries,
+            levels_progress):
+        with stats_.measure('levels'):
+          _apply_color_clip(
+            drawable,
+            drawable_color_clip,
+            memory_budget,
+            per_channel,
+            non_destructive,
+            process_drawables_only or use_sketch,
+            tile_summary,
+          )
 
-  for drawable in drawables:
-    black_point, white_point = get_color_clip(
+        if task_progress is not None:
+          task_progress.finish()
+  finally:
+    # The image is restored even if the analysis fails (e.g. due to invalid
+    # arguments) or is canceled.
+    with histograms.gimp_lock:
+      if orig_precision is not None:
+        with run_stats.measure('precision_conversion'):
+          procedure.modify_pdb(image.convert_precision, orig_precision)
+
+      image.undo_group_end()
+
+  return color_clips
+
+
+def _analyze_drawables(
+      image,
+      drawables,
+      config,
+      num_threads=None,
+      drawable_stats=None,
+      drawable_progress=None,
+      return_histograms=False,
+      histogram_lists=None,
+):
+  """Determines black and white points of the drawables according to the
+  procedure configuration without modifying them.
+
+  See `_get_color_clips` for the parameters and the return value.
+  """
+  import histograms
+
+  with histograms.gimp_lock:
+    precision = image.get_precision()
+    regions = [_get_analysis_region(image, drawable, config) for drawable in drawables]
+
+  per_channel = config.get_property('per-channel')
+
+  color_clips, histogram_lists = _get_color_clips(
+    drawables,
+    config.get_property('clip-percent-black'),
+    config.get_property('clip-percent-white'),
+    get_max_point(precision),
+    config.get_property('memory-budget') * 1024 * 1024,
+    num_threads=num_threads,
+    sampling_tolerance=config.get_property('sampling-tolerance'),
+    use_sketch=is_floating_point_precision(precision),
+    use_cache=config.get_property('use-histogram-cache'),
+    regions=regions,
+    per_channel=per_channel,
+    drawable_stats=drawable_stats,
+    drawable_progress=drawable_progress,
+    return_histograms=True,
+    histogram_lists=histogram_lists,
+    sequence_mode=config.get_property('sequence-mode'),
+    smoothing_window=config.get_property('smoothing-window'),
+  )
+
+  # Without NumPy, histograms are queried from GIMP in the TRC of the image.
+  # The points are converted to linear light, in which pixel histograms are
+  # computed, so that they are applied the same way regardless of the image
+  # precision.
+  if histograms.np is None and precision not in _linear_and_other_precisions.values():
+    color_clips = _map_color_clips(color_clips, color_clip.srgb_to_linear, per_channel)
+
+  if return_histograms:
+    return color_clips, histogram_lists
+  else:
+    return color_clips
+
+
+def _add_drawable_stats(run_stats, drawables):
+  return [
+    run_stats.add_drawable(
+      drawable.get_name(), drawable.get_id(), drawable.get_width() * drawable.get_height())
+    for drawable in drawables]
+
+
+def _apply_color_clip(
       drawable,
-      config.get_property('clip-percent-black'),
-      config.get_property('clip-percent-white'),
-    )
-    drawable.levels(
+      color_clip,
+      memory_budget,
+      per_channel,
+      non_destructive,
+      in_linear_light,
+      tile_summary=None,
+):
+  import levels
+
+  if per_channel:
+    levels.apply_channel_levels(drawable, color_clip, memory_budget, tile_summary)
+    return
+
+  low_input, high_input = color_clip
+
+  if non_destructive and isinstance(drawable, Gimp.Layer):
+    _apply_levels_as_filter(drawable, low_input, high_input)
+  elif in_linear_light:
+    # `Gimp.Drawable.levels` limits the input levels to [0, 1], which would
+    # discard points of floating-point images lying outside this range.
+    _apply_levels_in_linear_light(drawable, low_input, high_input)
+  else:
+    procedure.modify_pdb(
+      drawable.levels,
       Gimp.HistogramChannel.VALUE,
-      black_point / 255,
-      white_point / 255,
+      low_input,
+      high_input,
       False,
       1.0,
       0.0,
@@ -61,171 +675,684 @@ def python_fu_color_clip(proc, run_mode, image, drawables, config, _data):
       False,
     )
 
-  if orig_precision is not None:
-    image.convert_precision(orig_precision)
 
-  image.undo_group_end()
+def _get_color_clips(
+      drawables,
+      clip_percent_black,
+      clip_percent_white,
+      max_point,
+      memory_budget,
+      num_threads=None,
+      sampling_tolerance=0.0,
+      use_sketch=False,
+      use_cache=False,
+      regions=None,
+      per_channel=False,
+      drawable_stats=None,
+      drawable_progress=None,
+      return_histograms=False,
+      histogram_lists=None,
+      sequence_mode='none',
+      smoothing_window=1,
+):
+  """Returns a list of (black point, white point) tuples, one for each
+  drawable. The points are pixel values, where 0.0 corresponds to black and
+  1.0 to white.
+
+  If ``per_channel`` is ``True``, each list element is instead a list of
+  (black point, white point) tuples, one for each color channel of the
+  drawable, see `histograms.get_channel_histograms`.
+
+  If ``sampling_tolerance`` is greater than 0, the points are estimated from a
+  subsample of pixels, see `histograms.get_histogram`. If ``use_sketch`` is
+  ``True``, the points are obtained from a quantile sketch of floating-point
+  pixel values and may lie outside the [0, 1] range. If ``use_cache`` is
+  ``True``, histograms are reused while the drawables remain unchanged.
 
-  if dialog is not None:
-    dialog.destroy()
+  ``regions`` is a list of regions to analyze, one for each drawable, as
+  returned by `_get_analysis_region`. By default, the selected pixels of each
+  drawable are analyzed.
 
-  return Gimp.PDBStatusType.SUCCESS
+  The drawables are analyzed concurrently by a pool of at most ``num_threads``
+  threads (the number of CPU cores by default). If there are fewer drawables
+  than threads, the remaining threads are used to analyze bands of each
+  drawable in parallel. The memory budget is split evenly among the threads.
 
+  ``drawable_stats`` is a list of `stats.DrawableStats` objects, one for each
+  drawable, recording the time spent computing histograms and searching for
+  the points along with the number of PDB calls and buffer reads.
 
-def get_color_clip(drawable, clip_percent_black, clip_percent_white):
-  """Determines the black and white points based on the specified clip
-  percentages.
+  ``drawable_progress`` is a list of `progress.TaskProgress` objects, one for
+  each drawable, reporting the progress of the analysis. If the run is
+  canceled, `progress.Canceled` is raised. If ``use_cache`` is ``True``,
+  histograms of drawables analyzed completely or partially are kept (see
+  `histograms.get_histogram`), so that a later analysis in the same process
+  continues where the canceled one stopped.
 
-  This is a wrapper for `_get_color_clip` to correct clip percentages and black
-  and white points to prevent color inversion.
+  If ``return_histograms`` is ``True``, a tuple is returned instead, whose
+  second element contains a list of analyzed `histograms.CumulativeHistogram`
+  objects for each drawable, one for each channel if ``per_channel`` is
+  ``True``. Histograms returned this way can be passed as ``histogram_lists``
+  to determine points for other clip percentages without analyzing the
+  drawables again. Drawables whose element of ``histogram_lists`` is ``None``
+  are analyzed.
+
+  ``sequence_mode`` determines how the drawables are treated if they are
+  frames of an image sequence (e.g. an animation):
+  * ``'none'`` - points are determined for each drawable independently,
+  * ``'aggregate'`` - the histograms of all drawables are merged and the same
+    points, determined from the merged histogram, are returned for each
+    drawable,
+  * ``'smooth'`` - points of each drawable are averaged with the points of the
+    neighboring drawables in a window of ``smoothing_window`` drawables,
+    which avoids flicker between frames.
+
+  In either mode, each drawable is read only once.
+
+  `ValueError` is raised if a drawable has no pixels to analyze (e.g. it is
+  fully transparent), as there are no points to determine.
   """
-  clip_percent_black = max(min(clip_percent_black, 100.0), 0.0)
-  clip_percent_white = max(min(clip_percent_white, 100.0), 0.0)
-  
-  # Adjust percentages to prevent color inversion.
-  if clip_percent_black + clip_percent_white > 100.0:
-    if clip_percent_black > clip_percent_white:
-      clip_percent_black = 100.0 - clip_percent_white
-    elif clip_percent_white > clip_percent_black:
-      clip_percent_white = 100.0 - clip_percent_black
+  import histograms
+
+  if num_threads is None:
+    num_threads = histograms.get_num_workers()
+
+  num_workers = max(min(histograms.get_num_workers(len(drawables)), num_threads), 1)
+  num_threads_per_worker = max(num_threads // num_workers, 1)
+  memory_budget_per_worker = max(memory_budget // num_workers, 1)
+
+  if regions is None:
+    regions = [None] * len(drawables)
+
+  if drawable_stats is None:
+    drawable_stats = [None] * len(drawables)
+
+  if drawable_progress is None:
+    drawable_progress = [None] * len(drawables)
+
+  if per_channel and sequence_mode != 'none':
+    with histograms.gimp_lock:
+      num_channels = {histograms.get_num_color_components(drawable) for drawable in drawables}
+
+    if len(num_channels) > 1:
+      raise ValueError(
+        'When clipping channels independently, all drawables of a sequence must be either'
+        ' layers or channels')
+
+  if per_channel:
+    get_histograms_func = histograms.get_channel_histograms
+  else:
+    get_histograms_func = lambda *args, **kwargs: [histograms.get_histogram(*args, **kwargs)]
+
+  def _get_drawable_histograms(drawable, region, stats_, task_progress):
+    with _measure(stats_, 'histogram'):
+      return get_histograms_func(
+        drawable,
+        0,
+        max_point,
+        memory_budget=memory_budget_per_worker,
+        num_threads=num_threads_per_worker,
+        sampling_tolerance=sampling_tolerance,
+        use_cache=use_cache,
+        use_sketch=use_sketch,
+        region=region,
+        drawable_stats=stats_,
+        task_progress=task_progress,
+      )
+
+  def _get_drawable_color_clip(drawable, drawable_histograms, stats_, task_progress):
+    channel_color_clips = []
+
+    for histogram in drawable_histograms:
+      if histogram.total_count <= 0:
+        # Points cannot be determined, e.g. for a fully transparent layer or if
+        # the analysis region misses the drawable.
+        with histograms.gimp_lock:
+          drawable_name = drawable.get_name()
+        raise ValueError(
+          f'"{drawable_name}" has no pixels to analyze within the analysis region')
+
+      # PDB histograms are queried lazily, i.e. during the search.
+      with _measure(stats_, 'point_search'):
+        black_point, white_point = get_color_clip(
+          drawable,
+          clip_percent_black,
+          clip_percent_white,
+          max_point=histogram.max_point,
+          histogram=histogram,
+        )
+
+      channel_color_clips.append(
+        (histogram.get_value(black_point), histogram.get_value(white_point)))
+
+    if task_progress is not None:
+      task_progress.finish()
+
+    return channel_color_clips if per_channel else channel_color_clips[0]
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    if histogram_lists is None:
+      histogram_lists = [None] * len(drawables)
+
+    missing_indices = [
+      index for index, drawable_histograms in enumerate(histogram_lists)
+      if drawable_histograms is None]
+    select_missing = lambda items: [items[index] for index in missing_indices]
+
+    histogram_lists = list(histogram_lists)
+    for index, drawable_histograms in zip(
+          missing_indices,
+          executor.map(
+            _get_drawable_histograms,
+            select_missing(drawables),
+            select_missing(regions),
+            select_missing(drawable_stats),
+            select_missing(drawable_progress))):
+      histogram_lists[index] = drawable_histograms
+
+    if sequence_mode == 'aggregate' and drawables:
+      merged_histograms = [
+        histograms.merge_histograms(list(channel_histograms))
+        for channel_histograms in zip(*histogram_lists)]
+
+      color_clips = (
+        [_get_drawable_color_clip(drawables[0], merged_histograms, None, None)]
+        * len(drawables))
+
+      for task_progress in drawable_progress:
+        if task_progress is not None:
+          task_progress.finish()
     else:
-      clip_percent_black = 50.0
-      clip_percent_white = 50.0
-  
-  black_point, white_point = _get_color_clip(
-    drawable, clip_percent_black, clip_percent_white)
-  
-  # Adjust black point to prevent color inversion.
-  if black_point > white_point:
-    black_point = white_point
-  
-  return black_point, white_point
-
-
-def _get_color_clip(drawable, clip_percent_black, clip_percent_white):
+      color_clips = list(executor.map(
+        _get_drawable_color_clip,
+        drawables,
+        histogram_lists,
+        drawable_stats,
+        drawable_progress))
+
+  if sequence_mode == 'smooth':
+    color_clips = _smooth_color_clips(color_clips, smoothing_window, per_channel)
+
+  if return_histograms:
+    return color_clips, histogram_lists
+  else:
+    return color_clips
+
+
+def _smooth_color_clips(color_clips, smoothing_window, per_channel):
+  """Returns points of each drawable averaged with the points of the
+  neighboring drawables in a window of ``smoothing_window`` drawables centered
+  on the drawable. Windows are truncated at both ends of the sequence.
   """
-  Determine the black and white points based on the specified clip percentages.
-  
-  For layers and layer groups, use the RGB pseudo-channel of the histogram.
-  For channels and layer masks, use the value channel of the histogram.
+  if not per_channel:
+    return [
+      channel_color_clips[0]
+      for channel_color_clips in _smooth_color_clips(
+        [[drawable_color_clip] for drawable_color_clip in color_clips], smoothing_window, True)]
+
+  smoothed_color_clips = []
+
+  for index in range(len(color_clips)):
+    start_index = max(index - (smoothing_window - 1) // 2, 0)
+    end_index = index + smoothing_window // 2 + 1
+    window = color_clips[start_index:end_index]
+
+    smoothed_color_clips.append([
+      (sum(black_point for black_point, _unused in channel_points) / len(channel_points),
+       sum(white_point for _unused, white_point in channel_points) / len(channel_points))
+      for channel_points in zip(*window)])
+
+  return smoothed_color_clips
+
+
+def _map_color_clips(color_clips, func, per_channel):
+  """Returns points of each drawable with ``func`` applied to each point."""
+  if not per_channel:
+    return [
+      channel_color_clips[0]
+      for channel_color_clips in _map_color_clips(
+        [[drawable_color_clip] for drawable_color_clip in color_clips], func, True)]
+
+  return [
+    [(func(black_point), func(white_point)) for black_point, white_point in channel_color_clips]
+    for channel_color_clips in color_clips]
+
+
+def _measure(drawable_stats, stage):
+  if drawable_stats is not None:
+    return drawable_stats.measure(stage)
+  else:
+    return contextlib.nullcontext()
+
+
+def _get_analysis_region(image, drawable, config):
+  """Returns the region of the drawable to analyze according to the
+  ``analysis-region`` argument, as accepted by `histograms.get_histogram`.
+
+  The region only limits which pixels determine the black and white points.
+  Levels are applied to the drawable as before.
   """
+  analysis_region = config.get_property('analysis-region')
 
-  min_point = 0
-  max_point = 255
-  
-  black_point = _get_black_point(drawable, clip_percent_black, min_point, max_point)
-  white_point = _get_white_point(drawable, clip_percent_white, min_point, max_point)
-  
-  return black_point, white_point
+  if analysis_region == 'selection-bounds':
+    _success, _is_nonempty, x1, y1, x2, y2 = Gimp.Selection.bounds(image)
+    return x1, y1, x2 - x1, y2 - y1
+  elif analysis_region == 'rectangle':
+    x = config.get_property('region-x')
+    y = config.get_property('region-y')
+    width = config.get_property('region-width') or image.get_width() - x
+    height = config.get_property('region-height') or image.get_height() - y
+    return x, y, width, height
+  elif analysis_region == 'drawable':
+    _success, offset_x, offset_y = drawable.get_offsets()
+    return offset_x, offset_y, drawable.get_width(), drawable.get_height()
+  else:
+    return None
 
 
-def _get_black_point(drawable, clip_percent_black, min_point, max_point):
-  return _get_color_point(
-    drawable,
-    clip_percent_black,
-    min_point,
-    max_point,
-    initial_color_point=max_point,
-    point_sequence=range(min_point, max_point + 1),
-    get_percentile_from_histogram_func=get_black_point_histogram_percentile,
-    get_next_point_func=lambda point: point - 1,
-  )
+def _report_estimated_color_clips(drawables, color_clips, sampling_tolerance, per_channel=False):
+  import histograms
 
+  with histograms.gimp_lock:
+    lines = []
 
-def _get_white_point(drawable, clip_percent_white, min_point, max_point):
-  return _get_color_point(
-    drawable,
-    clip_percent_white,
-    min_point,
-    max_point,
-    initial_color_point=min_point,
-    point_sequence=range(max_point, -1, -1),
-    get_percentile_from_histogram_func=get_white_point_histogram_percentile,
-    get_next_point_func=lambda point: point + 1,
-  )
+    for drawable, drawable_color_clip in zip(drawables, color_clips):
+      channel_color_clips = drawable_color_clip if per_channel else [drawable_color_clip]
+      lines.append(f'{drawable.get_name()}: ' + '; '.join(
+        f'black point {black_point:.6f}, white point {white_point:.6f}'
+        for black_point, white_point in channel_color_clips))
 
+    Gimp.message(
+      f'Color Clip: points estimated from a sample of'
+      f' {histograms.get_sample_size(sampling_tolerance)} pixels per drawable'
+      f' (tolerance \u00b1{sampling_tolerance} percentile):\n' + '\n'.join(lines))
 
-def _get_color_point(
-      drawable,
-      clip_percent,
-      min_point,
-      max_point,
-      initial_color_point,
-      point_sequence,
-      get_percentile_from_histogram_func,
-      get_next_point_func,
-):
-  desired_percentile = 100.0 - clip_percent
-  color_point = initial_color_point
-  
-  for point in point_sequence:
-    current_percentile = get_percentile_from_histogram_func(drawable, point, min_point, max_point)
-    
-    if current_percentile < desired_percentile:
-      color_point = get_next_point_func(point)
-      break
-  
-  return color_point
 
+def _apply_levels_as_filter(drawable, low_input, high_input):
+  """Applies levels to the drawable as a non-destructive filter.
+
+  The drawable pixels are left intact and the filter is rendered only when
+  the image is displayed or exported. If the drawable already contains a
+  filter added by this plug-in, the filter is updated instead of adding a new
+  one.
+  """
+  drawable_filter = next(
+    (drawable_filter for drawable_filter in drawable.get_filters()
+     if (drawable_filter.get_name() == _FILTER_NAME
+         and drawable_filter.get_operation_name() == 'gegl:levels')),
+    None)
 
-def get_black_point_histogram_percentile(drawable, point, _min_point, max_point):
-  return _get_histogram_percentile(drawable, point, max_point)
+  is_new_filter = drawable_filter is None
+  if is_new_filter:
+    drawable_filter = Gimp.DrawableFilter.new(drawable, 'gegl:levels', _FILTER_NAME)
 
+  filter_config = drawable_filter.get_config()
+  filter_config.set_property('in-low', low_input)
+  filter_config.set_property('in-high', high_input)
+  filter_config.set_property('out-low', 0.0)
+  filter_config.set_property('out-high', 1.0)
 
-def get_white_point_histogram_percentile(drawable, point, min_point, _max_point):
-  return _get_histogram_percentile(drawable, min_point, point)
+  procedure.modify_pdb(drawable_filter.update)
+
+  if is_new_filter:
+    procedure.modify_pdb(drawable.append_filter, drawable_filter)
+
+
+def _apply_levels_in_linear_light(drawable, low_input, high_input):
+  """Applies levels to the drawable in linear light regardless of the image
+  precision.
+
+  The GEGL levels operation processes pixels in a linear format, hence the
+  image precision does not have to be converted. Only the drawable is modified
+  and pushed to the undo stack.
+  """
+  gi.require_version('Gegl', '0.4')
+  from gi.repository import Gegl
 
+  shadow_buffer = drawable.get_shadow_buffer()
 
-def _get_histogram_percentile(drawable, start_range, end_range):
-  if isinstance(drawable, Gimp.Channel):
-    normalized_percentile = drawable.histogram(
-      Gimp.HistogramChannel.VALUE, start_range / 255, end_range / 255).percentile
-    return normalized_percentile * 100.0
+  graph = Gegl.Node()
+
+  source_node = graph.create_child('gegl:buffer-source')
+  source_node.set_property('buffer', drawable.get_buffer())
+
+  levels_node = graph.create_child('gegl:levels')
+  levels_node.set_property('in-low', low_input)
+  levels_node.set_property('in-high', high_input)
+  levels_node.set_property('out-low', 0.0)
+  levels_node.set_property('out-high', 1.0)
+
+  sink_node = graph.create_child('gegl:write-buffer')
+  sink_node.set_property('buffer', shadow_buffer)
+
+  source_node.link(levels_node)
+  levels_node.link(sink_node)
+  sink_node.process()
+
+  shadow_buffer.flush()
+
+  procedure.modify_pdb(drawable.merge_shadow, True)
+  drawable.update(0, 0, drawable.get_width(), drawable.get_height())
+
+
+def get_max_point(precision):
+  """Returns the highest black or white point for the given image precision.
+
+  8-bit images are analyzed with 256 points. Images of higher precision are
+  analyzed with 65536 points, which is exact for 16-bit images and keeps the
+  histogram of 32-bit and floating-point images bounded in size.
+  """
+  if precision in [
+        Gimp.Precision.U8_LINEAR, Gimp.Precision.U8_NON_LINEAR, Gimp.Precision.U8_PERCEPTUAL]:
+    return 255
   else:
-    # Use the RGB pseudo-channel which combines the individual red, green and
-    # blue channels.
-    histogram_red = drawable.histogram(
-      Gimp.HistogramChannel.RED, start_range / 255, end_range / 255)
-    histogram_green = drawable.histogram(
-      Gimp.HistogramChannel.GREEN, start_range / 255, end_range / 255)
-    histogram_blue = drawable.histogram(
-      Gimp.HistogramChannel.BLUE, start_range / 255, end_range / 255)
+    return 65535
+
+
+def is_floating_point_precision(precision):
+  """Returns ``True`` if the image precision stores pixels as floating-point
+  values, which may lie outside the [0, 1] range.
+  """
+  return precision in [
+    Gimp.Precision.HALF_LINEAR,
+    Gimp.Precision.HALF_NON_LINEAR,
+    Gimp.Precision.HALF_PERCEPTUAL,
+    Gimp.Precision.FLOAT_LINEAR,
+    Gimp.Precision.FLOAT_NON_LINEAR,
+    Gimp.Precision.FLOAT_PERCEPTUAL,
+    Gimp.Precision.DOUBLE_LINEAR,
+    Gimp.Precision.DOUBLE_NON_LINEAR,
+    Gimp.Precision.DOUBLE_PERCEPTUAL,
+  ]
+
+
+def get_color_clip(
+      drawable, clip_percent_black, clip_percent_white, max_point=255, histogram=None):
+  """Determines the black and white points of the drawable based on the
+  specified clip percentages.
+
+  The points are in the range [0, ``max_point``].
+
+  If ``histogram`` is ``None``, the histogram of the drawable is obtained via
+  `histograms.get_histogram`. Otherwise, the specified histogram is used.
+
+  This is a wrapper for `color_clip.get_color_clip` obtaining the histogram
+  of the drawable.
+  """
+  import histograms
+
+  if histogram is None:
+    histogram = histograms.get_histogram(drawable, 0, max_point)
+
+  return color_clip.get_color_clip(histogram, clip_percent_black, clip_percent_white)
+
 
-    return (
-      (histogram_red.count + histogram_green.count + histogram_blue.count)
-      / (histogram_red.pixels + histogram_green.pixels + histogram_blue.pixels)
-    ) * 100.0
+_linear_and_other_precisions = {
+  Gimp.Precision.U8_NON_LINEAR: Gimp.Precision.U8_LINEAR,
+  Gimp.Precision.U8_PERCEPTUAL: Gimp.Precision.U8_LINEAR,
+  Gimp.Precision.U16_NON_LINEAR: Gimp.Precision.U16_LINEAR,
+  Gimp.Precision.U16_PERCEPTUAL: Gimp.Precision.U16_LINEAR,
+  Gimp.Precision.U32_NON_LINEAR: Gimp.Precision.U32_LINEAR,
+  Gimp.Precision.U32_PERCEPTUAL: Gimp.Precision.U32_LINEAR,
+  Gimp.Precision.HALF_NON_LINEAR: Gimp.Precision.HALF_LINEAR,
+  Gimp.Precision.HALF_PERCEPTUAL: Gimp.Precision.HALF_LINEAR,
+  Gimp.Precision.FLOAT_NON_LINEAR: Gimp.Precision.FLOAT_LINEAR,
+  Gimp.Precision.FLOAT_PERCEPTUAL: Gimp.Precision.FLOAT_LINEAR,
+  Gimp.Precision.DOUBLE_NON_LINEAR: Gimp.Precision.DOUBLE_LINEAR,
+  Gimp.Precision.DOUBLE_PERCEPTUAL: Gimp.Precision.DOUBLE_LINEAR,
+}
+
+
+_FILTER_NAME = 'Color Clip'
 
 
 _plugin_help = (
   "If the sum of the specified percentages is higher than 100, one or both "
   "of the percentages are automatically adjusted to prevent color inversion "
   "(e.g. 70% black clip and 40% white clip is treated as 60% black "
-  "and 40% white clip).")
+  "and 40% white clip).\n"
+  "If 'Process selected drawables only' is enabled, the image precision is "
+  "left intact and only the selected drawables are modified, which is faster "
+  "for images with many layers.\n"
+  "If 'Non-destructive' is enabled, color clip is added to layers as a filter "
+  "that can be edited or removed later. Running Color Clip again updates the "
+  "filter. Layer masks and channels are always modified directly.\n"
+  "If 'Sampling tolerance' is greater than 0, black and white points are "
+  "estimated from a subsample of pixels, which takes the same time regardless "
+  "of the image size. The estimated points are reported in a message.\n"
+  "'Analysis region' limits the pixels determining the black and white points "
+  "to the selection, its bounding box, a rectangle or the whole drawable. "
+  "Only pixels within the region are read, so a small reference region is "
+  "analyzed quickly even in large images. Regions other than the selection "
+  "require NumPy.\n"
+  "If 'Clip channels independently' is enabled, the red, green and blue "
+  "channels are stretched separately, which removes color casts. In this mode, "
+  "the drawables are always modified directly.\n"
+  "'Sequence mode' treats the selected drawables as frames of an animation. "
+  "'Aggregate' clips all frames by the same points determined from all frames "
+  "together, while 'Smooth' averages the points of neighboring frames to "
+  "prevent flicker. Each frame is analyzed only once in either mode.\n"
+  "The progress of the analysis is shown in the status bar. While the "
+  "drawables are analyzed, the run can be canceled from the dialog without "
+  "modifying the image. Without NumPy, if the image precision is converted, "
+  "the drawables are analyzed after the conversion and the precision is "
+  "converted back on cancel, which leaves an undo step in the undo history.\n"
+  "If 'Reuse histograms' is enabled, histograms are kept and reused until "
+  "the drawables change. Even a reused histogram requires reading all "
+  "analyzed pixels once to check for changes, which takes over half as long "
+  "as analyzing an 8-bit drawable, so this only speeds up repeated runs "
+  "served by 'extension-color-clip', mainly for high bit-depth drawables. "
+  "Partial histograms of a canceled run are kept only by its own plug-in "
+  "process, hence a subsequent run starts the analysis over.\n"
+  "By default, each run starts a new plug-in process. Batch scripts making "
+  "many calls can run 'extension-color-clip' once at the beginning, after "
+  "which calls made via the PDB are served by a single long-running process "
+  "for the rest of the GIMP session.\n"
+  "Each run returns timings of individual stages, the numbers of PDB calls "
+  "and pixel reads per drawable and the numbers of PDB queries answered from "
+  "memoized results of the same run as JSON. If 'Log file' is specified, the "
+  "statistics are also appended to the file, one line per run.")
+
+
+_analysis_region_choice = Gimp.Choice.new()
+_analysis_region_choice.add(
+  'selection', 0, 'Selection', 'Selected pixels, weighted by the selection')
+_analysis_region_choice.add(
+  'selection-bounds', 1, 'Selection bounds', 'All pixels within the selection bounding box')
+_analysis_region_choice.add(
+  'rectangle', 2, 'Rectangle', 'All pixels within the rectangle given by the region arguments')
+_analysis_region_choice.add(
+  'drawable', 3, 'Whole drawable', 'All pixels of the drawable regardless of the selection')
+
+
+_points_mode_choice = Gimp.Choice.new()
+_points_mode_choice.add(
+  'analyze', 0, 'Analyze', 'Return black and white points without modifying the drawables')
+_points_mode_choice.add(
+  'apply', 1, 'Apply given points', 'Apply the given black and white points without analysis')
+
+
+_sequence_mode_choice = Gimp.Choice.new()
+_sequence_mode_choice.add(
+  'none', 0, 'None', 'Determine points of each drawable independently')
+_sequence_mode_choice.add(
+  'aggregate', 1, 'Aggregate',
+  'Determine the same points for all drawables from their merged histogram')
+_sequence_mode_choice.add(
+  'smooth', 2, 'Smooth', 'Average points of each drawable with the neighboring drawables')
+
+
+_clip_arguments = [
+  [
+    'double',
+    'clip-percent-black',
+    'Black clip percentage',
+    'Black clip percentage',
+    0.0,
+    100.0,
+    0.0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'double',
+    'clip-percent-white',
+    'White clip percentage',
+    'White clip percentage',
+    0.0,
+    100.0,
+    0.0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'boolean',
+    'process-drawables-only',
+    'Process selected drawables only',
+    ('Analyze and adjust the selected drawables in linear light without converting'
+     ' the precision of the whole image'),
+    False,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'boolean',
+    'non-destructive',
+    'Non-destructive',
+    'Add color clip to layers as a non-destructive filter instead of modifying their pixels',
+    False,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'double',
+    'sampling-tolerance',
+    'Sampling tolerance (percentile)',
+    ('Estimate black and white points from a subsample of pixels with the given error'
+     ' in percentiles (0 = analyze all pixels)'),
+    0.0,
+    10.0,
+    0.0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'boolean',
+    'per-channel',
+    'Clip channels independently',
+    ('Determine black and white points separately for the red, green and blue channels,'
+     ' which also corrects color casts'),
+    False,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'choice',
+    'analysis-region',
+    'Analysis region',
+    ('Region of the drawables determining the black and white points (regions other than'
+     ' the selection require NumPy)'),
+    _analysis_region_choice,
+    'selection',
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'int',
+    'region-x',
+    'Region X',
+    'X coordinate of the rectangle to analyze in image coordinates',
+    -GLib.MAXINT,
+    GLib.MAXINT,
+    0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'int',
+    'region-y',
+    'Region Y',
+    'Y coordinate of the rectangle to analyze in image coordinates',
+    -GLib.MAXINT,
+    GLib.MAXINT,
+    0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'int',
+    'region-width',
+    'Region width',
+    'Width of the rectangle to analyze (0 = up to the right image edge)',
+    0,
+    GLib.MAXINT,
+    0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'int',
+    'region-height',
+    'Region height',
+    'Height of the rectangle to analyze (0 = up to the bottom image edge)',
+    0,
+    GLib.MAXINT,
+    0,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'choice',
+    'sequence-mode',
+    'Sequence mode',
+    'How to determine points if the drawables are frames of an image sequence (e.g. an animation)',
+    _sequence_mode_choice,
+    'none',
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'int',
+    'smoothing-window',
+    'Smoothing window',
+    'Number of consecutive drawables whose points are averaged in the "smooth" sequence mode',
+    1,
+    1000,
+    5,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'int',
+    'memory-budget',
+    'Memory budget (MiB)',
+    'Maximum amount of pixel data in MiB analyzed at once',
+    1,
+    65536,
+    # Equals `histograms.DEFAULT_MEMORY_BUDGET`, which is not imported here.
+    64,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'boolean',
+    'use-histogram-cache',
+    'Reuse histograms',
+    ('Keep histograms of analyzed drawables and reuse them while the drawables remain'
+     ' unchanged (requires NumPy; pays off for repeated runs served by'
+     ' extension-color-clip)'),
+    False,
+    GObject.ParamFlags.READWRITE,
+  ],
+  [
+    'string',
+    'log-file',
+    'Log file',
+    ('File to append performance statistics of each run to as a line of JSON'
+     ' (empty = no logging)'),
+    '',
+    GObject.ParamFlags.READWRITE,
+  ],
+]
 
 
 procedure.register_procedure(
   python_fu_color_clip,
   procedure_type=Gimp.ImageProcedure,
-  arguments=[
-    [
-      'double',
-      'clip-percent-black',
-      'Black clip percentage',
-      'Black clip percentage',
-      0.0,
-      100.0,
-      0.0,
-      GObject.ParamFlags.READWRITE,
-    ],
+  arguments=_clip_arguments,
+  return_values=[
     [
-      'double',
-      'clip-percent-white',
-      'White clip percentage',
-      'White clip percentage',
-      0.0,
-      100.0,
-      0.0,
+      'string',
+      'stats',
+      'Statistics',
+      'Performance statistics of the run as JSON',
+      '',
       GObject.ParamFlags.READWRITE,
     ],
   ],
@@ -240,6 +1367,182 @@ procedure.register_procedure(
   sensitivity_mask=(
     Gimp.ProcedureSensitivityMask.DRAWABLE
     | Gimp.ProcedureSensitivityMask.DRAWABLES),
+  persistent=True,
+  memoize_pdb_calls=True,
+)
+
+
+procedure.register_procedure(
+  python_fu_color_clip_batch,
+  procedure_type=Gimp.Procedure,
+  arguments=[
+    [
+      'enum',
+      'run-mode',
+      'Run mode',
+      'The run mode',
+      Gimp.RunMode,
+      Gimp.RunMode.NONINTERACTIVE,
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'string_array',
+      'input-files',
+      'Input files',
+      'Paths or glob patterns (e.g. "photos/**/*.jpg") of files to process',
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'string',
+      'output-directory',
+      'Output directory',
+      ('Directory to export processed files to, keeping their file formats and paths'
+       ' relative to the directories of the patterns'),
+      '',
+      GObject.ParamFlags.READWRITE,
+    ],
+    *_clip_arguments,
+    [
+      'int',
+      'num-workers',
+      'Number of workers',
+      'Number of files processed concurrently (0 = number of CPU cores)',
+      0,
+      1024,
+      0,
+      GObject.ParamFlags.READWRITE,
+    ],
+  ],
+  return_values=[
+    [
+      'int',
+      'num-processed-files',
+      'Number of processed files',
+      'Number of processed files',
+      0,
+      GLib.MAXINT,
+      0,
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'double',
+      'files-per-second',
+      'Files per second',
+      'Throughput in processed files per second',
+      0.0,
+      GLib.MAXDOUBLE,
+      0.0,
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'string',
+      'stats',
+      'Statistics',
+      'Performance statistics of the whole batch and of each file as JSON',
+      '',
+      GObject.ParamFlags.READWRITE,
+    ],
+  ],
+  documentation=(
+    'Applies Color Clip to multiple files and exports them to a directory.',
+    ('Each file is loaded, Color Clip is applied to its selected drawables (usually'
+     ' the top layer) and the result is exported under the same name to the output'
+     ' directory. Files are processed concurrently by a pool of workers and the'
+     f' throughput is reported at the end.\n{_plugin_help}'),
+  ),
+  attribution=('Kamil Burda', 'Kamil Burda', '2015'),
+  persistent=True,
+)
+
+
+procedure.register_procedure(
+  python_fu_color_clip_points,
+  procedure_type=Gimp.ImageProcedure,
+  arguments=[
+    [
+      'choice',
+      'mode',
+      'Mode',
+      'Whether to analyze the drawables or to apply the given points',
+      _points_mode_choice,
+      'analyze',
+      GObject.ParamFlags.READWRITE,
+    ],
+    *_clip_arguments,
+    [
+      'double_array',
+      'black-points',
+      'Black points',
+      ('Black points to apply in the "apply" mode - one for all drawables, or one for each'
+       ' drawable (each channel if clipping channels independently). Points are pixel'
+       ' values in linear light within [0, 1], or beyond for floating-point images'),
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'double_array',
+      'white-points',
+      'White points',
+      'White points to apply in the "apply" mode, in the same format as the black points',
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'int',
+      'histogram-size',
+      'Histogram size',
+      ('Number of values of the returned cumulative histogram of each analyzed channel'
+       ' (0 = none; without NumPy, each value takes a PDB query, at most 1024 per channel)'),
+      0,
+      65536,
+      0,
+      GObject.ParamFlags.READWRITE,
+    ],
+  ],
+  return_values=[
+    [
+      'double_array',
+      'black-points',
+      'Black points',
+      ('Black points of the drawables (each channel if clipping channels independently)'
+       ' as pixel values in linear light, where 0.0 is black and 1.0 is white'),
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'double_array',
+      'white-points',
+      'White points',
+      'White points of the drawables, in the same format as the black points',
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'double_array',
+      'cumulative-histogram',
+      'Cumulative histogram',
+      ('Concatenated cumulative histograms of the analyzed drawables (channels), each being'
+       ' the fractions of pixels with values at most 0.0, ..., 1.0'),
+      GObject.ParamFlags.READWRITE,
+    ],
+    [
+      'string',
+      'stats',
+      'Statistics',
+      'Performance statistics of the run as JSON',
+      '',
+      GObject.ParamFlags.READWRITE,
+    ],
+  ],
+  image_types="RGB*, GRAY*",
+  documentation=(
+    'Returns black and white points of drawables for Color Clip or applies given points.',
+    ('In the "analyze" mode, the drawables are analyzed as in Color Clip, but not'
+     ' modified. The black and white points are returned along with cumulative'
+     ' histograms if "Histogram size" is greater than 0. In the "apply" mode, the'
+     ' given points are applied without analyzing the drawables, e.g. to apply points'
+     ' obtained from a proxy image to the full-resolution original.'
+     f'\n{_plugin_help}'),
+  ),
+  attribution=('Kamil Burda', 'Kamil Burda', '2015'),
+  persistent=True,
+  memoize_pdb_calls=True,
 )
 
 
@@ -0,0 +1,145 @@
+"""Determining black and white points from a histogram.
+
+This module does not depend on GIMP and can be used (and tested) without it.
+"""
+
+
+def get_color_clip(histogram, clip_percent_black, clip_percent_white):
+  """Determines the black and white points based on the specified clip
+  percentages.
+
+  ``histogram`` is a cumulative histogram providing the ``min_point`` and
+  ``max_point`` attributes and the ``get_percentile(start_point, end_point)``
+  method, such as `histograms.CumulativeHistogram`. The points are in the range
+  [``min_point``, ``max_point``].
+
+  This is a wrapper for `_get_color_clip` to correct clip percentages and black
+  and white points to prevent color inversion.
+  """
+  clip_percent_black = max(min(clip_percent_black, 100.0), 0.0)
+  clip_percent_white = max(min(clip_percent_white, 100.0), 0.0)
+  
+  # Adjust percentages to prevent color inversion.
+  if clip_percent_black + clip_percent_white > 100.0:
+    if clip_percent_black > clip_percent_white:
+      clip_percent_black = 100.0 - clip_percent_white
+    elif clip_percent_white > clip_percent_black:
+      clip_percent_white = 100.0 - clip_percent_black
+    else:
+      clip_percent_black = 50.0
+      clip_percent_white = 50.0
+  
+  black_point, white_point = _get_color_clip(histogram, clip_percent_black, clip_percent_white)
+  
+  # Adjust black point to prevent color inversion.
+  if black_point > white_point:
+    black_point = white_point
+  
+  return black_point, white_point
+
+
+def _get_color_clip(histogram, clip_percent_black, clip_percent_white):
+  """
+  Determine the black and white points based on the specified clip percentages.
+
+  The histogram is shared by the black and white point searches, so that the
+  drawable is analyzed at most once.
+  """
+
+  min_point = histogram.min_point
+  max_point = histogram.max_point
+  
+  black_point = _get_black_point(histogram, clip_percent_black, min_point, max_point)
+  white_point = _get_white_point(histogram, clip_percent_white, min_point, max_point)
+  
+  return black_point, white_point
+
+
+def _get_black_point(histogram, clip_percent_black, min_point, max_point):
+  return _get_color_point(
+    histogram,
+    clip_percent_black,
+    min_point,
+    max_point,
+    initial_color_point=max_point,
+    point_sequence=range(min_point, max_point + 1),
+    get_percentile_from_histogram_func=get_black_point_histogram_percentile,
+    get_next_point_func=lambda point: point - 1,
+  )
+
+
+def _get_white_point(histogram, clip_percent_white, min_point, max_point):
+  return _get_color_point(
+    histogram,
+    clip_percent_white,
+    min_point,
+    max_point,
+    initial_color_point=min_point,
+    point_sequence=range(max_point, min_point - 1, -1),
+    get_percentile_from_histogram_func=get_white_point_histogram_percentile,
+    get_next_point_func=lambda point: point + 1,
+  )
+
+
+def _get_color_point(
+      histogram,
+      clip_percent,
+      min_point,
+      max_point,
+      initial_color_point,
+      point_sequence,
+      get_percentile_from_histogram_func,
+      get_next_point_func,
+):
+  """Returns the color point preceding the first point in ``point_sequence``
+  whose histogram percentile falls below ``100 - clip_percent``.
+
+  Since the histogram percentile is monotonic along ``point_sequence``, the
+  first such point is found by bisection, requiring only a logarithmic number
+  of histogram queries.
+  """
+  desired_percentile = 100.0 - clip_percent
+
+  lower_index = 0
+  upper_index = len(point_sequence)
+
+  while lower_index < upper_index:
+    middle_index = (lower_index + upper_index) // 2
+    current_percentile = get_percentile_from_histogram_func(
+      histogram, point_sequence[middle_index], min_point, max_point)
+
+    if current_percentile < desired_percentile:
+      upper_index = middle_index
+    else:
+      lower_index = middle_index + 1
+
+  if lower_index < len(point_sequence):
+    return get_next_point_func(point_sequence[lower_index])
+  else:
+    return initial_color_point
+
+
+def get_black_point_histogram_percentile(histogram, point, _min_point, max_point):
+  return histogram.get_percentile(point, max_point)
+
+
+def get_white_point_histogram_percentile(histogram, point, min_point, _max_point):
+  return histogram.get_percentile(min_point, point)
+
+
+def srgb_to_linear(value):
+  """Converts a value encoded with the sRGB transfer curve to linear light."""
+  if value <= 0.04045:
+    return value / 12.92
+  else:
+    return ((value + 0.055) / 1.055) ** 2.4
+
+
+def linear_to_srgb(value):
+  """Converts a value in linear light to a value encoded with the sRGB
+  transfer curve.
+  """
+  if value <= 0.0031308:
+    return value * 12.92
+  else:
+    return 1.055 * value ** (1 / 2.4) - 0.055
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+"""Setup shared by tests running the plug-in with the in-memory GIMP stand-in
+from the ``benchmarks`` folder.
+
+The stand-in requires NumPy. Without NumPy, importing this module raises
+`unittest.SkipTest`, which skips the importing test module.
+"""
+
+import importlib.util
+import os
+import sys
+import unittest
+
+if importlib.util.find_spec('numpy') is None:
+  raise unittest.SkipTest('NumPy is required by the fake GIMP backend')
+
+sys.path.insert(
+  0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import fake_gimp
+import run_benchmarks
+
+plugin = run_benchmarks.load_plugin()
+"""The plug-in script imported as a module with the fake backend installed."""
+
+__all__ = ['fake_gimp', 'plugin', 'run_benchmarks']
@@ -0,0 +1,1681 @@
+"""Histograms of drawables used to determine black and white points."""
+
+import collections
+import concurrent.futures
+import hashlib
+import math
+import os
+import threading
+
+import gi
+gi.require_version('Gegl', '0.4')
+from gi.repository import Gegl
+gi.require_version('Gimp', '3.0')
+from gi.repository import Gimp
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+import procedure
+import sketches
+import stats
+
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+"""Default maximum size in bytes of pixel data analyzed at once."""
+
+gimp_lock = threading.RLock()
+"""Lock serializing calls to GIMP made from multiple threads.
+
+Communication with GIMP goes through a single connection which must not be
+used by multiple threads at the same time. Histograms acquire this lock for
+each call to GIMP and release it while processing the obtained pixels.
+"""
+
+
+HISTOGRAM_CACHE_SIZE = 16
+"""Maximum number of histograms kept by `get_histogram` for reuse."""
+
+
+def get_num_workers(num_tasks=None):
+  """Returns the number of threads to use for analyzing ``num_tasks``
+  independent tasks (e.g. drawables), or the number of usable CPU cores if
+  ``num_tasks`` is ``None``.
+
+  Without NumPy, all the work is done by GIMP via the PDB, which cannot be
+  parallelized, hence a single worker is used.
+  """
+  if np is None:
+    return 1
+
+  num_workers = os.cpu_count() or 1
+  if num_tasks is not None:
+    num_workers = min(num_workers, num_tasks)
+
+  return max(num_workers, 1)
+
+
+def get_histogram(
+      drawable,
+      min_point=0,
+      max_point=255,
+      memory_budget=DEFAULT_MEMORY_BUDGET,
+      num_threads=1,
+      use_cache=False,
+      sampling_tolerance=0.0,
+      use_sketch=False,
+      region=None,
+      drawable_stats=None,
+      task_progress=None,
+):
+  """Returns a cumulative histogram of the drawable for points in the range
+  [``min_point``, ``max_point``].
+
+  If NumPy is available, the histogram is computed from the drawable pixels
+  in a single pass via `PixelHistogram`. Otherwise, the histogram is queried
+  from the GIMP PDB via `PdbHistogram`.
+
+  ``memory_budget`` is the maximum size in bytes of pixel data analyzed at once
+  by `PixelHistogram`. ``num_threads`` is the number of threads computing the
+  `PixelHistogram` counts from horizontal bands of the drawable.
+
+  Pixels are always analyzed in linear light by `PixelHistogram`, while
+  `PdbHistogram` uses the precision of the image the drawable belongs to.
+
+  If ``use_cache`` is ``True``, the most recently computed `PixelHistogram`
+  objects are reused if the drawable, its pixels and the selection have not
+  changed since. See `get_histogram_cache_key` for details. Verifying that the
+  drawable has not changed requires reading all analyzed pixels, even on a
+  hit, which costs over half as much as computing a histogram of an 8-bit
+  drawable. On a miss, this cost adds to computing the histogram. The cache
+  therefore only pays off if the same drawables are analyzed repeatedly, e.g.
+  by a persistent plug-in process, and if the histograms are expensive to
+  compute, e.g. for floating-point drawables. `PdbHistogram` objects are not
+  cached as they only require a few PDB queries.
+
+  If ``sampling_tolerance`` is greater than 0 and NumPy is available, the
+  histogram is estimated from a subsample of pixels whose size depends only on
+  the tolerance, not on the drawable size. See `get_sample_size` for details.
+  Estimated histograms are not cached.
+
+  If ``use_sketch`` is ``True`` and NumPy is available, pixels are analyzed as
+  floating-point values via `SketchHistogram`, preserving values outside the
+  [0, 1] range in high bit-depth and HDR images. Values within the range are
+  counted for points in [``min_point``, ``max_point``] as usual and only the
+  values outside the range are kept in a quantile sketch.
+
+  ``region`` is an (x, y, width, height) rectangle in image coordinates
+  limiting the analysis to the part of the drawable inside the rectangle. Only
+  the pixels within the rectangle are read and they are not weighted by the
+  selection. If ``region`` is ``None``, the drawable pixels within the
+  selection bounds are analyzed, weighted by the selection. ``region`` requires
+  NumPy as `PdbHistogram` always analyzes the selected pixels. Without NumPy,
+  `ValueError` is raised if ``region`` is not ``None``.
+
+  If ``drawable_stats`` is a `stats.DrawableStats` object, the number of PDB
+  calls, pixel reads and cache hits is recorded in it.
+
+  If ``task_progress`` is a `progress.TaskProgress` object, the progress of
+  the analysis is reported to it and `progress.Canceled` is raised between
+  units of work (chunks of pixels or PDB queries) once the run is canceled.
+  If ``use_cache`` is ``True``, counts of the chunks processed so far are kept
+  (see `_process_chunks`), so that analyzing the same pixels again only
+  processes the remaining chunks.
+  """
+  return _get_histograms(
+    drawable,
+    min_point,
+    max_point,
+    memory_budget,
+    num_threads,
+    use_cache,
+    sampling_tolerance,
+    use_sketch,
+    region,
+    drawable_stats,
+    task_progress,
+    per_channel=False,
+  )[0]
+
+
+def get_channel_histograms(
+      drawable,
+      min_point=0,
+      max_point=255,
+      memory_budget=DEFAULT_MEMORY_BUDGET,
+      num_threads=1,
+      use_cache=False,
+      sampling_tolerance=0.0,
+      use_sketch=False,
+      region=None,
+      drawable_stats=None,
+      task_progress=None,
+):
+  """Returns a list of cumulative histograms, one for each color channel of
+  the drawable - red, green and blue for layers and layer groups, value for
+  channels and layer masks.
+
+  If NumPy is available, all histograms are computed from a single read of the
+  drawable pixels. Otherwise, each histogram is queried from the GIMP PDB
+  separately.
+
+  The parameters have the same meaning as in `get_histogram`.
+  """
+  return _get_histograms(
+    drawable,
+    min_point,
+    max_point,
+    memory_budget,
+    num_threads,
+    use_cache,
+    sampling_tolerance,
+    use_sketch,
+    region,
+    drawable_stats,
+    task_progress,
+    per_channel=True,
+  )
+
+
+def _get_histograms(
+      drawable,
+      min_point,
+      max_point,
+      memory_budget,
+      num_threads,
+      use_cache,
+      sampling_tolerance,
+      use_sketch,
+      region,
+      drawable_stats,
+      task_progress,
+      per_channel,
+):
+  if np is None and region is not None:
+    # `PdbHistogram` can only analyze the selected pixels.
+    raise ValueError('Analysis regions other than the selection require NumPy')
+
+  cache_key = None
+  num_bins = max_point - min_point + 1
+
+  if np is not None and sampling_tolerance > 0:
+    channel_counts = _get_sampled_pixel_counts(
+      drawable,
+      num_bins,
+      get_sample_size(sampling_tolerance),
+      memory_budget,
+      num_threads,
+      region=region,
+      drawable_stats=drawable_stats,
+      task_progress=task_progress)
+    if not per_channel:
+      channel_counts = [channel_counts.sum(axis=0)]
+
+    return [PixelHistogram(counts, min_point) for counts in channel_counts]
+
+  tile_summary = None
+  new_tile_summary = None
+
+  if use_cache and np is not None:
+    cache_key, tile_summary = _get_cache_key_and_tile_summary(
+      drawable,
+      min_point,
+      max_point,
+      memory_budget,
+      use_sketch,
+      region,
+      per_channel,
+      drawable_stats,
+      task_progress)
+    histograms = _histogram_cache.get(cache_key)
+    if histograms is not None:
+      stats.count(drawable_stats, 'histogram_cache_hits')
+      return histograms
+  elif np is not None:
+    # Without the cache, tiles are classified from the pixels read by the
+    # analysis itself, which requires no extra reads.
+    new_tile_summary = _create_tile_summary(drawable, region)
+
+  if np is not None and use_sketch:
+    channel_counts, channel_sketches = _get_pixel_sketches(
+      drawable,
+      num_bins,
+      memory_budget,
+      num_threads,
+      region=region,
+      drawable_stats=drawable_stats,
+      tile_summary=tile_summary,
+      new_tile_summary=new_tile_summary,
+      task_progress=task_progress,
+      partial_key=cache_key)
+    if not per_channel:
+      for channel_sketch in channel_sketches[1:]:
+        channel_sketches[0].merge(channel_sketch)
+      channel_counts = [channel_counts.sum(axis=0)]
+      channel_sketches = channel_sketches[:1]
+
+    histograms = [
+      SketchHistogram(counts, sketch, min_point)
+      for counts, sketch in zip(channel_counts, channel_sketches)]
+  elif np is not None:
+    channel_counts = _get_pixel_counts(
+      drawable,
+      num_bins,
+      memory_budget,
+      num_threads,
+      region=region,
+      drawable_stats=drawable_stats,
+      tile_summary=tile_summary,
+      new_tile_summary=new_tile_summary,
+      task_progress=task_progress,
+      partial_key=cache_key)
+    if not per_channel:
+      channel_counts = [channel_counts.sum(axis=0)]
+
+    histograms = [PixelHistogram(counts, min_point) for counts in channel_counts]
+  elif per_channel:
+    histograms = [
+      PdbHistogram(
+        drawable,
+        min_point,
+        max_point,
+        histogram_channels=[histogram_channel],
+        drawable_stats=drawable_stats,
+        task_progress=task_progress)
+      for histogram_channel in _get_histogram_channels(drawable)]
+  else:
+    histograms = [
+      PdbHistogram(
+        drawable,
+        min_point,
+        max_point,
+        drawable_stats=drawable_stats,
+        task_progress=task_progress)]
+
+  if new_tile_summary is not None:
+    tile_summary = new_tile_summary
+    stats.count(drawable_stats, 'empty_tiles', len(tile_summary.empty_tiles))
+    stats.count(drawable_stats, 'uniform_tiles', len(tile_summary.uniform_pixels))
+
+  for histogram in histograms:
+    histogram.tile_summary = tile_summary
+
+  if cache_key is not None:
+    _histogram_cache.put(cache_key, histograms)
+
+  return histograms
+
+
+def get_histogram_cache_key(
+      drawable,
+      min_point,
+      max_point,
+      memory_budget=DEFAULT_MEMORY_BUDGET,
+      use_sketch=False,
+      region=None,
+      per_channel=False,
+      drawable_stats=None,
+):
+  """Returns a key identifying the histogram of the drawable in its current
+  state.
+
+  The key consists of the drawable ID, the point range, the histogram type
+  (see ``use_sketch`` in `get_histogram` and ``per_channel`` distinguishing
+  `get_channel_histograms`), the image precision,
+  the drawable geometry, the analyzed region and a digest of the drawable
+  pixels and of the selection within the analyzed region (see ``region`` in
+  `get_histogram`). Any edit of the analyzed pixels or of the selection
+  therefore results in a different key.
+
+  The digest is computed from the pixels in their native format, in chunks of
+  at most ``memory_budget`` bytes. This is considerably cheaper than computing
+  the histogram as no pixel format conversion nor binning is performed.
+  """
+  return _get_cache_key_and_tile_summary(
+    drawable,
+    min_point,
+    max_point,
+    memory_budget,
+    use_sketch,
+    region,
+    per_channel,
+    drawable_stats,
+  )[0]
+
+
+def _get_cache_key_and_tile_summary(
+      drawable,
+      min_point,
+      max_point,
+      memory_budget,
+      use_sketch,
+      region,
+      per_channel,
+      drawable_stats,
+      task_progress=None,
+):
+  # The `TileSummary` is obtained from the same pass over the pixels as the
+  # digest, so that the analysis can skip empty and uniform tiles at no extra
+  # cost.
+  with gimp_lock:
+    image = drawable.get_image()
+    _success, offset_x, offset_y = drawable.get_offsets()
+
+    metadata = (
+      drawable.get_id(),
+      min_point,
+      max_point,
+      use_sketch,
+      per_channel,
+      int(image.get_precision()),
+      drawable.get_width(),
+      drawable.get_height(),
+      offset_x,
+      offset_y,
+    )
+
+  analyzed_rect = _get_analyzed_rect(drawable, region)
+
+  digest, tile_summary = _scan_content(
+    drawable, analyzed_rect, region is None, memory_budget, drawable_stats, task_progress)
+
+  return metadata + (region, analyzed_rect, digest), tile_summary
+
+
+def get_sample_size(tolerance, confidence=0.95):
+  """Returns the number of pixels to sample so that percentiles estimated from
+  the sample deviate from the exact percentiles by at most ``tolerance``
+  percentage points with probability ``confidence``.
+
+  The sample size follows from the Dvoretzky-Kiefer-Wolfowitz inequality
+  bounding the deviation of the empirical distribution function from the
+  true one. For example, a tolerance of 0.1 percentage points requires about
+  1.8 million pixels at 95% confidence.
+  """
+  epsilon = tolerance / 100.0
+
+  return math.ceil(math.log(2 / (1 - confidence)) / (2 * epsilon ** 2))
+
+
+def clear_histogram_cache():
+  """Removes all histograms kept for reuse by `get_histogram`, including
+  partial results of canceled runs.
+  """
+  _histogram_cache.clear()
+  _partial_results.clear()
+
+
+def _scan_content(
+      drawable, rect, use_selection, memory_budget, drawable_stats=None, task_progress=None):
+  """Returns a tuple of (digest, `TileSummary`) of the drawable pixels (and of
+  the selection if ``use_selection`` is ``True``) within ``rect``.
+
+  The `TileSummary` is ``None`` if ``rect`` is ``None``. Cancellation is
+  checked via ``task_progress`` before reading each chunk.
+  """
+  digest = hashlib.blake2b(digest_size=16)
+
+  if rect is None:
+    return digest.digest(), None
+
+  x, y, width, height = rect
+
+  with gimp_lock:
+    _success, offset_x, offset_y = drawable.get_offsets()
+    buffer = drawable.get_buffer()
+    bytes_per_pixel = drawable.get_bpp()
+    bytes_per_row = max(width * bytes_per_pixel, 1)
+    tile_width = buffer.get_property('tile-width')
+    tile_height = buffer.get_property('tile-height')
+
+    if isinstance(drawable, Gimp.Channel) or not drawable.has_alpha():
+      bytes_per_alpha = 0
+    else:
+      bytes_per_alpha = bytes_per_pixel // (2 if drawable.is_gray() else 4)
+
+    image = drawable.get_image()
+    if use_selection and not Gimp.Selection.is_empty(image):
+      selection_buffer = image.get_selection().get_buffer()
+    else:
+      selection_buffer = None
+
+  tile_summary = TileSummary(rect, tile_width, tile_height)
+
+  rows_per_chunk = max(memory_budget // bytes_per_row // tile_height, 1) * tile_height
+
+  chunk_y = y
+  while chunk_y < y + height:
+    _check_canceled(task_progress)
+
+    # Chunks are aligned to tile rows so that each tile lies in a single chunk.
+    next_chunk_y = min((chunk_y // tile_height) * tile_height + rows_per_chunk, y + height)
+    chunk_height = next_chunk_y - chunk_y
+
+    with gimp_lock:
+      pixel_data = buffer.get(
+        Gegl.Rectangle.new(x, chunk_y, width, chunk_height), 1.0, None, Gegl.AbyssPolicy.NONE)
+
+      if selection_buffer is not None:
+        selection_data = selection_buffer.get(
+          Gegl.Rectangle.new(x + offset_x, chunk_y + offset_y, width, chunk_height),
+          1.0,
+          'Y u8',
+          Gegl.AbyssPolicy.NONE)
+      else:
+        selection_data = b''
+
+    stats.count(drawable_stats, 'buffer_reads', 2 if selection_buffer is not None else 1)
+
+    digest.update(pixel_data)
+    digest.update(selection_data)
+
+    tile_summary.add_chunk(
+      (x, chunk_y, width, chunk_height),
+      np.frombuffer(pixel_data, dtype=np.uint8).reshape(chunk_height, width, bytes_per_pixel),
+      bytes_per_alpha,
+      np.frombuffer(selection_data, dtype=np.uint8).reshape(chunk_height, width)
+      if selection_buffer is not None else None,
+    )
+
+    chunk_y = next_chunk_y
+
+  stats.count(drawable_stats, 'empty_tiles', len(tile_summary.empty_tiles))
+  stats.count(drawable_stats, 'uniform_tiles', len(tile_summary.uniform_pixels))
+
+  return digest.digest(), tile_summary
+
+
+def _create_tile_summary(drawable, region):
+  """Returns an empty `TileSummary` of the analyzed part of the drawable (see
+  `_get_analyzed_rect`), or ``None`` if the part is empty.
+  """
+  analyzed_rect = _get_analyzed_rect(drawable, region)
+  if analyzed_rect is None:
+    return None
+
+  with gimp_lock:
+    buffer = drawable.get_buffer()
+    tile_width = buffer.get_property('tile-width')
+    tile_height = buffer.get_property('tile-height')
+
+  return TileSummary(analyzed_rect, tile_width, tile_height)
+
+
+class TileSummary:
+  """Classification of the buffer tiles of a drawable within a rectangle,
+  allowing to skip tiles whose pixels need not be read individually.
+
+  Tiles are identified by (column, row) tuples in the grid of buffer tiles.
+  Tiles at the edges of ``rect`` are only considered within ``rect``.
+
+  * ``empty_tiles`` is a set of tiles whose pixels all have zero weight, i.e.
+    they are fully transparent or not selected.
+  * ``uniform_pixels`` maps tiles whose pixels are all identical to a tuple of
+    (pixel in the native format of the drawable as bytes, selection value or
+    ``None`` if the selection is not considered).
+  * ``nonuniform_selection_tiles`` is a set of tiles from ``uniform_pixels``
+    whose pixels are weighted differently by the selection.
+
+  ``pixel_format`` is the babl format of the pixels the tiles were classified
+  from, or ``None`` for the native format of the drawable. Pixels identical in
+  a converted format (e.g. non-linear 8-bit pixels read as linear 8-bit) may
+  differ in the native format.
+  """
+
+  def __init__(self, rect, tile_width, tile_height, pixel_format=None):
+    self.rect = rect
+    self.tile_width = tile_width
+    self.tile_height = tile_height
+    self.pixel_format = pixel_format
+
+    self.empty_tiles = set()
+    self.uniform_pixels = {}
+    self.nonuniform_selection_tiles = set()
+
+  def add_chunk(self, chunk_rect, pixels, bytes_per_alpha, selection):
+    """Classifies tiles within a chunk spanning whole tile rows.
+
+    ``pixels`` is a NumPy array of bytes of shape (height, width, bytes per
+    pixel). The last ``bytes_per_alpha`` bytes of each pixel hold the alpha
+    channel. ``selection`` is ``None`` or a 2D array of selection values.
+
+    The chunk may also span only some tile columns, as long as its edges lie
+    on tile boundaries or on the edges of ``rect``.
+    """
+    chunk_x, chunk_y, chunk_width, chunk_height = chunk_rect
+
+    # Tiles are classified from the minimum and maximum of each byte within
+    # each tile, computed for all tiles at once rather than tile by tile.
+    row_starts = _get_tile_starts(chunk_y, chunk_height, self.tile_height)
+    column_starts = _get_tile_starts(chunk_x, chunk_width, self.tile_width)
+    first_column = chunk_x // self.tile_width
+    first_row = chunk_y // self.tile_height
+
+    min_pixels = _reduce_tiles(np.minimum, pixels, row_starts, column_starts)
+    max_pixels = _reduce_tiles(np.maximum, pixels, row_starts, column_starts)
+
+    is_empty = np.zeros(min_pixels.shape[:2], dtype=bool)
+    if bytes_per_alpha:
+      is_empty |= ~max_pixels[..., -bytes_per_alpha:].any(axis=2)
+
+    if selection is not None:
+      min_selection = _reduce_tiles(np.minimum, selection, row_starts, column_starts)
+      max_selection = _reduce_tiles(np.maximum, selection, row_starts, column_starts)
+      is_empty |= max_selection == 0
+
+    for row_index, column_index in zip(*np.nonzero(is_empty)):
+      self.empty_tiles.add((first_column + int(column_index), first_row + int(row_index)))
+
+    for row_index, column_index in zip(*np.nonzero((min_pixels == max_pixels).all(axis=2))):
+      tile = (first_column + int(column_index), first_row + int(row_index))
+
+      if selection is not None:
+        selection_value = int(selection[row_starts[row_index], column_starts[column_index]])
+        if min_selection[row_index, column_index] != max_selection[row_index, column_index]:
+          self.nonuniform_selection_tiles.add(tile)
+      else:
+        selection_value = None
+
+      self.uniform_pixels[tile] = (max_pixels[row_index, column_index].tobytes(), selection_value)
+
+  def is_uniformly_weighted(self, tile):
+    """Returns ``True`` if all pixels of the tile have the same value and
+    weight.
+    """
+    return tile in self.uniform_pixels and tile not in self.nonuniform_selection_tiles
+
+  def get_tiles(self, rect):
+    """Yields (tile, tile rectangle) tuples for tiles intersecting ``rect``,
+    with the tile rectangles limited to ``rect``.
+    """
+    x, y, width, height = rect
+
+    for row in range(y // self.tile_height, (y + height - 1) // self.tile_height + 1):
+      tile_y = max(y, row * self.tile_height)
+      tile_height = min(y + height, (row + 1) * self.tile_height) - tile_y
+
+      for column in range(x // self.tile_width, (x + width - 1) // self.tile_width + 1):
+        tile_x = max(x, column * self.tile_width)
+        tile_width = min(x + width, (column + 1) * self.tile_width) - tile_x
+
+        yield (column, row), (tile_x, tile_y, tile_width, tile_height)
+
+  def split_rect(self, rect, is_skipped):
+    """Returns a tuple of (rectangles, skipped tiles) splitting ``rect``.
+
+    Skipped tiles are given by the ``is_skipped`` function accepting a tile and
+    are returned as a list of (tile, tile rectangle) tuples. The rectangles
+    cover the remaining tiles, merging neighboring tiles into as few
+    rectangles as possible. If no tile is skipped, ``[rect]`` is returned.
+    """
+    skipped_tiles = []
+    # Runs of neighboring non-skipped tiles as [x, width] lists for each tile
+    # row.
+    row_runs = {}
+
+    for tile, tile_rect in self.get_tiles(rect):
+      tile_x, tile_y, tile_width, tile_height = tile_rect
+      _tile_y, _tile_height, runs = row_runs.setdefault(tile[1], (tile_y, tile_height, []))
+
+      if is_skipped(tile):
+        skipped_tiles.append((tile, tile_rect))
+      elif runs and runs[-1][0] + runs[-1][1] == tile_x:
+        runs[-1][1] += tile_width
+      else:
+        runs.append([tile_x, tile_width])
+
+    if not skipped_tiles:
+      return [rect], []
+
+    rects = []
+    previous_runs = None
+
+    for tile_y, tile_height, runs in row_runs.values():
+      if runs and runs == previous_runs:
+        # Rectangles are extended to the following tile row if it has the same
+        # runs, so that uninterrupted columns of tiles are read at once.
+        rects[-len(runs):] = [
+          (run_x, run_y, run_width, run_height + tile_height)
+          for run_x, run_y, run_width, run_height in rects[-len(runs):]]
+      else:
+        rects.extend((run_x, tile_y, run_width, tile_height) for run_x, run_width in runs)
+
+      previous_runs = runs
+
+    return rects, skipped_tiles
+
+
+def _get_tile_starts(start, length, tile_length):
+  first_boundary = (start // tile_length + 1) * tile_length
+  return np.concatenate([[0], np.arange(first_boundary, start + length, tile_length) - start])
+
+
+def _reduce_tiles(func, array, row_starts, column_starts):
+  row_ends = np.append(row_starts[1:], len(array))
+
+  return np.stack([
+    func.reduceat(func.reduce(array[row_start:row_end], axis=0), column_starts, axis=0)
+    for row_start, row_end in zip(row_starts, row_ends)])
+
+
+class _LruCache:
+  """Thread-safe mapping keeping at most ``max_size`` most recently used
+  items.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      if key not in self._items:
+        return None
+
+      self._items.move_to_end(key)
+      return self._items[key]
+
+  def put(self, key, value):
+    with self._lock:
+      self._items[key] = value
+      self._items.move_to_end(key)
+
+      while len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+  def pop(self, key):
+    with self._lock:
+      return self._items.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+
+_histogram_cache = _LruCache(HISTOGRAM_CACHE_SIZE)
+
+_partial_results = _LruCache(HISTOGRAM_CACHE_SIZE)
+"""Results of chunks processed by canceled runs, see `_process_chunks`."""
+
+
+class CumulativeHistogram:
+  """Cumulative pixel counts for points in the range
+  [``min_point``, ``max_point``].
+
+  For layers and layer groups, the RGB pseudo-channel combining the red, green
+  and blue channels is used. For channels and layer masks, the value channel is
+  used.
+
+  Subclasses must implement `get_cumulative_count` and `total_count`.
+
+  ``tile_summary`` is the `TileSummary` of the analyzed pixels if it was
+  obtained during the analysis, e.g. to be reused when applying levels.
+  """
+
+  tile_summary = None
+
+  def __init__(self, min_point, max_point):
+    self.min_point = min_point
+    self.max_point = max_point
+
+  @property
+  def total_count(self):
+    """Total (alpha- and selection-weighted) number of pixels."""
+    raise NotImplementedError
+
+  def get_percentile(self, start_point, end_point):
+    """Returns the percentage of pixels whose values lie within
+    [``start_point``, ``end_point``].
+    """
+    count = self.get_cumulative_count(end_point) - self.get_cumulative_count(start_point - 1)
+    total_count = self.total_count
+
+    if total_count > 0:
+      return (count / total_count) * 100.0
+    else:
+      return 0.0
+
+  def get_cumulative_count(self, point):
+    """Returns the number of pixels whose values lie within
+    [``min_point``, ``point``].
+    """
+    raise NotImplementedError
+
+  def get_value(self, point):
+    """Returns the pixel value corresponding to the point, where
+    ``min_point`` corresponds to 0.0 and ``max_point`` to 1.0.
+    """
+    return (point - self.min_point) / (self.max_point - self.min_point)
+
+  def get_cumulative_fractions(self, num_values=256):
+    """Returns a list of fractions of pixels whose values are at most
+    0.0, ..., 1.0 for ``num_values`` evenly spaced values.
+
+    The table allows storing or comparing histograms regardless of the
+    precision of the analyzed image. For `PdbHistogram`, each value requires
+    querying the PDB, unless a point of the same GIMP histogram bin was already
+    queried. The number of queries per channel is thus limited to 256 for 8-bit
+    drawables and 1024 otherwise, regardless of ``num_values``.
+    """
+    total_count = self.total_count
+    fractions = []
+
+    for index in range(num_values):
+      point = self.min_point + round(
+        index * (self.max_point - self.min_point) / max(num_values - 1, 1))
+
+      if total_count > 0:
+        fractions.append(self.get_cumulative_count(point) / total_count)
+      else:
+        fractions.append(0.0)
+
+    return fractions
+
+
+_U8_PRECISIONS = [
+  Gimp.Precision.U8_LINEAR,
+  Gimp.Precision.U8_NON_LINEAR,
+  Gimp.Precision.U8_PERCEPTUAL,
+]
+"""Precisions of drawables whose pixels GIMP counts in 256 histogram bins."""
+
+
+class PdbHistogram(CumulativeHistogram):
+  """Cumulative histogram queried from the GIMP PDB.
+
+  Each cumulative count is queried from GIMP at most once, on first use. All
+  subsequent percentile queries, including those for both the black and the
+  white point, are answered from the table of already obtained counts.
+
+  ``histogram_channels`` is a list of `Gimp.HistogramChannel` values whose
+  counts are summed. By default, the channels described in
+  `CumulativeHistogram` are used.
+
+  GIMP counts pixels in 256 bins for 8-bit drawables and in 1024 bins
+  otherwise, rounding the queried range to whole bins. Points are therefore
+  mapped to bins before querying, so that points falling into an already
+  queried bin (e.g. while bisecting 65536 points of a 16-bit drawable) require
+  no PDB call.
+
+  If ``drawable_stats`` is not ``None``, each PDB call is counted in it. If
+  ``task_progress`` is not ``None``, cancellation is checked before each PDB
+  call. Counts queried before the run was canceled are kept in the table.
+  """
+
+  def __init__(
+        self,
+        drawable,
+        min_point=0,
+        max_point=255,
+        histogram_channels=None,
+        drawable_stats=None,
+        task_progress=None,
+  ):
+    super().__init__(min_point, max_point)
+
+    self.drawable = drawable
+    self.drawable_stats = drawable_stats
+    self.task_progress = task_progress
+
+    if histogram_channels is None:
+      # For layers, use the RGB pseudo-channel which combines the individual
+      # red, green and blue channels.
+      histogram_channels = _get_histogram_channels(drawable)
+
+    self.histogram_channels = histogram_channels
+
+    with gimp_lock:
+      precision = drawable.get_image().get_precision()
+
+    self._max_bin = (256 if precision in _U8_PRECISIONS else 1024) - 1
+
+    self._cumulative_counts = {}
+    self._total_count = None
+
+  @property
+  def total_count(self):
+    if self._total_count is None:
+      self.get_cumulative_count(self.min_point)
+
+    return self._total_count
+
+  def get_cumulative_count(self, point):
+    if point < self.min_point:
+      return 0.0
+
+    end_bin = self._get_bin(min(point, self.max_point))
+
+    if end_bin not in self._cumulative_counts:
+      self._cumulative_counts[end_bin], self._total_count = self._query_counts(
+        self._get_bin(self.min_point), end_bin)
+
+    return self._cumulative_counts[end_bin]
+
+  def _get_bin(self, point):
+    # GIMP rounds halves up.
+    return math.floor(point / self.max_point * self._max_bin + 0.5)
+
+  def _query_counts(self, start_bin, end_bin):
+    count = 0.0
+    total_count = 0.0
+
+    for histogram_channel in self.histogram_channels:
+      _check_canceled(self.task_progress)
+
+      # Identical queries made during the same run (e.g. by the preview and
+      # by the analysis) are answered from `procedure.PdbCallMemo` if enabled.
+      with gimp_lock:
+        histogram = procedure.query_pdb(
+          self.drawable.histogram,
+          histogram_channel,
+          start_bin / self._max_bin,
+          end_bin / self._max_bin,
+          on_pdb_call=lambda: stats.count(self.drawable_stats, 'pdb_calls'))
+
+      if self.task_progress is not None:
+        self.task_progress.pulse()
+
+      count += histogram.count
+      total_count += histogram.pixels
+
+    return count, total_count
+
+
+class PixelHistogram(CumulativeHistogram):
+  """Cumulative histogram computed from per-point pixel counts.
+
+  ``counts`` is a NumPy array whose element at index ``i`` is the number of
+  pixels with the value ``min_point + i``.
+  """
+
+  def __init__(self, counts, min_point=0):
+    super().__init__(min_point, min_point + len(counts) - 1)
+
+    self.counts = counts
+
+    self._cumulative_counts = np.cumsum(counts)
+
+  @property
+  def total_count(self):
+    return float(self._cumulative_counts[-1])
+
+  def get_cumulative_count(self, point):
+    if point < self.min_point:
+      return 0.0
+
+    return float(self._cumulative_counts[min(point, self.max_point) - self.min_point])
+
+
+class SketchHistogram(PixelHistogram):
+  """Cumulative histogram of floating-point pixel values, combining per-point
+  counts of values within the [0, 1] range with the buckets of a
+  `sketches.QuantileSketch` of values outside the range.
+
+  ``counts`` are the counts of values within the range as in
+  `PixelHistogram`. ``sketch`` holds the values outside the range.
+
+  Points are ordered by their pixel values: buckets of values below 0.0,
+  followed by the points of ``counts``, followed by buckets of values above
+  1.0. Points therefore do not map linearly to pixel values; use `get_value`
+  to obtain the pixel value of a point, which may lie outside the [0, 1]
+  range. Values within the range are as exact as for `PixelHistogram`, while
+  values outside the range are within the relative accuracy of the sketch.
+  """
+
+  def __init__(self, counts, sketch, min_point=0):
+    bucket_values, bucket_counts = sketch.get_buckets()
+    bucket_values = np.array(bucket_values, dtype=np.float64)
+    bucket_counts = np.array(bucket_counts, dtype=np.float64)
+
+    # The sketch only holds values outside the range. Representative values
+    # of buckets adjacent to the range are kept outside to preserve the order.
+    is_below_range = bucket_values <= 0.0
+
+    self.num_below_range = int(is_below_range.sum())
+
+    super().__init__(
+      np.concatenate([bucket_counts[is_below_range], counts, bucket_counts[~is_below_range]]),
+      min_point - self.num_below_range)
+
+    self.in_range_counts = counts
+    self.sketch = sketch
+    self.values = np.concatenate([
+      np.minimum(bucket_values[is_below_range], 0.0),
+      np.linspace(0.0, 1.0, len(counts)),
+      np.maximum(bucket_values[~is_below_range], 1.0),
+    ])
+
+  def get_value(self, point):
+    return float(self.values[min(max(point, self.min_point), self.max_point) - self.min_point])
+
+  def get_cumulative_fractions(self, num_values=256):
+    """Returns a list of fractions of pixels whose values are at most
+    0.0, ..., 1.0 for ``num_values`` evenly spaced values.
+
+    Pixels with values below 0.0 are counted in all fractions and pixels with
+    values above 1.0 in none, so the last fraction may be less than 1.0.
+    """
+    total_count = self.total_count
+    if total_count <= 0:
+      return [0.0] * num_values
+
+    # Values are in ascending order, hence the number of points with a value
+    # not exceeding a given value is found by bisection.
+    num_points = np.searchsorted(self.values, np.linspace(0.0, 1.0, num_values), side='right')
+
+    cumulative_counts = np.concatenate([[0.0], self._cumulative_counts])[num_points]
+
+    return (cumulative_counts / total_count).tolist()
+
+
+class MergedHistogram(CumulativeHistogram):
+  """Cumulative histogram summing the counts of histograms with the same
+  points, answered lazily from the merged histograms.
+  """
+
+  def __init__(self, histograms):
+    super().__init__(histograms[0].min_point, histograms[0].max_point)
+
+    self.histograms = histograms
+
+  @property
+  def total_count(self):
+    return sum(histogram.total_count for histogram in self.histograms)
+
+  def get_cumulative_count(self, point):
+    return sum(histogram.get_cumulative_count(point) for histogram in self.histograms)
+
+
+def merge_histograms(histograms):
+  """Returns a cumulative histogram of all pixels counted in the given
+  histograms, e.g. of multiple frames of an animation.
+
+  `PixelHistogram` counts are summed and `SketchHistogram` counts and sketches
+  are merged into a new histogram, which does not require reading any pixels
+  again. Other histograms (`PdbHistogram`) are combined into a
+  `MergedHistogram`.
+
+  The histograms must be computed for the same range of points.
+  """
+  if len(histograms) == 1:
+    return histograms[0]
+
+  if all(isinstance(histogram, SketchHistogram) for histogram in histograms):
+    first_sketch = histograms[0].sketch
+    merged_sketch = sketches.QuantileSketch(
+      relative_accuracy=first_sketch.relative_accuracy,
+      max_num_buckets=first_sketch.max_num_buckets,
+      min_value=first_sketch.min_value)
+
+    for histogram in histograms:
+      merged_sketch.merge(histogram.sketch)
+
+    return SketchHistogram(
+      sum(histogram.in_range_counts for histogram in histograms),
+      merged_sketch,
+      histograms[0].min_point + histograms[0].num_below_range)
+  elif all(type(histogram) is PixelHistogram for histogram in histograms):
+    return PixelHistogram(
+      sum(histogram.counts for histogram in histograms), histograms[0].min_point)
+  else:
+    return MergedHistogram(histograms)
+
+
+def _get_pixel_counts(
+      drawable,
+      num_bins,
+      memory_budget=DEFAULT_MEMORY_BUDGET,
+      num_threads=1,
+      region=None,
+      drawable_stats=None,
+      tile_summary=None,
+      new_tile_summary=None,
+      task_progress=None,
+      partial_key=None,
+):
+  """Returns a 2D array of per-value pixel counts of the drawable, one row for
+  each color channel, computed from the drawable pixels in a single vectorized
+  pass.
+
+  The counts are weighted by the alpha channel and the selection the same way
+  as in `Gimp.Drawable.histogram`.
+
+  Pixels are read in tile-aligned chunks whose size is limited by
+  ``memory_budget`` (in bytes), so that memory usage does not grow with the
+  drawable size.
+
+  If ``num_threads`` is greater than 1, the chunks, forming horizontal bands
+  of the drawable, are distributed among multiple threads, each accumulating
+  its own partial counts. The memory budget is split evenly among the threads.
+  The partial counts are sums of integer weights and are therefore merged
+  exactly.
+
+  If ``tile_summary`` is a `TileSummary` of the analyzed pixels, empty tiles
+  are skipped and each tile of identical pixels is counted from a single
+  pixel. Otherwise, if ``new_tile_summary`` is an empty `TileSummary` of the
+  analyzed pixels, the tiles are classified into it from the read pixels. See
+  `_PixelChunkReader`.
+
+  ``task_progress`` and ``partial_key`` allow canceling and resuming the
+  computation, see `_process_chunks`.
+  """
+  def _get_counts_for_chunks(reader, chunk_rects):
+    counts = np.zeros((reader.num_color_components, num_bins), dtype=np.float64)
+
+    for chunk_rect in chunk_rects:
+      pixels, weights = reader.read_chunk(chunk_rect)
+
+      for component_index in range(reader.num_color_components):
+        counts[component_index] += np.bincount(
+          pixels[:, component_index], weights=weights, minlength=num_bins)
+
+    return counts
+
+  partial_counts = _process_chunks(
+    drawable,
+    _get_component_type(num_bins),
+    memory_budget,
+    num_threads,
+    _get_counts_for_chunks,
+    region=region,
+    drawable_stats=drawable_stats,
+    tile_summary=tile_summary,
+    new_tile_summary=new_tile_summary,
+    task_progress=task_progress,
+    partial_key=partial_key)
+
+  return sum(
+    partial_counts,
+    np.zeros((get_num_color_components(drawable), num_bins), dtype=np.float64))
+
+
+def _get_pixel_sketches(
+      drawable,
+      num_bins,
+      memory_budget=DEFAULT_MEMORY_BUDGET,
+      num_threads=1,
+      region=None,
+      drawable_stats=None,
+      tile_summary=None,
+      new_tile_summary=None,
+      task_progress=None,
+      partial_key=None,
+):
+  """Returns a tuple of (counts, sketches) of floating-point drawable pixel
+  values, built in a single pass.
+
+  ``counts`` is a 2D array of counts of values within the [0, 1] range
+  quantized to ``num_bins`` points, one row for each color channel.
+  ``sketches`` is a list of `sketches.QuantileSketch` instances of values
+  outside the range, one for each color channel.
+
+  Pixels are weighted, processed in chunks and the remaining parameters are
+  used the same way as in `_get_pixel_counts`. Each thread builds its own
+  counts and sketches, which are merged at the end.
+  """
+  def _get_counts_and_sketches_for_chunks(reader, chunk_rects):
+    counts = np.zeros((reader.num_color_components, num_bins), dtype=np.float64)
+    channel_sketches = [
+      sketches.QuantileSketch() for _unused in range(reader.num_color_components)]
+
+    for chunk_rect in chunk_rects:
+      pixels, weights = reader.read_chunk(chunk_rect)
+
+      for component_index in range(reader.num_color_components):
+        values = pixels[:, component_index]
+        is_in_range = (values >= 0.0) & (values <= 1.0)
+
+        if is_in_range.all():
+          in_range_values, in_range_weights = values, weights
+        else:
+          in_range_values = values[is_in_range]
+          in_range_weights = weights[is_in_range] if weights is not None else None
+
+          channel_sketches[component_index].add(
+            values[~is_in_range], weights[~is_in_range] if weights is not None else None)
+
+        counts[component_index] += np.bincount(
+          np.rint(in_range_values * (num_bins - 1)).astype(np.intp),
+          weights=in_range_weights,
+          minlength=num_bins)
+
+    return counts, channel_sketches
+
+  counts = np.zeros((get_num_color_components(drawable), num_bins), dtype=np.float64)
+  channel_sketches = [
+    sketches.QuantileSketch() for _unused in range(get_num_color_components(drawable))]
+
+  for partial_counts, partial_sketches in _process_chunks(
+        drawable,
+        'float',
+        memory_budget,
+        num_threads,
+        _get_counts_and_sketches_for_chunks,
+        region=region,
+        drawable_stats=drawable_stats,
+        tile_summary=tile_summary,
+        new_tile_summary=new_tile_summary,
+        task_progress=task_progress,
+        partial_key=partial_key):
+    counts += partial_counts
+    for channel_sketch, partial_sketch in zip(channel_sketches, partial_sketches):
+      channel_sketch.merge(partial_sketch)
+
+  return counts, channel_sketches
+
+
+def _process_chunks(
+      drawable,
+      component_type,
+      memory_budget,
+      num_threads,
+      process_chunks_func,
+      region=None,
+      drawable_stats=None,
+      tile_summary=None,
+      new_tile_summary=None,
+      task_progress=None,
+      partial_key=None,
+):
+  """Splits the analyzed part of the drawable (see `_get_analyzed_rect`) into
+  chunks and returns a list of results of ``process_chunks_func``, one for
+  each thread processing the chunks.
+
+  ``process_chunks_func`` accepts a `_PixelChunkReader` instance and an
+  iterable of chunk rectangles to process. An empty list is returned if the
+  region to analyze is empty.
+
+  Each processed chunk is reported to ``task_progress``. Once the run is
+  canceled, the threads stop before their next chunk and `progress.Canceled`
+  is raised. If ``partial_key`` is not ``None`` (a key identifying the
+  drawable contents, see `get_histogram_cache_key`), the results obtained so
+  far are kept under the key along with the processed chunks, and a later call
+  with the same key only processes the remaining chunks. The returned list
+  then also contains the kept results.
+  """
+  analyzed_rect = _get_analyzed_rect(drawable, region)
+  if analyzed_rect is None:
+    if task_progress is not None:
+      task_progress.finish()
+    return []
+
+  x, y, width, height = analyzed_rect
+
+  with gimp_lock:
+    reader = _PixelChunkReader(
+      drawable,
+      component_type,
+      max(memory_budget // num_threads, 1),
+      use_selection=region is None,
+      drawable_stats=drawable_stats,
+      tile_summary=tile_summary,
+      new_tile_summary=new_tile_summary)
+
+  chunk_rects = reader.get_chunk_rects(x, y, width, height)
+
+  kept_results, processed_chunk_rects = [], set()
+  if partial_key is not None:
+    partial_result = _partial_results.pop(partial_key)
+    # Results of differently split chunks (e.g. due to a different memory
+    # budget) cannot be combined.
+    if partial_result is not None and partial_result[1] <= set(chunk_rects):
+      kept_results, processed_chunk_rects = partial_result
+
+  remaining_chunk_rects = [
+    chunk_rect for chunk_rect in chunk_rects if chunk_rect not in processed_chunk_rects]
+
+  if task_progress is not None:
+    task_progress.start(len(chunk_rects), len(processed_chunk_rects))
+
+  num_threads = max(min(num_threads, len(remaining_chunk_rects)), 1)
+  thread_processed_chunk_rects = [[] for _unused in range(num_threads)]
+
+  def _process_thread_chunks(thread_index):
+    return process_chunks_func(
+      reader,
+      _iterate_chunk_rects(
+        remaining_chunk_rects[thread_index::num_threads],
+        task_progress,
+        thread_processed_chunk_rects[thread_index]))
+
+  if num_threads == 1:
+    results = [_process_thread_chunks(0)]
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+      results = list(executor.map(_process_thread_chunks, range(num_threads)))
+
+  results = kept_results + results
+
+  if task_progress is not None and task_progress.is_canceled:
+    if partial_key is not None:
+      for chunk_rects_of_thread in thread_processed_chunk_rects:
+        processed_chunk_rects = processed_chunk_rects.union(chunk_rects_of_thread)
+      _partial_results.put(partial_key, (results, processed_chunk_rects))
+
+    task_progress.check()
+
+  return results
+
+
+def _iterate_chunk_rects(chunk_rects, task_progress, processed_chunk_rects):
+  """Yields chunk rectangles until the run is canceled, appending each
+  processed rectangle to ``processed_chunk_rects``.
+
+  A rectangle is processed once the next one is requested, hence the results
+  accumulated by the consumer always correspond to ``processed_chunk_rects``.
+  """
+  for chunk_rect in chunk_rects:
+    if task_progress is not None and task_progress.is_canceled:
+      return
+
+    yield chunk_rect
+
+    processed_chunk_rects.append(chunk_rect)
+    if task_progress is not None:
+      task_progress.advance()
+
+
+def _check_canceled(task_progress):
+  if task_progress is not None:
+    task_progress.check()
+
+
+def _get_sampled_pixel_counts(
+      drawable,
+      num_bins,
+      sample_size,
+      memory_budget=DEFAULT_MEMORY_BUDGET,
+      num_threads=1,
+      region=None,
+      drawable_stats=None,
+      task_progress=None,
+):
+  """Returns a 2D array of per-value pixel counts of approximately
+  ``sample_size`` pixels of the drawable, one row for each color channel.
+
+  The drawable is divided into a grid of square cells and one pixel at a
+  random position within each cell is sampled, weighted by the cell area.
+  Unlike sampling pixels at fixed positions, this cannot be fooled by regular
+  patterns such as stripes, and the stratification by cells makes the
+  estimate at least as accurate as one from independently sampled pixels.
+  Positions are drawn from a fixed seed, so that repeated runs give the same
+  estimate.
+
+  Only the buffer tiles containing sampled pixels are read, each reported to
+  ``task_progress``. If the drawable has fewer pixels than ``sample_size``,
+  all pixels are counted by `_get_pixel_counts` with the given
+  ``memory_budget`` and ``num_threads``.
+  """
+  counts = np.zeros((get_num_color_components(drawable), num_bins), dtype=np.float64)
+
+  analyzed_rect = _get_analyzed_rect(drawable, region)
+  if analyzed_rect is None:
+    return counts
+
+  x, y, width, height = analyzed_rect
+
+  stride = max(math.floor(math.sqrt(width * height / sample_size)), 1)
+
+  if stride == 1:
+    return _get_pixel_counts(
+      drawable,
+      num_bins,
+      memory_budget,
+      num_threads,
+      region=region,
+      drawable_stats=drawable_stats,
+      task_progress=task_progress)
+
+  with gimp_lock:
+    reader = _PixelChunkReader(
+      drawable,
+      _get_component_type(num_bins),
+      memory_budget,
+      use_selection=region is None,
+      drawable_stats=drawable_stats)
+    tile_width = reader.buffer.get_property('tile-width')
+    tile_height = reader.buffer.get_property('tile-height')
+
+  rng = np.random.default_rng(0)
+
+  # Cells at the right and bottom edges may be truncated.
+  cell_xs = np.arange(x, x + width, stride)
+  cell_ys = np.arange(y, y + height, stride)
+  cell_widths = np.minimum(x + width - cell_xs, stride)
+  cell_heights = np.minimum(y + height - cell_ys, stride)
+
+  num_cells = (len(cell_ys), len(cell_xs))
+  sample_xs = (cell_xs + np.floor(rng.random(num_cells) * cell_widths).astype(np.int64)).ravel()
+  sample_ys = (
+    cell_ys[:, np.newaxis]
+    + np.floor(rng.random(num_cells) * cell_heights[:, np.newaxis]).astype(np.int64)).ravel()
+  cell_areas = np.outer(cell_heights, cell_widths).ravel().astype(np.float64)
+
+  tile_indices = (sample_ys // tile_height) * (x + width) + sample_xs // tile_width
+  order = np.argsort(tile_indices, kind='stable')
+  _unique_tile_indices, tile_starts = np.unique(tile_indices[order], return_index=True)
+
+  if task_progress is not None:
+    task_progress.start(len(tile_starts))
+
+  for start, end in zip(tile_starts, list(tile_starts[1:]) + [len(order)]):
+    _check_canceled(task_progress)
+
+    tile_samples = order[start:end]
+    tile_sample_xs = sample_xs[tile_samples]
+    tile_sample_ys = sample_ys[tile_samples]
+
+    tile_x = max((tile_sample_xs[0] // tile_width) * tile_width, x)
+    tile_y = max((tile_sample_ys[0] // tile_height) * tile_height, y)
+    tile_rect_width = min((tile_sample_xs[0] // tile_width + 1) * tile_width, x + width) - tile_x
+    tile_rect_height = (
+      min((tile_sample_ys[0] // tile_height + 1) * tile_height, y + height) - tile_y)
+
+    pixels, weights = reader.read_chunk((tile_x, tile_y, tile_rect_width, tile_rect_height))
+
+    pixel_indices = (tile_sample_ys - tile_y) * tile_rect_width + tile_sample_xs - tile_x
+    sampled_pixels = pixels[pixel_indices]
+    sampled_weights = cell_areas[tile_samples]
+    if weights is not None:
+      sampled_weights = sampled_weights * weights[pixel_indices]
+
+    for component_index in range(reader.num_color_components):
+      counts[component_index] += np.bincount(
+        sampled_pixels[:, component_index], weights=sampled_weights, minlength=num_bins)
+
+    if task_progress is not None:
+      task_progress.advance()
+
+  return counts
+
+
+def _get_analyzed_rect(drawable, region):
+  """Returns the (x, y, width, height) rectangle of the drawable to analyze in
+  drawable coordinates, or ``None`` if the rectangle is empty.
+
+  If ``region`` is ``None``, the rectangle is the intersection of the drawable
+  and the selection bounds. Otherwise, it is the intersection of the drawable
+  and ``region`` given in image coordinates.
+  """
+  with gimp_lock:
+    if region is None:
+      is_nonempty, x, y, width, height = drawable.mask_intersect()
+      return (x, y, width, height) if is_nonempty else None
+
+    _success, offset_x, offset_y = drawable.get_offsets()
+    drawable_width = drawable.get_width()
+    drawable_height = drawable.get_height()
+
+  region_x, region_y, region_width, region_height = region
+
+  x1 = max(region_x - offset_x, 0)
+  y1 = max(region_y - offset_y, 0)
+  x2 = min(region_x + region_width - offset_x, drawable_width)
+  y2 = min(region_y + region_height - offset_y, drawable_height)
+
+  if x2 <= x1 or y2 <= y1:
+    return None
+
+  return x1, y1, x2 - x1, y2 - y1
+
+
+def get_num_color_components(drawable):
+  """Returns the number of color channels analyzed separately by
+  `get_channel_histograms`.
+  """
+  return 1 if isinstance(drawable, Gimp.Channel) else 3
+
+
+def _get_histogram_channels(drawable):
+  if isinstance(drawable, Gimp.Channel):
+    return [Gimp.HistogramChannel.VALUE]
+  else:
+    return [Gimp.HistogramChannel.RED, Gimp.HistogramChannel.GREEN, Gimp.HistogramChannel.BLUE]
+
+
+def _get_component_type(num_bins):
+  # Reading pixels as integers whose maximum value matches the number of bins
+  # allows using the pixel values as bin indexes directly.
+  if num_bins <= 256:
+    return 'u8'
+  else:
+    return 'u16'
+
+
+class _PixelChunkReader:
+  """Reads pixels of a drawable in tile-aligned chunks, along with weights
+  given by the alpha channel and the selection.
+
+  ``component_type`` is the type of pixel components as understood by babl,
+  one of ``'u8'``, ``'u16'`` or ``'float'``. If ``use_selection`` is
+  ``False``, pixels are weighted by the alpha channel only. If
+  ``drawable_stats`` is not ``None``, each read from a buffer is counted in it.
+
+  If ``tile_summary`` is a `TileSummary` of the read pixels, empty tiles are
+  not read and tiles of identical pixels are represented by a single pixel
+  weighted by the number of pixels in the tile. If ``new_tile_summary`` is an
+  empty `TileSummary`, the tiles of each chunk read in full are classified
+  into it in the format of the read pixels.
+
+  The array holding the weights is allocated once per thread for the largest
+  chunk and reused for all chunks read by that thread.
+  """
+
+  def __init__(
+        self,
+        drawable,
+        component_type,
+        memory_budget,
+        use_selection=True,
+        drawable_stats=None,
+        tile_summary=None,
+        new_tile_summary=None,
+  ):
+    self.drawable = drawable
+    self.memory_budget = memory_budget
+    self.drawable_stats = drawable_stats
+    self.tile_summary = tile_summary
+    self.new_tile_summary = new_tile_summary
+
+    self.dtype = {'u8': np.uint8, 'u16': np.uint16, 'float': np.float32}[component_type]
+
+    if isinstance(drawable, Gimp.Channel):
+      self.color_format = f'Y {component_type}'
+      self.num_color_components = 1
+      self.has_alpha = False
+    elif drawable.has_alpha():
+      self.color_format = f'RGBA {component_type}'
+      self.num_color_components = 3
+      self.has_alpha = True
+    else:
+      self.color_format = f'RGB {component_type}'
+      self.num_color_components = 3
+      self.has_alpha = False
+
+    self.num_components = self.num_color_components + int(self.has_alpha)
+
+    self.buffer = drawable.get_buffer()
+
+    image = drawable.get_image()
+    if use_selection and not Gimp.Selection.is_empty(image):
+      self.selection_buffer = image.get_selection().get_buffer()
+    else:
+      self.selection_buffer = None
+
+    _success, self.offset_x, self.offset_y = drawable.get_offsets()
+
+    if self.new_tile_summary is not None:
+      self.new_tile_summary.pixel_format = self.color_format
+
+    self._thread_data = threading.local()
+    self._uniform_pixels_and_weights = {}
+    self._new_tile_summary_lock = threading.Lock()
+
+  @property
+  def has_weights(self):
+    return self.has_alpha or self.selection_buffer is not None
+
+  @property
+  def bytes_per_pixel(self):
+    bytes_per_pixel = self.num_components * np.dtype(self.dtype).itemsize
+    if self.has_weights:
+      # Weights are stored as 64-bit floats, selection values as 8-bit integers.
+      bytes_per_pixel += np.dtype(np.float64).itemsize + np.dtype(np.uint8).itemsize
+
+    return bytes_per_pixel
+
+  def get_chunk_rects(self, x, y, width, height):
+    """Returns a list of (x, y, width, height) tuples splitting the specified
+    region into chunks aligned to the buffer tiles.
+
+    Each chunk spans as many full tile rows as the memory budget allows. If
+    even a single tile row exceeds the budget, the rows are further split into
+    columns of whole tiles.
+    """
+    with gimp_lock:
+      tile_width = self.buffer.get_property('tile-width')
+      tile_height = self.buffer.get_property('tile-height')
+
+    max_chunk_pixels = max(self.memory_budget // self.bytes_per_pixel, tile_width * tile_height)
+
+    chunk_width = min(width, max(max_chunk_pixels // tile_height // tile_width, 1) * tile_width)
+    chunk_height = max(max_chunk_pixels // chunk_width // tile_height, 1) * tile_height
+
+    chunk_rects = []
+
+    chunk_y = y
+    while chunk_y < y + height:
+      next_chunk_y = min((chunk_y // tile_height) * tile_height + chunk_height, y + height)
+
+      chunk_x = x
+      while chunk_x < x + width:
+        next_chunk_x = min((chunk_x // tile_width) * tile_width + chunk_width, x + width)
+        if chunk_width >= width:
+          next_chunk_x = x + width
+
+        chunk_rects.append((chunk_x, chunk_y, next_chunk_x - chunk_x, next_chunk_y - chunk_y))
+
+        chunk_x = next_chunk_x
+
+      chunk_y = next_chunk_y
+
+    return chunk_rects
+
+  def read_chunk(self, chunk_rect):
+    """Returns a tuple of (pixels, weights) arrays for the specified chunk.
+
+    ``pixels`` has the shape (number of pixels, number of components).
+    ``weights`` is ``None`` if the drawable has no alpha channel and there is
+    no selection. The returned ``weights`` array is only valid until the next
+    call to this method from the same thread.
+
+    If tiles of the chunk are skipped according to the `TileSummary`, the
+    returned arrays contain the pixels of the remaining tiles followed by one
+    pixel for each tile of identical pixels, and ``weights`` is never
+    ``None``.
+    """
+    if self.tile_summary is None:
+      return self._read_rect(chunk_rect, classify_tiles=self.new_tile_summary is not None)
+
+    rects, skipped_tiles = self.tile_summary.split_rect(chunk_rect, self._is_skipped)
+    if not skipped_tiles:
+      return self._read_rect(chunk_rect)
+
+    pixel_parts = []
+    weight_parts = []
+
+    for rect in rects:
+      pixels, weights = self._read_rect(rect)
+      pixel_parts.append(pixels)
+      weight_parts.append(weights.copy() if weights is not None else np.ones(len(pixels)))
+
+    for tile, (tile_x, tile_y, tile_width, tile_height) in skipped_tiles:
+      if tile in self.tile_summary.empty_tiles:
+        continue
+
+      pixel, weight = self._get_uniform_pixel_and_weight(tile, tile_x, tile_y)
+      pixel_parts.append(pixel)
+      weight_parts.append(np.array([weight * tile_width * tile_height]))
+
+    if not pixel_parts:
+      return np.empty((0, self.num_components), dtype=self.dtype), np.empty(0)
+
+    return np.concatenate(pixel_parts), np.concatenate(weight_parts)
+
+  def _is_skipped(self, tile):
+    return (
+      tile in self.tile_summary.empty_tiles or self.tile_summary.is_uniformly_weighted(tile))
+
+  def _get_uniform_pixel_and_weight(self, tile, x, y):
+    # Tiles of the same color (e.g. a flat background) share the converted
+    # pixel, which is read only once.
+    key = self.tile_summary.uniform_pixels[tile]
+
+    if key not in self._uniform_pixels_and_weights:
+      pixels, weights = self._read_rect((x, y, 1, 1))
+      self._uniform_pixels_and_weights[key] = (
+        pixels.copy(), float(weights[0]) if weights is not None else 1.0)
+
+    return self._uniform_pixels_and_weights[key]
+
+  def _read_rect(self, rect, classify_tiles=False):
+    x, y, width, height = rect
+    num_pixels = width * height
+
+    with gimp_lock:
+      pixel_data = self.buffer.get(
+        Gegl.Rectangle.new(x, y, width, height), 1.0, self.color_format, Gegl.AbyssPolicy.NONE)
+    stats.count(self.drawable_stats, 'buffer_reads')
+
+    pixels = np.frombuffer(pixel_data, dtype=self.dtype).reshape(num_pixels, self.num_components)
+
+    if not self.has_weights:
+      if classify_tiles:
+        self._classify_tiles(rect, pixels, None)
+      return pixels, None
+
+    weights_buffer = getattr(self._thread_data, 'weights', None)
+    if weights_buffer is None or len(weights_buffer) < num_pixels:
+      weights_buffer = np.empty(num_pixels, dtype=np.float64)
+      self._thread_data.weights = weights_buffer
+
+    weights = weights_buffer[:num_pixels]
+
+    if self.has_alpha:
+      weights[:] = pixels[:, self.num_color_components]
+    else:
+      weights.fill(1.0)
+
+    if self.selection_buffer is not None:
+      with gimp_lock:
+        selection_data = self.selection_buffer.get(
+          Gegl.Rectangle.new(x + self.offset_x, y + self.offset_y, width, height),
+          1.0,
+          'Y u8',
+          Gegl.AbyssPolicy.NONE)
+      stats.count(self.drawable_stats, 'buffer_reads')
+
+      selection = np.frombuffer(selection_data, dtype=np.uint8)
+      weights *= selection
+    else:
+      selection = None
+
+    if classify_tiles:
+      self._classify_tiles(rect, pixels, selection)
+
+    return pixels, weights
+
+  def _classify_tiles(self, rect, pixels, selection):
+    _x, _y, width, height = rect
+    bytes_per_alpha = np.dtype(self.dtype).itemsize if self.has_alpha else 0
+
+    with self._new_tile_summary_lock:
+      self.new_tile_summary.add_chunk(
+        rect,
+        pixels.view(np.uint8).reshape(height, width, -1),
+        bytes_per_alpha,
+        selection.reshape(height, width) if selection is not None else None)
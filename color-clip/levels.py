@@ -0,0 +1,196 @@
+"""Application of levels with separate input ranges for each color channel."""
+
+import gi
+gi.require_version('Gegl', '0.4')
+from gi.repository import Gegl
+gi.require_version('Gimp', '3.0')
+from gi.repository import Gimp
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+import histograms
+import procedure
+
+
+_LINEAR_PRECISIONS = {
+  'u8': Gimp.Precision.U8_LINEAR,
+  'u16': Gimp.Precision.U16_LINEAR,
+}
+"""Linear precisions whose pixels are read unchanged in the babl formats of
+the given component type.
+"""
+
+
+def apply_channel_levels(
+      drawable,
+      channel_inputs,
+      memory_budget=histograms.DEFAULT_MEMORY_BUDGET,
+      tile_summary=None,
+):
+  """Stretches each color channel of the drawable so that its
+  (low input, high input) tuple in ``channel_inputs`` maps to [0, 1].
+
+  ``channel_inputs`` contains one tuple for each color channel - red, green
+  and blue for layers and layer groups, value for channels and layer masks.
+
+  If NumPy is available, all channels are adjusted in linear light in a single
+  pass over the drawable pixels, processed in tile-aligned chunks of at most
+  ``memory_budget`` bytes. Otherwise, `Gimp.Drawable.levels` is applied once
+  for each channel in the precision of the image.
+
+  If ``tile_summary`` is a `histograms.TileSummary` of the pixels to adjust
+  (e.g. obtained while analyzing the drawable), tiles of identical pixels are
+  not read; they are filled with the adjusted pixel instead. The summary is
+  ignored if its tiles were classified from pixels in a format that may merge
+  distinct pixels of the drawable.
+  """
+  if np is None:
+    _apply_channel_levels_via_pdb(drawable, channel_inputs)
+    return
+
+  is_nonempty, x, y, width, height = drawable.mask_intersect()
+  if not is_nonempty:
+    return
+
+  if isinstance(drawable, Gimp.Channel):
+    pixel_format = 'Y float'
+    num_components = 1
+  elif drawable.has_alpha():
+    pixel_format = 'RGBA float'
+    num_components = 4
+  else:
+    pixel_format = 'RGB float'
+    num_components = 3
+
+  buffer = drawable.get_buffer()
+  shadow_buffer = drawable.get_shadow_buffer()
+
+  if tile_summary is not None and (
+        tile_summary.rect != (x, y, width, height)
+        or tile_summary.tile_width != buffer.get_property('tile-width')
+        or tile_summary.tile_height != buffer.get_property('tile-height')
+        or not _has_exact_uniform_tiles(drawable, tile_summary, pixel_format)):
+    tile_summary = None
+
+  adjusted_uniform_pixels = {}
+
+  bytes_per_row = width * num_components * np.dtype(np.float32).itemsize
+  tile_height = buffer.get_property('tile-height')
+  rows_per_chunk = max(memory_budget // bytes_per_row // tile_height, 1) * tile_height
+
+  chunk_y = y
+  while chunk_y < y + height:
+    # Align chunks to tile rows so that each tile is read and written once.
+    next_chunk_y = min((chunk_y // tile_height) * tile_height + rows_per_chunk, y + height)
+    chunk_rect = (x, chunk_y, width, next_chunk_y - chunk_y)
+
+    if tile_summary is not None:
+      rects, uniform_tiles = tile_summary.split_rect(
+        chunk_rect, lambda tile: tile in tile_summary.uniform_pixels)
+    else:
+      rects, uniform_tiles = [chunk_rect], []
+
+    for rect in rects:
+      _adjust_rect(buffer, shadow_buffer, rect, pixel_format, num_components, channel_inputs)
+
+    for native_pixel, fill_rect in _get_uniform_rects(tile_summary, uniform_tiles):
+      fill_x, fill_y, fill_width, fill_height = fill_rect
+
+      if native_pixel not in adjusted_uniform_pixels:
+        adjusted_uniform_pixels[native_pixel] = _adjust_pixels(
+          _read_pixels(buffer, (fill_x, fill_y, 1, 1), pixel_format, num_components),
+          channel_inputs,
+        ).tobytes()
+
+      shadow_buffer.set(
+        Gegl.Rectangle.new(*fill_rect),
+        pixel_format,
+        adjusted_uniform_pixels[native_pixel] * (fill_width * fill_height))
+
+    chunk_y = next_chunk_y
+
+  shadow_buffer.flush()
+
+  procedure.modify_pdb(drawable.merge_shadow, True)
+  drawable.update(x, y, width, height)
+
+
+def _has_exact_uniform_tiles(drawable, tile_summary, pixel_format):
+  """Returns ``True`` if the tiles classified as uniform in ``tile_summary``
+  hold pixels that are identical when read in ``pixel_format``.
+  """
+  if tile_summary.pixel_format is None or tile_summary.pixel_format == pixel_format:
+    return True
+
+  # Pixels of linear 8- or 16-bit images are read unchanged in the format of
+  # the same precision. Other conversions may map distinct pixels to the same
+  # pixel, e.g. dark non-linear 8-bit pixels read as linear 8-bit.
+  component_type = tile_summary.pixel_format.split(' ')[-1]
+
+  return drawable.get_image().get_precision() == _LINEAR_PRECISIONS.get(component_type)
+
+
+def _get_uniform_rects(tile_summary, uniform_tiles):
+  """Returns a list of (native pixel, rectangle) tuples, merging neighboring
+  uniform tiles of the same pixel in a tile row into a single rectangle.
+  """
+  uniform_rects = []
+
+  for tile, (tile_x, tile_y, tile_width, tile_height) in uniform_tiles:
+    native_pixel, _selection_value = tile_summary.uniform_pixels[tile]
+
+    if uniform_rects:
+      previous_native_pixel, (previous_x, previous_y, previous_width, previous_height) = (
+        uniform_rects[-1])
+
+      if (previous_native_pixel == native_pixel
+          and previous_y == tile_y
+          and previous_x + previous_width == tile_x):
+        uniform_rects[-1] = (
+          native_pixel, (previous_x, previous_y, previous_width + tile_width, previous_height))
+        continue
+
+    uniform_rects.append((native_pixel, (tile_x, tile_y, tile_width, tile_height)))
+
+  return uniform_rects
+
+
+def _adjust_rect(buffer, shadow_buffer, rect, pixel_format, num_components, channel_inputs):
+  pixels = _adjust_pixels(
+    _read_pixels(buffer, rect, pixel_format, num_components), channel_inputs)
+
+  shadow_buffer.set(Gegl.Rectangle.new(*rect), pixel_format, pixels.tobytes())
+
+
+def _read_pixels(buffer, rect, pixel_format, num_components):
+  return np.frombuffer(
+    buffer.get(Gegl.Rectangle.new(*rect), 1.0, pixel_format, Gegl.AbyssPolicy.NONE),
+    dtype=np.float32,
+  ).reshape(-1, num_components).copy()
+
+
+def _adjust_pixels(pixels, channel_inputs):
+  for component_index, (low_input, high_input) in enumerate(channel_inputs):
+    component = pixels[:, component_index]
+    if high_input > low_input:
+      component -= low_input
+      component /= high_input - low_input
+    else:
+      component[:] = np.where(component >= high_input, 1.0, 0.0)
+
+  return pixels
+
+
+def _apply_channel_levels_via_pdb(drawable, channel_inputs):
+  if isinstance(drawable, Gimp.Channel):
+    histogram_channels = [Gimp.HistogramChannel.VALUE]
+  else:
+    histogram_channels = [
+      Gimp.HistogramChannel.RED, Gimp.HistogramChannel.GREEN, Gimp.HistogramChannel.BLUE]
+
+  for histogram_channel, (low_input, high_input) in zip(histogram_channels, channel_inputs):
+    procedure.modify_pdb(
+      drawable.levels, histogram_channel, low_input, high_input, False, 1.0, 0.0, 1.0, False)
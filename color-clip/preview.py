@@ -0,0 +1,225 @@
+"""Preview of Color Clip displayed in the plug-in dialog."""
+
+import concurrent.futures
+
+import gi
+gi.require_version('Gimp', '3.0')
+from gi.repository import Gimp
+from gi.repository import GdkPixbuf
+from gi.repository import GLib
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+
+import color_clip
+import progress
+
+
+class ColorClipPreview:
+  """Widget displaying a downscaled drawable with color clip applied.
+
+  The drawable is analyzed by ``analyze_func`` in the same way as by Color
+  Clip itself, i.e. according to the analysis region, the per-channel mode
+  and the image precision given by the procedure configuration.
+  ``analyze_func`` accepts the ``drawable_progress``, ``return_histograms``
+  and ``histogram_lists`` keyword arguments of `_analyze_drawables` in the
+  plug-in script, with ``drawables`` and ``config`` already bound.
+
+  The drawable histograms are computed when the preview is created and
+  whenever an argument determining the analyzed pixels changes. Each change of
+  the clip percentages only queries the precomputed histograms for new black
+  and white points and re-renders the downscaled drawable. Updates are delayed
+  until the arguments stop changing for ``update_delay_milliseconds`` so that
+  dragging a slider remains responsive.
+
+  The drawable is analyzed in a separate thread (see
+  `progress.run_in_background`) with its progress shown in the status bar, so
+  that the dialog remains responsive. An analysis that is still running is
+  canceled once its result becomes obsolete or `stop` is called.
+  """
+
+  _ANALYSIS_PROPERTY_NAMES = [
+    'per-channel',
+    'analysis-region',
+    'region-x',
+    'region-y',
+    'region-width',
+    'region-height',
+    'sampling-tolerance',
+  ]
+
+  def __init__(
+        self,
+        drawable,
+        config,
+        analyze_func,
+        max_size=256,
+        update_delay_milliseconds=50,
+  ):
+    self.drawable = drawable
+    self.config = config
+    self.update_delay_milliseconds = update_delay_milliseconds
+
+    self._analyze_func = analyze_func
+    self._histogram_lists = None
+    self._analysis_progress = None
+    self._analysis_future = None
+
+    self._thumbnail = drawable.get_thumbnail(
+      max_size, max_size, Gimp.PixbufTransparency.KEEP_ALPHA)
+    self._thumbnail_pixels = bytes(self._thumbnail.read_pixel_bytes().get_data())
+
+    self._update_source_id = None
+
+    self.widget = Gtk.Frame(label='Preview')
+    self._image = Gtk.Image()
+    self._image.set_margin_top(6)
+    self._image.set_margin_bottom(6)
+    self.widget.add(self._image)
+    self.widget.show_all()
+
+    for property_name in ['clip-percent-black', 'clip-percent-white']:
+      config.connect(f'notify::{property_name}', self._on_config_changed)
+
+    for property_name in self._ANALYSIS_PROPERTY_NAMES:
+      config.connect(f'notify::{property_name}', self._on_analysis_config_changed)
+
+    self.update()
+
+  def update(self):
+    """Starts determining the points for the current arguments, replacing any
+    analysis still running. The preview is re-rendered once the points are
+    determined.
+    """
+    self._update_source_id = None
+
+    self._cancel_analysis()
+
+    analysis_progress = progress.Progress('Color Clip preview')
+    histogram_lists = self._histogram_lists
+
+    self._analysis_progress = analysis_progress
+    self._analysis_future = progress.run_in_background(
+      lambda: self._analyze_func(
+        drawable_progress=[analysis_progress.add_task()],
+        return_histograms=True,
+        histogram_lists=histogram_lists),
+      self._on_analysis_done)
+
+    return False
+
+  def stop(self):
+    """Cancels updates of the preview and returns the histograms of the
+    drawable as returned by ``analyze_func``, or ``None`` if the analysis for
+    the current arguments has not finished.
+    """
+    if self._update_source_id is not None:
+      GLib.source_remove(self._update_source_id)
+      self._update_source_id = None
+
+    self._cancel_analysis()
+
+    return self._histogram_lists
+
+  def _cancel_analysis(self):
+    if self._analysis_future is None:
+      return
+
+    self._analysis_progress.cancel()
+    # The analysis stops before its next unit of work.
+    concurrent.futures.wait([self._analysis_future])
+    self._analysis_progress.end()
+
+    self._analysis_future = None
+    self._analysis_progress = None
+
+  def _on_analysis_done(self, future):
+    if future is not self._analysis_future:
+      # The analysis was canceled or replaced by a newer one.
+      return
+
+    self._analysis_progress.end()
+    self._analysis_future = None
+    self._analysis_progress = None
+
+    try:
+      color_clips, self._histogram_lists = future.result()
+    except ValueError:
+      # The arguments are invalid (e.g. the analysis region misses the
+      # drawable), which is reported once Color Clip is run.
+      self._image.set_from_pixbuf(self._thumbnail)
+      return
+
+    if self.config.get_property('per-channel'):
+      channel_inputs = color_clips[0]
+    else:
+      channel_inputs = [color_clips[0]]
+
+    self._image.set_from_pixbuf(self._get_clipped_thumbnail(channel_inputs))
+
+  def _on_config_changed(self, _config, _param_spec):
+    if self._update_source_id is not None:
+      GLib.source_remove(self._update_source_id)
+
+    self._update_source_id = GLib.timeout_add(self.update_delay_milliseconds, self.update)
+
+  def _on_analysis_config_changed(self, config, param_spec):
+    # Histograms being computed for the previous arguments are obsolete.
+    self._cancel_analysis()
+    self._histogram_lists = None
+    self._on_config_changed(config, param_spec)
+
+  def _get_clipped_thumbnail(self, channel_inputs):
+    """Returns the thumbnail with levels applied to each color channel.
+
+    ``channel_inputs`` is a list of (low input, high input) tuples, one for
+    each color channel, or a single tuple applied to all color channels.
+    """
+    lookup_tables = [
+      _get_levels_lookup_table(low_input, high_input) for low_input, high_input in channel_inputs]
+
+    num_channels = self._thumbnail.get_n_channels()
+    num_color_channels = num_channels - 1 if self._thumbnail.get_has_alpha() else num_channels
+    if len(lookup_tables) == 1:
+      lookup_tables *= num_color_channels
+
+    clipped_pixels = bytearray(self._thumbnail_pixels)
+    rowstride = self._thumbnail.get_rowstride()
+
+    for row_start in range(0, len(clipped_pixels), rowstride):
+      row_end = row_start + self._thumbnail.get_width() * num_channels
+      for channel, lookup_table in enumerate(lookup_tables[:num_color_channels]):
+        clipped_pixels[row_start + channel:row_end:num_channels] = (
+          self._thumbnail_pixels[row_start + channel:row_end:num_channels].translate(
+            lookup_table))
+
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+      GLib.Bytes.new(bytes(clipped_pixels)),
+      self._thumbnail.get_colorspace(),
+      self._thumbnail.get_has_alpha(),
+      self._thumbnail.get_bits_per_sample(),
+      self._thumbnail.get_width(),
+      self._thumbnail.get_height(),
+      self._thumbnail.get_rowstride(),
+    )
+
+
+def _get_levels_lookup_table(low_input, high_input):
+  """Returns a 256-byte table mapping 8-bit sRGB values to values with levels
+  applied in linear light, usable with `bytes.translate`.
+  """
+  input_range = high_input - low_input
+
+  lookup_table = bytearray(256)
+
+  for value in range(256):
+    linear_value = color_clip.srgb_to_linear(value / 255)
+
+    if input_range > 0:
+      linear_value = (linear_value - low_input) / input_range
+    else:
+      linear_value = 1.0 if linear_value >= high_input else 0.0
+
+    lookup_table[value] = round(
+      color_clip.linear_to_srgb(min(max(linear_value, 0.0), 1.0)) * 255)
+
+  return bytes(lookup_table)
@@ -4,18 +4,17 @@
 from collections.abc import Iterable
 import functools
 import inspect
+import os
 import sys
+import threading
 from typing import Callable, List, Optional, Tuple, Type, Union
 
 import gi
 
-gi.require_version('Gegl', '0.4')
-from gi.repository import Gegl
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp
-gi.require_version('GimpUi', '3.0')
-from gi.repository import GimpUi
 from gi.repository import GLib
+from gi.repository import GObject
 
 
 _PROCEDURE_NAMES_AND_DATA = {}
@@ -23,6 +22,10 @@ _USE_LOCALE = False
 _INIT_PROCEDURES_FUNC: Optional[Callable] = None
 _QUIT_FUNC: Optional[Callable] = None
 
+_INITIALIZED_LIBRARIES = set()
+
+_PDB_CALL_MEMO: Optional['PdbCallMemo'] = None
+
 
 def register_procedure(
       procedure: Callable,
@@ -45,6 +48,8 @@ def register_procedure(
       interpreter_name: Optional[str] = None,
       extract_func: Optional[Callable] = None,
       extract_data: Optional[Iterable] = None,
+      persistent: bool = False,
+      memoize_pdb_calls: bool = False,
 ):
   # noinspection PyUnresolvedReferences
   """Registers a function as a GIMP procedure.
@@ -185,6 +190,22 @@ def register_procedure(
     extract_data: See `Gimp.VectorLoadProcedure.new()` for more information.
       Applicable only if ``procedure_type`` is `Gimp.VectorLoadProcedure` and
       otherwise ignored.
+    persistent: If ``True``, the procedure can additionally be served by a
+      persistent extension instead of by a new plug-in process on each call.
+      The procedure is registered as usual. The extension (named
+      ``extension-<plug-in file name>``) is not started by GIMP; once it is
+      run (e.g. at the beginning of a batch script), it installs all
+      persistent procedures of the plug-in as temporary procedures under
+      their usual names, which take precedence over the regular procedures
+      for the rest of the GIMP session. Interpreter startup and the
+      initialization of `GimpUi` and `Gegl` thus happen only once, and
+      module-level state (e.g. caches) is kept between calls.
+    memoize_pdb_calls: If ``True``, results of pure queries made via
+      `query_pdb` while the procedure runs are memoized by (procedure,
+      arguments), so that identical queries call the PDB only once. The
+      results are discarded when the run ends and, for a particular object
+      (e.g. a drawable), when the object is modified via `modify_pdb`. See
+      `PdbCallMemo` for details.
 
   Example:
 
@@ -258,6 +279,117 @@ def register_procedure(
   proc_dict['interpreter_name'] = interpreter_name
   proc_dict['extract_func'] = extract_func
   proc_dict['extract_data'] = extract_data
+  proc_dict['persistent'] = persistent
+  proc_dict['memoize_pdb_calls'] = memoize_pdb_calls
+
+
+class PdbCallMemo:
+  """Results of pure query PDB calls made during a single procedure run.
+
+  A query is identified by the object it is called on (e.g. a drawable), the
+  name of the procedure (method) and the arguments, which must be hashable.
+  Queries with unhashable arguments are not memoized.
+
+  Modifying an object drops the memoized results of queries on that object.
+  Modifying any other object, such as an image (e.g. converting its
+  precision), drops all memoized results, since it may affect the results of
+  queries on any drawable.
+
+  The memo may be used from multiple threads.
+  """
+
+  def __init__(self):
+    self.num_hits = 0
+    self.num_misses = 0
+
+    self._results = {}
+    self._lock = threading.Lock()
+
+  def query(self, func, *args, on_pdb_call=None):
+    """Returns the result of calling ``func`` (a bound method performing a
+    pure query) with ``args``, calling the PDB only if the same query was not
+    made before. ``on_pdb_call`` is called with no arguments if the PDB is
+    called.
+    """
+    key = (func.__self__, func.__name__, args)
+
+    try:
+      with self._lock:
+        if key in self._results:
+          self.num_hits += 1
+          return self._results[key]
+    except TypeError:
+      # Unhashable arguments
+      return _call_pdb(func, args, on_pdb_call)
+
+    result = _call_pdb(func, args, on_pdb_call)
+
+    with self._lock:
+      self.num_misses += 1
+      self._results[key] = result
+
+    return result
+
+  def invalidate(self, obj):
+    """Drops memoized results of queries on ``obj`` (all results if ``obj`` is
+    not a drawable).
+    """
+    with self._lock:
+      if isinstance(obj, Gimp.Drawable):
+        for key in [key for key in self._results if key[0] == obj]:
+          del self._results[key]
+      else:
+        self._results.clear()
+
+  def get_counts(self):
+    with self._lock:
+      return {'hits': self.num_hits, 'misses': self.num_misses}
+
+
+def query_pdb(func: Callable, *args, on_pdb_call: Optional[Callable] = None):
+  """Calls ``func``, a bound method of a GIMP object performing a pure PDB
+  query (e.g. `Gimp.Drawable.histogram`), with ``args`` and returns the result.
+
+  If the running procedure was registered with ``memoize_pdb_calls=True``,
+  the result is memoized for the rest of the run, see `PdbCallMemo`.
+  ``on_pdb_call`` is called with no arguments each time the PDB is actually
+  called, e.g. to count PDB calls.
+  """
+  memo = _PDB_CALL_MEMO
+  if memo is None:
+    return _call_pdb(func, args, on_pdb_call)
+  else:
+    return memo.query(func, *args, on_pdb_call=on_pdb_call)
+
+
+def modify_pdb(func: Callable, *args):
+  """Calls ``func``, a bound method of a GIMP object modifying the object
+  (e.g. `Gimp.Drawable.levels`), with ``args`` and returns the result.
+
+  Results of queries on the object memoized during the current run are
+  dropped, see `PdbCallMemo.invalidate`.
+  """
+  memo = _PDB_CALL_MEMO
+  if memo is not None:
+    memo.invalidate(func.__self__)
+
+  return func(*args)
+
+
+def get_pdb_call_memo_counts() -> Optional[dict]:
+  """Returns a dictionary with the number of ``'hits'`` and ``'misses'`` of
+  the memoized PDB queries of the current run, or ``None`` if the running
+  procedure does not memoize PDB calls.
+  """
+  memo = _PDB_CALL_MEMO
+  return memo.get_counts() if memo is not None else None
+
+
+def _call_pdb(func, args, on_pdb_call):
+  result = func(*args)
+  if on_pdb_call is not None:
+    on_pdb_call()
+  return result
 
 
 def _parse_and_check_parameters(parameters):
@@ -375,15 +507,27 @@ class PyPlugIn(Gimp.PlugIn):
 
 
 def _do_query_procedures(_plugin_instance):
-  return list(_PROCEDURE_NAMES_AND_DATA)
+  proc_names = list(_PROCEDURE_NAMES_AND_DATA)
 
+  if _get_persistent_proc_names():
+    proc_names.append(_get_extension_name())
 
-def _do_create_procedure(plugin_instance, proc_name):
-  if proc_name in _PROCEDURE_NAMES_AND_DATA:
+  return proc_names
+
+
+def _do_create_procedure(plugin_instance, proc_name, temporary=False):
+  if proc_name == _get_extension_name() and _get_persistent_proc_names():
+    return _create_extension_procedure(plugin_instance, proc_name)
+  elif proc_name in _PROCEDURE_NAMES_AND_DATA:
     proc_dict = _PROCEDURE_NAMES_AND_DATA[proc_name]
   else:
     return None
 
+  if temporary:
+    pdb_procedure_type = Gimp.PDBProcType.TEMPORARY
+  else:
+    pdb_procedure_type = proc_dict['pdb_procedure_type']
+
   if not inspect.isclass(proc_dict['procedure_type']):
     raise TypeError(f"{proc_dict['procedure_type']} is not a valid class type")
 
@@ -392,13 +536,14 @@ def _do_create_procedure(plugin_instance, proc_name):
     proc_dict['procedure_type'],
     proc_dict['init_ui'],
     proc_dict['init_gegl'],
+    proc_dict['memoize_pdb_calls'],
   )
 
   if issubclass(proc_dict['procedure_type'], Gimp.ExportProcedure):
     procedure = proc_dict['procedure_type'].new(
       plugin_instance,
       proc_name,
-      proc_dict['pdb_procedure_type'],
+      pdb_procedure_type,
       proc_dict['export_metadata'],
       procedure_wrapper,
       proc_dict['run_data'],
@@ -408,7 +553,7 @@ def _do_create_procedure(plugin_instance, proc_name):
       plugin_instance,
       proc_name,
       proc_dict['interpreter_name'],
-      proc_dict['pdb_procedure_type'],
+      pdb_procedure_type,
       procedure_wrapper,
       proc_dict['run_data'],
     )
@@ -416,7 +561,7 @@ def _do_create_procedure(plugin_instance, proc_name):
     procedure = proc_dict['procedure_type'].new(
       plugin_instance,
       proc_name,
-      proc_dict['pdb_procedure_type'],
+      pdb_procedure_type,
       proc_dict['extract_func'],
       proc_dict['extract_data'],
       procedure_wrapper,
@@ -426,7 +571,7 @@ def _do_create_procedure(plugin_instance, proc_name):
     procedure = proc_dict['procedure_type'].new(
       plugin_instance,
       proc_name,
-      proc_dict['pdb_procedure_type'],
+      pdb_procedure_type,
       procedure_wrapper,
       proc_dict['run_data'],
     )
@@ -452,11 +597,13 @@ def _do_create_procedure(plugin_instance, proc_name):
       param_type = params.pop(0)
       _get_add_param_func(procedure, param_type, 'aux_argument')(name, *params)
 
-  if proc_dict['menu_label'] is not None:
+  # Temporary procedures are not added to menus again, menus keep running the
+  # regular procedures.
+  if proc_dict['menu_label'] is not None and not temporary:
     procedure.set_menu_label(proc_dict['menu_label'])
 
   menu_path = proc_dict['menu_path']
-  if menu_path is not None:
+  if menu_path is not None and not temporary:
     if isinstance(menu_path, str):
       procedure.add_menu_path(menu_path)
     elif isinstance(menu_path, Iterable):
@@ -488,6 +635,56 @@ def _do_create_procedure(plugin_instance, proc_name):
   return procedure
 
 
+def _get_persistent_proc_names():
+  return [
+    proc_name for proc_name, proc_dict in _PROCEDURE_NAMES_AND_DATA.items()
+    if proc_dict['persistent']]
+
+
+def _get_extension_name():
+  plugin_name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+  return f'extension-{plugin_name}'.replace('_', '-').lower()
+
+
+def _create_extension_procedure(plugin_instance, proc_name):
+  procedure = Gimp.Procedure.new(
+    plugin_instance, proc_name, Gimp.PDBProcType.PERSISTENT, _run_extension, None)
+
+  procedure.set_documentation(
+    'Serves procedures of the plug-in from a single long-running process.',
+    ('The procedures are installed as temporary procedures and run in this'
+     ' process for the rest of the GIMP session. Run this procedure once,'
+     ' e.g. at the beginning of a batch script.'),
+    proc_name)
+
+  # GIMP automatically starts only extensions without arguments.
+  _get_add_param_func(procedure, 'enum', 'argument')(
+    'run-mode',
+    'Run mode',
+    'The run mode',
+    Gimp.RunMode,
+    Gimp.RunMode.NONINTERACTIVE,
+    GObject.ParamFlags.READWRITE,
+  )
+
+  return procedure
+
+
+def _run_extension(procedure, _config, _data):
+  plugin_instance = procedure.get_plug_in()
+
+  for proc_name in _get_persistent_proc_names():
+    plugin_instance.add_temp_procedure(
+      _do_create_procedure(plugin_instance, proc_name, temporary=True))
+
+  procedure.extension_ready()
+
+  # Each iteration waits for and runs a single call to a temporary procedure.
+  # The process exits when GIMP quits.
+  while True:
+    plugin_instance.persistent_process(0)
+
+
 def _get_add_param_func(procedure, param_type, param_group):
   try:
     return getattr(procedure, f'add_{param_type}_{param_group}')
@@ -495,7 +692,7 @@ def _get_add_param_func(procedure, param_type, param_group):
     raise ValueError(f'type "{param_type}" is not valid')
 
 
-def _get_procedure_wrapper(func, procedure_type, init_ui, init_gegl):
+def _get_procedure_wrapper(func, procedure_type, init_ui, init_gegl, memoize_pdb_calls=False):
   @functools.wraps(func)
   def func_wrapper(*procedure_and_args):
     procedure = procedure_and_args[0]
@@ -509,13 +706,27 @@ def _get_procedure_wrapper(func, procedure_type, init_ui, init_gegl):
          for prop in config.list_properties() if prop.name == 'run-mode'),
         Gimp.RunMode.NONINTERACTIVE)
 
-    if init_ui and run_mode == Gimp.RunMode.INTERACTIVE:
+    # `GimpUi` and `Gegl` are imported only when needed, which avoids loading
+    # the user interface libraries during plug-in queries and non-interactive
+    # runs.
+    # The libraries are initialized only once per process, which matters for
+    # persistent procedures serving many calls.
+    if (init_ui and run_mode == Gimp.RunMode.INTERACTIVE
+        and 'GimpUi' not in _INITIALIZED_LIBRARIES):
+      gi.require_version('GimpUi', '3.0')
+      from gi.repository import GimpUi
+
       GimpUi.init(procedure.get_name())
+      _INITIALIZED_LIBRARIES.add('GimpUi')
+
+    if init_gegl and 'Gegl' not in _INITIALIZED_LIBRARIES:
+      gi.require_version('Gegl', '0.4')
+      from gi.repository import Gegl
 
-    if init_gegl:
       Gegl.init()
+      _INITIALIZED_LIBRARIES.add('Gegl')
 
-    return_values = func(*procedure_and_args)
+    return_values = _run_procedure(func, procedure_and_args, memoize_pdb_calls)
 
     if return_values is None:
       return_values = []
@@ -543,3 +754,20 @@ def _get_procedure_wrapper(func, procedure_type, init_ui, init_gegl):
     return formatted_return_values
 
   return func_wrapper
+
+
+def _run_procedure(func, procedure_and_args, memoize_pdb_calls):
+  global _PDB_CALL_MEMO
+
+  if not memoize_pdb_calls:
+    return func(*procedure_and_args)
+
+  # The previous memo is restored in case this procedure was called from
+  # another procedure of the same process.
+  previous_memo = _PDB_CALL_MEMO
+  _PDB_CALL_MEMO = PdbCallMemo()
+
+  try:
+    return func(*procedure_and_args)
+  finally:
+    _PDB_CALL_MEMO = previous_memo
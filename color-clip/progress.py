@@ -0,0 +1,208 @@
+"""Progress reporting and cancellation of Color Clip runs."""
+
+import concurrent.futures
+import threading
+import time
+
+import gi
+gi.require_version('Gimp', '3.0')
+from gi.repository import Gimp
+from gi.repository import GLib
+
+import histograms
+
+
+class Canceled(Exception):
+  """Raised between two units of work of a run that was canceled."""
+
+
+class Progress:
+  """Progress of a run, reported to GIMP via `Gimp.progress_init` and
+  `Gimp.progress_update`.
+
+  A run consists of tasks (e.g. analyzing a drawable) created by `add_task`,
+  each contributing equally to the overall progress. Tasks are divided into
+  units of work (e.g. chunks of pixels or PDB queries) and may run in separate
+  threads. Between units, tasks call `TaskProgress.check`, which raises
+  `Canceled` once `cancel` is called, e.g. from the user interface.
+
+  To limit the number of PDB calls, GIMP is updated at most once per
+  ``update_interval`` seconds.
+  """
+
+  def __init__(self, text, update_interval=0.1):
+    self.update_interval = update_interval
+
+    self._tasks = []
+    self._canceled = threading.Event()
+    self._lock = threading.Lock()
+    self._last_update_time = None
+
+    with histograms.gimp_lock:
+      Gimp.progress_init(text)
+
+  @property
+  def is_canceled(self):
+    return self._canceled.is_set()
+
+  @property
+  def fraction(self):
+    with self._lock:
+      return self._get_fraction()
+
+  def add_task(self):
+    """Creates, stores and returns a `TaskProgress` object for a new task."""
+    task = TaskProgress(self)
+
+    with self._lock:
+      self._tasks.append(task)
+
+    return task
+
+  def cancel(self):
+    """Requests canceling the run. Tasks stop at the next call to
+    `TaskProgress.check`. May be called from any thread.
+    """
+    self._canceled.set()
+
+  def end(self):
+    with histograms.gimp_lock:
+      Gimp.progress_end()
+
+  def _update(self, is_pulse=False, force=False):
+    # GIMP is called without holding `_lock`, so that tasks holding the GIMP
+    # lock (e.g. while applying levels) cannot deadlock with other tasks.
+    with self._lock:
+      current_time = time.perf_counter()
+      if (not force
+          and self._last_update_time is not None
+          and current_time - self._last_update_time < self.update_interval):
+        return
+
+      self._last_update_time = current_time
+      fraction = self._get_fraction()
+
+    with histograms.gimp_lock:
+      if is_pulse:
+        Gimp.progress_pulse()
+      else:
+        Gimp.progress_update(fraction)
+
+  def _get_fraction(self):
+    if not self._tasks:
+      return 0.0
+
+    return sum(task._get_fraction() for task in self._tasks) / len(self._tasks)
+
+
+class TaskProgress:
+  """Progress of a single task of a `Progress` object.
+
+  If the number of units of the task is known, the task is started by
+  `start` and each finished unit is reported by `advance`. Otherwise, `pulse`
+  indicates that the task is still running.
+
+  All methods may be called from multiple threads, e.g. when bands of a
+  drawable are analyzed in parallel.
+  """
+
+  def __init__(self, progress):
+    self._progress = progress
+
+    self._num_units = 0
+    self._num_done_units = 0
+    self._is_done = False
+
+  @property
+  def is_canceled(self):
+    return self._progress.is_canceled
+
+  def start(self, num_units, num_done_units=0):
+    """Sets the number of units of the task, of which ``num_done_units`` are
+    already done (e.g. by a previous run that was canceled).
+    """
+    with self._progress._lock:
+      self._num_units = num_units
+      self._num_done_units = num_done_units
+
+    self._progress._update()
+
+  def advance(self, num_units=1):
+    with self._progress._lock:
+      self._num_done_units += num_units
+
+    self._progress._update()
+
+  def pulse(self):
+    self._progress._update(is_pulse=True)
+
+  def finish(self):
+    with self._progress._lock:
+      self._is_done = True
+
+    self._progress._update(force=True)
+
+  def check(self):
+    """Raises `Canceled` if the run was canceled."""
+    if self._progress.is_canceled:
+      raise Canceled
+
+  def _get_fraction(self):
+    if self._is_done:
+      return 1.0
+    elif self._num_units > 0:
+      return min(self._num_done_units / self._num_units, 1.0)
+    else:
+      return 0.0
+
+
+def run_in_background(func, on_done):
+  """Calls ``func`` in a separate thread and returns its
+  `concurrent.futures.Future`.
+
+  Once ``func`` returns or raises an exception, ``on_done`` is called with the
+  future from the GLib main loop, i.e. in the thread running the user
+  interface.
+  """
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  future = executor.submit(func)
+  # The thread exits once `func` returns.
+  executor.shutdown(wait=False)
+
+  future.add_done_callback(lambda future_: GLib.idle_add(_call_once, on_done, future_))
+
+  return future
+
+
+def _call_once(func, *args):
+  func(*args)
+  # Removes the idle source.
+  return False
+
+
+def run_in_dialog(dialog, progress, func):
+  """Calls ``func`` in a separate thread while keeping ``dialog`` responsive
+  and returns its return value.
+
+  The dialog contents and its OK button are made insensitive. Any other
+  response of the dialog (Cancel or closing the dialog) cancels ``progress``.
+  Exceptions raised by ``func``, such as `Canceled`, are propagated.
+  """
+  gi.require_version('Gtk', '3.0')
+  from gi.repository import Gtk
+
+  dialog.get_content_area().set_sensitive(False)
+  dialog.set_response_sensitive(Gtk.ResponseType.OK, False)
+
+  handler_id = dialog.connect('response', lambda *_args: progress.cancel())
+
+  try:
+    # `on_done` only wakes up the main loop of the dialog once `func` returns.
+    future = run_in_background(func, lambda _future: None)
+
+    while not future.done():
+      Gtk.main_iteration_do(True)
+
+    return future.result()
+  finally:
+    dialog.disconnect(handler_id)
@@ -0,0 +1,153 @@
+"""Mergeable quantile sketch for pixel values of arbitrary range."""
+
+import math
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+
+class QuantileSketch:
+  """Quantile sketch with relative accuracy, built in a single streaming pass.
+
+  The sketch follows the DDSketch algorithm: each value is assigned to a
+  bucket whose bounds grow geometrically with the value magnitude, so that
+  any quantile is answered with a relative error of at most
+  ``relative_accuracy``. Positive and negative values are kept in separate
+  bucket stores and values whose magnitude is below ``min_value`` are counted
+  as zero. This makes the sketch suitable for high dynamic range pixel values
+  outside the [0, 1] range.
+
+  The number of buckets per store is limited to ``max_num_buckets``; if
+  exceeded, the buckets of the lowest magnitudes are collapsed into one, which
+  keeps memory usage constant while preserving accuracy for the remaining
+  buckets.
+
+  Sketches with the same parameters can be merged via `merge`, e.g. when
+  built from chunks of a drawable in parallel or from multiple drawables.
+  """
+
+  def __init__(self, relative_accuracy=0.005, max_num_buckets=4096, min_value=1e-6):
+    self.relative_accuracy = relative_accuracy
+    self.max_num_buckets = max_num_buckets
+    self.min_value = min_value
+
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+
+    self._log_gamma = math.log(self.gamma)
+
+    self.positive_counts = {}
+    self.negative_counts = {}
+    self.zero_count = 0.0
+
+  @property
+  def total_count(self):
+    return (
+      sum(self.positive_counts.values()) + sum(self.negative_counts.values()) + self.zero_count)
+
+  def add(self, values, weights=None):
+    """Adds a NumPy array of values to the sketch, optionally weighted by
+    ``weights`` of the same shape. Non-finite values are ignored.
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if weights is None:
+      weights = np.ones_like(values)
+    else:
+      weights = np.asarray(weights, dtype=np.float64).ravel()
+
+    is_finite = np.isfinite(values)
+    magnitudes = np.abs(values)
+
+    self.zero_count += float(weights[is_finite & (magnitudes < self.min_value)].sum())
+
+    for bucket_counts, mask in [
+          (self.positive_counts, is_finite & (values >= self.min_value)),
+          (self.negative_counts, is_finite & (values <= -self.min_value))]:
+      if not mask.any():
+        continue
+
+      keys = np.ceil(np.log(magnitudes[mask]) / self._log_gamma).astype(np.int64)
+      min_key = int(keys.min())
+      key_counts = np.bincount(keys - min_key, weights=weights[mask])
+
+      for key_offset in np.flatnonzero(key_counts).tolist():
+        key = min_key + key_offset
+        bucket_counts[key] = bucket_counts.get(key, 0.0) + float(key_counts[key_offset])
+
+      self._collapse(bucket_counts)
+
+  def merge(self, other):
+    """Adds the contents of another sketch with the same parameters to this
+    sketch.
+    """
+    if other.gamma != self.gamma or other.min_value != self.min_value:
+      raise ValueError('only sketches with the same parameters can be merged')
+
+    for bucket_counts, other_bucket_counts in [
+          (self.positive_counts, other.positive_counts),
+          (self.negative_counts, other.negative_counts)]:
+      for key, count in other_bucket_counts.items():
+        bucket_counts[key] = bucket_counts.get(key, 0.0) + count
+
+      self._collapse(bucket_counts)
+
+    self.zero_count += other.zero_count
+
+  def get_quantile(self, quantile):
+    """Returns the value at the given quantile in the range [0, 1], or ``None``
+    if the sketch is empty.
+    """
+    values, counts = self.get_buckets()
+    total_count = sum(counts)
+
+    if total_count <= 0:
+      return None
+
+    rank = quantile * total_count
+    cumulative_count = 0.0
+
+    for value, count in zip(values, counts):
+      cumulative_count += count
+      if cumulative_count >= rank and count > 0:
+        return value
+
+    return values[-1]
+
+  def get_buckets(self):
+    """Returns a tuple of (values, counts) lists of all buckets in ascending
+    order of their values.
+
+    Each value is the representative value of the bucket, i.e. a value within
+    ``relative_accuracy`` of any value counted in the bucket.
+    """
+    values = []
+    counts = []
+
+    for key in sorted(self.negative_counts, reverse=True):
+      values.append(-self._get_bucket_value(key))
+      counts.append(self.negative_counts[key])
+
+    if self.zero_count > 0 or not (self.positive_counts or self.negative_counts):
+      values.append(0.0)
+      counts.append(self.zero_count)
+
+    for key in sorted(self.positive_counts):
+      values.append(self._get_bucket_value(key))
+      counts.append(self.positive_counts[key])
+
+    return values, counts
+
+  def _get_bucket_value(self, key):
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def _collapse(self, bucket_counts):
+    if len(bucket_counts) <= self.max_num_buckets:
+      return
+
+    keys = sorted(bucket_counts)
+    num_keys_to_collapse = len(keys) - self.max_num_buckets
+    target_key = keys[num_keys_to_collapse]
+
+    for key in keys[:num_keys_to_collapse]:
+      bucket_counts[target_key] += bucket_counts.pop(key)
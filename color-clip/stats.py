@@ -0,0 +1,135 @@
+"""Performance statistics of Color Clip runs."""
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+_log_lock = threading.Lock()
+
+
+class RunStats:
+  """Timings and counts of a single run of Color Clip on an image.
+
+  Durations of run-wide stages (e.g. precision conversion) are recorded via
+  `measure` and run-wide counters (e.g. memoized PDB queries) via `count`.
+  Statistics of individual drawables are recorded in `DrawableStats` objects
+  created by `add_drawable`.
+  """
+
+  def __init__(self):
+    self.durations = collections.defaultdict(float)
+    self.counts = collections.Counter()
+    self.drawable_stats = []
+
+    self._start_time = time.perf_counter()
+    self._end_time = None
+
+  @property
+  def total_seconds(self):
+    end_time = self._end_time if self._end_time is not None else time.perf_counter()
+    return end_time - self._start_time
+
+  def add_drawable(self, name, drawable_id, num_pixels):
+    """Creates, stores and returns a `DrawableStats` object for a drawable."""
+    drawable_stats = DrawableStats(name, drawable_id, num_pixels)
+    self.drawable_stats.append(drawable_stats)
+    return drawable_stats
+
+  @contextlib.contextmanager
+  def measure(self, stage):
+    """Adds the time spent in the ``with`` block to the duration of
+    ``stage``.
+    """
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.durations[stage] += time.perf_counter() - start_time
+
+  def count(self, name, num=1):
+    """Increments the run-wide counter named ``name`` by ``num``."""
+    self.counts[name] += num
+
+  def finish(self):
+    """Stops measuring the total duration of the run."""
+    self._end_time = time.perf_counter()
+
+  def to_dict(self):
+    return {
+      'total_seconds': self.total_seconds,
+      'stage_seconds': dict(self.durations),
+      'counts': dict(self.counts),
+      'num_pixels': sum(drawable_stats.num_pixels for drawable_stats in self.drawable_stats),
+      'drawables': [drawable_stats.to_dict() for drawable_stats in self.drawable_stats],
+    }
+
+
+class DrawableStats:
+  """Timings and counts of processing a single drawable.
+
+  Both `measure` and `count` may be called from multiple threads, e.g. when
+  bands of the drawable are analyzed in parallel.
+  """
+
+  def __init__(self, name, drawable_id, num_pixels):
+    self.name = name
+    self.drawable_id = drawable_id
+    self.num_pixels = num_pixels
+
+    self.durations = collections.defaultdict(float)
+    self.counts = collections.Counter()
+
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def measure(self, stage):
+    """Adds the time spent in the ``with`` block to the duration of
+    ``stage``.
+    """
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      duration = time.perf_counter() - start_time
+      with self._lock:
+        self.durations[stage] += duration
+
+  def count(self, name, num=1):
+    """Increments the counter named ``name`` (e.g. the number of PDB calls) by
+    ``num``.
+    """
+    with self._lock:
+      self.counts[name] += num
+
+  def to_dict(self):
+    with self._lock:
+      return {
+        'name': self.name,
+        'id': self.drawable_id,
+        'num_pixels': self.num_pixels,
+        'stage_seconds': dict(self.durations),
+        'counts': dict(self.counts),
+      }
+
+
+def count(drawable_stats, name, num=1):
+  """Increments a counter of ``drawable_stats`` if it is not ``None``."""
+  if drawable_stats is not None:
+    drawable_stats.count(name, num)
+
+
+def write_log(filepath, record):
+  """Appends ``record`` as a single line of JSON to the file at ``filepath``.
+
+  The file can be written to from multiple threads or processes, one record
+  per line (the JSON Lines format), so that records from many runs can be
+  aggregated later.
+  """
+  line = json.dumps(record, separators=(',', ':')) + '\n'
+
+  with _log_lock:
+    with open(filepath, 'a', encoding='utf-8') as file:
+      file.write(line)
@@ -56,13 +56,11 @@ _histogram_percentiles_min_black_variable_white = [
   0.999, 1.0, 1.0, 1.0]
 
 
-def _get_black_point_histogram_percentile(
-      _drawable, _histogram_channel, point, _min_point, _max_point):
+def _get_black_point_histogram_percentile(_histogram, point, _min_point, _max_point):
   return _histogram_percentiles_variable_black_max_white[point] * 100.0
 
   
-def _get_white_point_histogram_percentile(
-      _drawable, _histogram_channel, point, _min_point, _max_point):
+def _get_white_point_histogram_percentile(_histogram, point, _min_point, _max_point):
   return _histogram_percentiles_min_black_variable_white[point] * 100.0
 
 
@@ -75,8 +73,7 @@ def _get_white_point_histogram_percentile(
 class TestGetColorClip(unittest.TestCase):
   
   def setUp(self):
-    self.image = None
-    self.drawable = None
+    self.histogram = mock.Mock(min_point=0, max_point=255)
   
   def test_nominal_cases(self):
     self._test_get_color_clip_with_data([
@@ -120,5 +117,22 @@ class TestGetColorClip(unittest.TestCase):
   
   def _test_get_color_clip(self, clip_percentages, expected_color_points):
     self.assertEqual(
-      color_clip.get_color_clip(self.image, self.drawable, *clip_percentages),
+      color_clip.get_color_clip(self.histogram, *clip_percentages),
       expected_color_points)
+
+
+class TestSrgbTransferCurve(unittest.TestCase):
+  
+  def test_endpoints(self):
+    for func in [color_clip.srgb_to_linear, color_clip.linear_to_srgb]:
+      self.assertEqual(func(0.0), 0.0)
+      self.assertAlmostEqual(func(1.0), 1.0)
+  
+  def test_mid_gray(self):
+    self.assertAlmostEqual(color_clip.srgb_to_linear(0.5), 0.21404, places=5)
+    self.assertAlmostEqual(color_clip.linear_to_srgb(0.21404), 0.5, places=5)
+  
+  def test_round_trip(self):
+    for value in range(256):
+      self.assertAlmostEqual(
+        color_clip.linear_to_srgb(color_clip.srgb_to_linear(value / 255)), value / 255)
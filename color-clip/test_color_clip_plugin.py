@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the plug-in script, run with the in-memory GIMP stand-in set up by
+`fake_backend`.
+"""
+
+import contextlib
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from fake_backend import fake_gimp, plugin, run_benchmarks
+
+import numpy as np
+
+import color_clip
+import histograms
+
+
+class TestGetBatchFilepaths(unittest.TestCase):
+
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.dirpath = temp_dir.name
+
+    for filepath in ['photos/a.jpg', 'photos/2024/a.jpg', 'photos/2024/b.png', 'other/a.jpg']:
+      self._create_file(filepath)
+
+  def test_keeps_relative_paths(self):
+    self.assertEqual(
+      plugin._get_batch_filepaths([self._path('photos/**/*.jpg')], self._path('out')),
+      {
+        self._path('photos/2024/a.jpg'): self._path('out/2024/a.jpg'),
+        self._path('photos/a.jpg'): self._path('out/a.jpg'),
+      })
+
+  def test_path_without_wildcards(self):
+    self.assertEqual(
+      plugin._get_batch_filepaths([self._path('photos/2024/b.png')], self._path('out')),
+      {self._path('photos/2024/b.png'): self._path('out/b.png')})
+
+  def test_files_matched_by_multiple_patterns_are_processed_once(self):
+    self.assertEqual(
+      plugin._get_batch_filepaths(
+        [self._path('photos/*.jpg'), self._path('photos/**/a.jpg')], self._path('out')),
+      {
+        self._path('photos/a.jpg'): self._path('out/a.jpg'),
+        self._path('photos/2024/a.jpg'): self._path('out/2024/a.jpg'),
+      })
+
+  def test_colliding_output_files(self):
+    with self.assertRaisesRegex(ValueError, 'other/a.jpg'):
+      plugin._get_batch_filepaths(
+        [self._path('photos/*.jpg'), self._path('other/*.jpg')], self._path('out'))
+
+  def test_output_file_overwriting_input_file(self):
+    with self.assertRaises(ValueError):
+      plugin._get_batch_filepaths([self._path('photos/*.jpg')], self._path('photos'))
+
+  def _create_file(self, filepath):
+    filepath = self._path(filepath)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'w'):
+      pass
+
+  def _path(self, filepath):
+    return os.path.join(self.dirpath, *filepath.split('/'))
+
+
+class TestGetColorClipsWithoutPixels(unittest.TestCase):
+
+  def setUp(self):
+    self.layer = run_benchmarks.create_drawable(64, 64, 'u8', 'gaussian')
+
+  def test_fully_transparent_drawable(self):
+    pixels = self.layer.pixels.copy()
+    pixels[..., 3] = 0
+    self.layer = fake_gimp.FakeLayer(pixels, 'u8')
+
+    for use_numpy in [True, False]:
+      with self.subTest(use_numpy=use_numpy), _use_numpy(use_numpy):
+        with self.assertRaisesRegex(ValueError, 'no pixels'):
+          plugin._get_color_clips([self.layer], 1.0, 1.0, 255, 1024 * 1024)
+
+  def test_region_outside_drawable(self):
+    with self.assertRaisesRegex(ValueError, 'no pixels'):
+      plugin._get_color_clips(
+        [self.layer], 1.0, 1.0, 255, 1024 * 1024, regions=[(100, 100, 10, 10)])
+
+
+class TestGetColorClipsWithHistograms(unittest.TestCase):
+
+  def setUp(self):
+    self.layers = [
+      run_benchmarks.create_drawable(64, 64, 'u8', shape, seed=index)
+      for index, shape in enumerate(['gaussian', 'bimodal'])]
+
+  def test_only_drawables_without_histograms_are_analyzed(self):
+    color_clips, histogram_lists = plugin._get_color_clips(
+      self.layers, 1.0, 1.0, 255, 1024 * 1024, return_histograms=True)
+
+    with mock.patch.object(
+          histograms, 'get_histogram', wraps=histograms.get_histogram) as get_histogram_spy:
+      reused_color_clips, reused_histogram_lists = plugin._get_color_clips(
+        self.layers,
+        1.0,
+        1.0,
+        255,
+        1024 * 1024,
+        return_histograms=True,
+        histogram_lists=[histogram_lists[0], None])
+
+    self.assertEqual(
+      [call.args[0] for call in get_histogram_spy.call_args_list], [self.layers[1]])
+    self.assertIs(reused_histogram_lists[0], histogram_lists[0])
+    self.assertEqual(reused_color_clips, color_clips)
+
+
+class TestGetGivenColorClips(unittest.TestCase):
+
+  def setUp(self):
+    self.layer = run_benchmarks.create_drawable(16, 16, 'u8', 'gaussian')
+    self.channel = fake_gimp.FakeChannel(np.zeros((16, 16, 1), dtype=np.uint8), 'u8')
+
+  def test_single_pair_for_all_drawables(self):
+    self.assertEqual(
+      plugin._get_given_color_clips([self.layer, self.channel], [0.1], [0.9], False),
+      [(0.1, 0.9), (0.1, 0.9)])
+
+  def test_single_pair_for_all_channels(self):
+    self.assertEqual(
+      plugin._get_given_color_clips([self.layer, self.channel], [0.1], [0.9], True),
+      [[(0.1, 0.9)] * 3, [(0.1, 0.9)]])
+
+  def test_pair_for_each_drawable(self):
+    self.assertEqual(
+      plugin._get_given_color_clips([self.layer, self.channel], [0.1, 0.2], [0.9, 0.8], False),
+      [(0.1, 0.9), (0.2, 0.8)])
+
+  def test_pair_for_each_channel(self):
+    self.assertEqual(
+      plugin._get_given_color_clips(
+        [self.layer, self.channel], [0.1, 0.2, 0.3, 0.4], [0.9, 0.8, 0.7, 0.6], True),
+      [[(0.1, 0.9), (0.2, 0.8), (0.3, 0.7)], [(0.4, 0.6)]])
+
+  def test_mismatched_number_of_points(self):
+    with self.assertRaisesRegex(ValueError, 'must be the same'):
+      plugin._get_given_color_clips([self.layer], [0.1, 0.2], [0.9], False)
+
+    with self.assertRaisesRegex(ValueError, 'Expected 1 or 2 pairs'):
+      plugin._get_given_color_clips([self.layer, self.channel], [0.1] * 3, [0.9] * 3, False)
+
+  def test_points_outside_range(self):
+    with self.assertRaisesRegex(ValueError, r'within \[0, 1\]'):
+      plugin._get_given_color_clips([self.layer], [-0.1], [0.9], False)
+
+    with self.assertRaisesRegex(ValueError, r'within \[0, 1\]'):
+      plugin._get_given_color_clips([self.layer], [0.1], [1.5], False)
+
+    self.assertEqual(
+      plugin._get_given_color_clips(
+        [self.layer], [-0.1], [1.5], False, allow_out_of_range=True),
+      [(-0.1, 1.5)])
+
+
+class TestAnalyzeDrawables(unittest.TestCase):
+
+  def setUp(self):
+    self.layer = run_benchmarks.create_drawable(64, 64, 'u8', 'gaussian')
+    self.config = _Config({
+      'clip-percent-black': 1.0,
+      'clip-percent-white': 1.0,
+      'memory-budget': 1,
+      'sampling-tolerance': 0.0,
+      'use-histogram-cache': False,
+      'analysis-region': 'selection',
+      'per-channel': False,
+      'sequence-mode': 'none',
+      'smoothing-window': 1,
+    })
+
+  def test_pdb_points_of_non_linear_image_are_in_linear_light(self):
+    image = self.layer.get_image()
+
+    with _use_numpy(False):
+      linear_color_clips = plugin._analyze_drawables(image, [self.layer], self.config)
+
+      image.precision = fake_gimp.Precision.U8_NON_LINEAR
+      try:
+        non_linear_color_clips = plugin._analyze_drawables(image, [self.layer], self.config)
+      finally:
+        image.precision = fake_gimp.Precision.U8_LINEAR
+
+    black_point, white_point = linear_color_clips[0]
+    self.assertEqual(
+      non_linear_color_clips,
+      [(color_clip.srgb_to_linear(black_point), color_clip.srgb_to_linear(white_point))])
+
+
+class TestApplyColorClip(unittest.TestCase):
+
+  def setUp(self):
+    values = np.linspace(-0.5, 1.5, 256, dtype=np.float32).reshape(16, 16)
+    self.pixels = np.stack([values, values.T, values[::-1], np.full((16, 16), 0.8)], axis=2)
+
+  def test_linear_light_keeps_values_outside_range(self):
+    layer = fake_gimp.FakeLayer(self.pixels.astype(np.float32), 'float')
+
+    plugin._apply_color_clip(layer, (0.2, 0.7), 1024 * 1024, False, False, True)
+
+    np.testing.assert_allclose(
+      layer.pixels[..., :3], (self.pixels[..., :3] - 0.2) / 0.5, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(layer.pixels[..., 3], self.pixels[..., 3])
+
+  def test_per_channel(self):
+    channel_inputs = [(0.0, 1.0), (-0.5, 1.5), (0.5, 1.0)]
+    layer = fake_gimp.FakeLayer(self.pixels.astype(np.float32), 'float')
+
+    plugin._apply_color_clip(layer, channel_inputs, 1024 * 1024, True, False, True)
+
+    for component_index, (low_input, high_input) in enumerate(channel_inputs):
+      np.testing.assert_allclose(
+        layer.pixels[..., component_index],
+        (self.pixels[..., component_index] - low_input) / (high_input - low_input),
+        rtol=1e-6,
+        atol=1e-6)
+
+
+class TestAnalysisRegionWithoutNumpy(unittest.TestCase):
+
+  def setUp(self):
+    self.image = _Image(fake_gimp.Precision.U8_LINEAR)
+    self.layer = run_benchmarks.create_drawable(64, 64, 'u8', 'gaussian')
+    self.layer._image = self.image
+    self.config = _Config({
+      'clip-percent-black': 1.0,
+      'clip-percent-white': 1.0,
+      'process-drawables-only': False,
+      'non-destructive': False,
+      'memory-budget': 1,
+      'sampling-tolerance': 0.0,
+      'use-histogram-cache': False,
+      'analysis-region': 'selection',
+      'region-x': 0,
+      'region-y': 0,
+      'region-width': 16,
+      'region-height': 16,
+      'per-channel': False,
+      'sequence-mode': 'none',
+      'smoothing-window': 1,
+    })
+
+  def test_region_other_than_selection_is_rejected(self):
+    for analysis_region in ['rectangle', 'drawable']:
+      with self.subTest(analysis_region=analysis_region), _use_numpy(False):
+        self.config.properties['analysis-region'] = analysis_region
+
+        with self.assertRaisesRegex(ValueError, 'require NumPy'):
+          plugin._analyze_drawables(self.image, [self.layer], self.config)
+
+  def test_procedure_reports_calling_error(self):
+    self.config.properties['analysis-region'] = 'drawable'
+
+    with _use_numpy(False), mock.patch.object(
+          plugin.Gimp, 'PDBStatusType', create=True) as pdb_status_type:
+      status, message = plugin.python_fu_color_clip(
+        None, None, self.image, [self.layer], self.config, None)
+
+    self.assertIs(status, pdb_status_type.CALLING_ERROR)
+    self.assertIn('require NumPy', message)
+    self.assertEqual(self.image.undo_group_depth, 0)
+
+
+class TestDeferredImports(unittest.TestCase):
+
+  def test_modules_loading_numpy_or_gegl_are_not_imported_with_plugin(self):
+    for module_name in ['histograms', 'levels', 'preview', 'progress']:
+      with self.subTest(module_name=module_name):
+        self.assertFalse(hasattr(plugin, module_name))
+
+  def test_default_memory_budget(self):
+    memory_budget_argument = next(
+      argument for argument in plugin._clip_arguments if argument[1] == 'memory-budget')
+
+    self.assertEqual(memory_budget_argument[-2], histograms.DEFAULT_MEMORY_BUDGET // (1024 * 1024))
+
+
+class TestSmoothColorClips(unittest.TestCase):
+
+  def test_centered_window(self):
+    self._assert_color_clips_equal(
+      plugin._smooth_color_clips([(0.0, 0.3), (0.3, 0.6), (0.6, 0.9), (0.3, 0.9)], 3, False),
+      [
+        (0.15, 0.45),
+        (0.3, 0.6),
+        (0.4, 0.8),
+        (0.45, 0.9),
+      ])
+
+  def test_even_window(self):
+    self._assert_color_clips_equal(
+      plugin._smooth_color_clips([(0.0, 0.4), (0.2, 0.6), (0.4, 0.8)], 2, False),
+      [(0.1, 0.5), (0.3, 0.7), (0.4, 0.8)])
+
+  def test_window_of_one_keeps_points(self):
+    color_clips = [(0.1, 0.9), (0.2, 0.8)]
+
+    self.assertEqual(plugin._smooth_color_clips(color_clips, 1, False), color_clips)
+
+  def test_window_larger_than_sequence(self):
+    self._assert_color_clips_equal(
+      plugin._smooth_color_clips([(0.0, 0.4), (0.2, 0.8)], 5, False),
+      [(0.1, 0.6), (0.1, 0.6)])
+
+  def test_per_channel(self):
+    self._assert_color_clips_equal(
+      plugin._smooth_color_clips(
+        [[(0.0, 0.4), (0.2, 0.6)], [(0.2, 0.8), (0.4, 1.0)]], 2, True),
+      [[(0.1, 0.6), (0.3, 0.8)], [(0.2, 0.8), (0.4, 1.0)]])
+
+  def _assert_color_clips_equal(self, color_clips, expected_color_clips):
+    np.testing.assert_allclose(color_clips, expected_color_clips)
+
+
+class _Image(fake_gimp.Image):
+
+  def __init__(self, precision):
+    super().__init__(precision)
+
+    self.undo_group_depth = 0
+
+  def undo_group_start(self):
+    self.undo_group_depth += 1
+
+  def undo_group_end(self):
+    self.undo_group_depth -= 1
+
+
+class _Config:
+
+  def __init__(self, properties):
+    self.properties = properties
+
+  def get_property(self, name):
+    return self.properties[name]
+
+
+@contextlib.contextmanager
+def _use_numpy(use_numpy):
+  orig_np = histograms.np
+  if not use_numpy:
+    histograms.np = None
+
+  try:
+    yield
+  finally:
+    histograms.np = orig_np
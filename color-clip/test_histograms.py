@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of `histograms`, run with the in-memory GIMP stand-in set up by
+`fake_backend`.
+"""
+
+import unittest
+import unittest.mock as mock
+
+from fake_backend import fake_gimp, run_benchmarks
+
+import numpy as np
+
+import color_clip
+import histograms
+import stats
+
+
+def _create_layer(values):
+  pixels = np.concatenate(
+    [np.repeat(values[..., np.newaxis], 3, axis=2), np.full(values.shape + (1,), 255)], axis=2)
+  return fake_gimp.FakeLayer(pixels.astype(np.uint8), 'u8')
+
+
+def _create_layer_with_flat_areas(precision):
+  # A cut-out object surrounded by transparent tiles, with a column of tiles of
+  # a single opaque color at the left.
+  layer = run_benchmarks.create_drawable(512, 256, precision, 'cutout')
+  pixels = layer.pixels.copy()
+  pixels[:, :128] = np.array([0.3, 0.6, 0.9, 1.0]) * (
+    1.0 if precision == 'float' else np.iinfo(pixels.dtype).max)
+  return fake_gimp.FakeLayer(pixels, precision)
+
+
+class TestSampledHistogram(unittest.TestCase):
+
+  def test_regular_pattern_is_not_aliased(self):
+    # Dark columns at the same spacing as the sampled cells.
+    tolerance = 2.0
+    values = np.full((512, 512), 200)
+    values[:, 3::7] = 10
+    layer = _create_layer(values)
+
+    histogram = histograms.get_histogram(layer, 0, 255, sampling_tolerance=tolerance)
+
+    self.assertAlmostEqual(histogram.get_percentile(0, 10), 100 / 7, delta=tolerance)
+
+  def test_estimate_within_tolerance(self):
+    tolerance = 2.0
+    layer = run_benchmarks.create_drawable(512, 512, 'u8', 'bimodal')
+
+    exact_histogram = histograms.get_histogram(layer, 0, 255)
+    histogram = histograms.get_histogram(layer, 0, 255, sampling_tolerance=tolerance)
+
+    for point in range(256):
+      self.assertAlmostEqual(
+        histogram.get_percentile(0, point),
+        exact_histogram.get_percentile(0, point),
+        delta=tolerance)
+
+  def test_small_drawable_is_counted_with_memory_budget_and_threads(self):
+    layer = run_benchmarks.create_drawable(128, 128, 'u8', 'gaussian')
+
+    exact_histogram = histograms.get_histogram(layer, 0, 255)
+
+    with mock.patch.object(
+          histograms, '_get_pixel_counts', wraps=histograms._get_pixel_counts) as get_pixel_counts:
+      histogram = histograms.get_histogram(
+        layer, 0, 255, memory_budget=4096, num_threads=4, sampling_tolerance=0.1)
+
+    self.assertEqual(get_pixel_counts.call_args.args[2:4], (4096, 4))
+    for point in range(256):
+      self.assertEqual(
+        histogram.get_cumulative_count(point), exact_histogram.get_cumulative_count(point))
+
+
+class TestSketchHistogram(unittest.TestCase):
+
+  def _create_float_layer(self, values):
+    pixels = np.concatenate(
+      [np.repeat(values[..., np.newaxis], 3, axis=2), np.ones(values.shape + (1,))], axis=2)
+    return fake_gimp.FakeLayer(pixels.astype(np.float32), 'float')
+
+  def _get_color_clip(self, histogram, clip_percent_black, clip_percent_white):
+    black_point, white_point = color_clip.get_color_clip(
+      histogram, clip_percent_black, clip_percent_white)
+    return histogram.get_value(black_point), histogram.get_value(white_point)
+
+  def test_values_within_range_are_exact(self):
+    values = np.random.default_rng(0).random((256, 256))
+    layer = self._create_float_layer(values)
+
+    histogram = histograms.get_histogram(layer, 0, 65535, use_sketch=True)
+
+    black_value, white_value = self._get_color_clip(histogram, 1.0, 1.0)
+    self.assertAlmostEqual(black_value, np.quantile(values, 0.01), delta=2 / 65535)
+    self.assertAlmostEqual(white_value, np.quantile(values, 0.99), delta=2 / 65535)
+
+  def test_values_outside_range(self):
+    values = np.random.default_rng(0).uniform(-1.0, 3.0, (256, 256))
+    layer = self._create_float_layer(values)
+
+    histogram = histograms.get_histogram(layer, 0, 65535, use_sketch=True)
+
+    black_value, white_value = self._get_color_clip(histogram, 10.0, 10.0)
+    self.assertAlmostEqual(black_value, np.quantile(values, 0.1), delta=0.6 * 0.01)
+    self.assertAlmostEqual(white_value, np.quantile(values, 0.9), delta=2.6 * 0.01)
+
+    fractions = histogram.get_cumulative_fractions(3)
+    self.assertAlmostEqual(fractions[0], 0.25, delta=0.01)
+    self.assertAlmostEqual(fractions[2], 0.5, delta=0.01)
+
+  def test_merge(self):
+    values = np.random.default_rng(0).uniform(-1.0, 2.0, (256, 256))
+    layers = [self._create_float_layer(values[:128]), self._create_float_layer(values[128:])]
+
+    merged_histogram = histograms.merge_histograms([
+      histograms.get_histogram(layer, 0, 65535, use_sketch=True) for layer in layers])
+    histogram = histograms.get_histogram(
+      self._create_float_layer(values), 0, 65535, use_sketch=True)
+
+    self.assertEqual(
+      self._get_color_clip(merged_histogram, 5.0, 5.0),
+      self._get_color_clip(histogram, 5.0, 5.0))
+
+
+class TestMergeHistograms(unittest.TestCase):
+
+  def setUp(self):
+    self.layers = [
+      run_benchmarks.create_drawable(64, 64, 'u8', shape, seed=index)
+      for index, shape in enumerate(['gaussian', 'bimodal', 'low-key'])]
+
+  def test_single_histogram(self):
+    histogram = histograms.get_histogram(self.layers[0], 0, 255)
+
+    self.assertIs(histograms.merge_histograms([histogram]), histogram)
+
+  def test_pixel_histograms(self):
+    merged_histogram = histograms.merge_histograms(
+      [histograms.get_histogram(layer, 0, 255) for layer in self.layers])
+
+    self.assertIs(type(merged_histogram), histograms.PixelHistogram)
+    self._assert_equals_histogram_of_all_pixels(merged_histogram)
+
+  def test_pdb_histograms(self):
+    orig_np = histograms.np
+    histograms.np = None
+    try:
+      merged_histogram = histograms.merge_histograms(
+        [histograms.get_histogram(layer, 0, 255) for layer in self.layers])
+      self.assertIsInstance(merged_histogram, histograms.MergedHistogram)
+      self._assert_equals_histogram_of_all_pixels(merged_histogram)
+    finally:
+      histograms.np = orig_np
+
+  def _assert_equals_histogram_of_all_pixels(self, merged_histogram):
+    layer_of_all_pixels = fake_gimp.FakeLayer(
+      np.concatenate([layer.pixels for layer in self.layers]), 'u8')
+    histogram = histograms.get_histogram(layer_of_all_pixels, 0, 255)
+
+    self.assertEqual(merged_histogram.total_count, histogram.total_count)
+    for point in range(256):
+      self.assertEqual(
+        merged_histogram.get_cumulative_count(point), histogram.get_cumulative_count(point))
+
+
+class TestChunkedAndThreadedAnalysis(unittest.TestCase):
+
+  def setUp(self):
+    self.layers = {
+      precision: run_benchmarks.create_drawable(512, 256, precision, 'bimodal')
+      for precision in ['u8', 'float']}
+
+  def test_small_memory_budget_splits_drawable_into_chunks(self):
+    for precision, layer in self.layers.items():
+      with self.subTest(precision=precision):
+        histogram, num_reads = self._get_histogram(layer, precision)
+        chunked_histogram, num_chunked_reads = self._get_histogram(
+          layer, precision, memory_budget=4096)
+
+        self.assertEqual(num_reads, 1)
+        self.assertGreater(num_chunked_reads, 1)
+        self._assert_histograms_equal(chunked_histogram, histogram)
+
+  def test_threads_match_single_thread(self):
+    for precision, layer in self.layers.items():
+      with self.subTest(precision=precision):
+        histogram, _num_reads = self._get_histogram(layer, precision, memory_budget=4096)
+        threaded_histogram, _num_reads = self._get_histogram(
+          layer, precision, memory_budget=4096, num_threads=4)
+
+        self._assert_histograms_equal(threaded_histogram, histogram)
+
+  def test_channel_histograms_match_default_run(self):
+    layer = self.layers['u8']
+
+    channel_histograms = histograms.get_channel_histograms(layer, 0, 255)
+    chunked_channel_histograms = histograms.get_channel_histograms(
+      layer, 0, 255, memory_budget=4096, num_threads=4)
+
+    self.assertEqual(len(chunked_channel_histograms), 3)
+    for chunked_histogram, histogram in zip(chunked_channel_histograms, channel_histograms):
+      self._assert_histograms_equal(chunked_histogram, histogram)
+
+  def test_channel_histograms_count_each_channel(self):
+    pixels = np.random.default_rng(0).integers(0, 256, (128, 128, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    layer = fake_gimp.FakeLayer(pixels, 'u8')
+
+    channel_histograms = histograms.get_channel_histograms(
+      layer, 0, 255, memory_budget=4096, num_threads=4)
+
+    for component_index, histogram in enumerate(channel_histograms):
+      expected_fractions = np.cumsum(
+        np.bincount(pixels[..., component_index].ravel(), minlength=256)) / pixels[..., 0].size
+      np.testing.assert_allclose(
+        [histogram.get_cumulative_count(point) / histogram.total_count for point in range(256)],
+        expected_fractions)
+
+  @staticmethod
+  def _get_histogram(layer, precision, **kwargs):
+    drawable_stats = stats.DrawableStats(layer.get_name(), layer.get_id(), 512 * 256)
+
+    histogram = histograms.get_histogram(
+      layer,
+      0,
+      255 if precision == 'u8' else 65535,
+      use_sketch=precision == 'float',
+      drawable_stats=drawable_stats,
+      **kwargs)
+
+    return histogram, drawable_stats.counts['buffer_reads']
+
+  def _assert_histograms_equal(self, histogram, expected_histogram):
+    self.assertEqual(histogram.total_count, expected_histogram.total_count)
+    for point in range(0, histogram.max_point + 1, (histogram.max_point + 1) // 256):
+      self.assertEqual(
+        histogram.get_cumulative_count(point), expected_histogram.get_cumulative_count(point))
+
+
+class TestHistogramCache(unittest.TestCase):
+
+  def setUp(self):
+    self.layers = [
+      run_benchmarks.create_drawable(256, 128, 'u8', 'gaussian', seed=seed) for seed in range(3)]
+
+    histograms.clear_histogram_cache()
+    self.addCleanup(histograms.clear_histogram_cache)
+
+  def test_hit_reads_pixels_only_to_verify_contents(self):
+    histogram, _counts = self._get_histogram(self.layers[0])
+    cached_histogram, counts = self._get_histogram(self.layers[0])
+
+    self.assertIs(cached_histogram, histogram)
+    self.assertEqual(counts['histogram_cache_hits'], 1)
+    # A hit still reads all analyzed pixels once to compute the digest.
+    self.assertEqual(counts['buffer_reads'], 1)
+
+  def test_miss_after_edit(self):
+    histogram, _counts = self._get_histogram(self.layers[0])
+
+    self.layers[0].pixels[:10, :10, :3] = 0
+
+    edited_histogram, counts = self._get_histogram(self.layers[0])
+
+    self.assertIsNot(edited_histogram, histogram)
+    self.assertEqual(counts['histogram_cache_hits'], 0)
+    self.assertGreater(edited_histogram.get_cumulative_count(0), histogram.get_cumulative_count(0))
+
+  def test_least_recently_used_histogram_is_evicted(self):
+    with mock.patch.object(histograms, '_histogram_cache', histograms._LruCache(2)):
+      for layer in [self.layers[0], self.layers[1], self.layers[0], self.layers[2]]:
+        self._get_histogram(layer)
+
+      hit_counts = [
+        self._get_histogram(layer)[1]['histogram_cache_hits']
+        for layer in [self.layers[0], self.layers[2], self.layers[1]]]
+
+    self.assertEqual(hit_counts, [1, 1, 0])
+
+  @staticmethod
+  def _get_histogram(layer):
+    drawable_stats = stats.DrawableStats(layer.get_name(), layer.get_id(), 256 * 128)
+
+    histogram = histograms.get_histogram(
+      layer, 0, 255, use_cache=True, drawable_stats=drawable_stats)
+
+    return histogram, drawable_stats.counts
+
+
+class TestPdbHistogram(unittest.TestCase):
+
+  def test_high_precision_queries_are_limited_to_bins(self):
+    layer = run_benchmarks.create_drawable(64, 64, 'u16', 'gaussian')
+    drawable_stats = stats.DrawableStats(layer.get_name(), layer.get_id(), 64 * 64)
+
+    histogram = histograms.PdbHistogram(layer, 0, 65535, drawable_stats=drawable_stats)
+    black_point, white_point = color_clip.get_color_clip(histogram, 1.0, 1.0)
+
+    # GIMP counts 16-bit pixels in 1024 bins, which takes at most 11 queries
+    # of each of the 3 color channels for each point.
+    self.assertLessEqual(drawable_stats.counts['pdb_calls'], 2 * 11 * 3)
+
+    for point in [0, black_point - 1, black_point, white_point, 40000, 65535]:
+      expected_count = sum(
+        layer.histogram(histogram_channel, 0.0, point / 65535).count
+        for histogram_channel in histogram.histogram_channels)
+      self.assertEqual(histogram.get_cumulative_count(point), expected_count)
+
+
+  def test_cumulative_fractions_are_queried_once_per_bin(self):
+    layer = run_benchmarks.create_drawable(16, 16, 'u16', 'gaussian')
+    drawable_stats = stats.DrawableStats(layer.get_name(), layer.get_id(), 16 * 16)
+
+    histogram = histograms.PdbHistogram(layer, 0, 65535, drawable_stats=drawable_stats)
+    fractions = histogram.get_cumulative_fractions(65536)
+
+    self.assertEqual(len(fractions), 65536)
+    self.assertLessEqual(drawable_stats.counts['pdb_calls'], 1024 * 3)
+    self.assertEqual(fractions[-1], 1.0)
+    for point in [0, 1000, 30000, 65535]:
+      self.assertEqual(
+        fractions[point], histogram.get_cumulative_count(point) / histogram.total_count)
+
+
+class TestTileSummary(unittest.TestCase):
+
+  def setUp(self):
+    self.tile_summary = histograms.TileSummary((0, 0, 12, 12), 4, 4)
+
+  def test_split_rect_without_skipped_tiles(self):
+    self.assertEqual(
+      self.tile_summary.split_rect((0, 0, 12, 12), lambda tile: False),
+      ([(0, 0, 12, 12)], []))
+
+  def test_split_rect_around_skipped_tile(self):
+    self.assertEqual(
+      self.tile_summary.split_rect((0, 0, 12, 12), lambda tile: tile == (1, 1)),
+      (
+        [(0, 0, 12, 4), (0, 4, 4, 4), (8, 4, 4, 4), (0, 8, 12, 4)],
+        [((1, 1), (4, 4, 4, 4))],
+      ))
+
+  def test_split_rect_merges_tile_rows_with_same_runs(self):
+    self.assertEqual(
+      self.tile_summary.split_rect((0, 0, 12, 12), lambda tile: tile[0] == 1),
+      (
+        [(0, 0, 4, 12), (8, 0, 4, 12)],
+        [((1, 0), (4, 0, 4, 4)), ((1, 1), (4, 4, 4, 4)), ((1, 2), (4, 8, 4, 4))],
+      ))
+
+  def test_split_rect_not_aligned_to_tiles(self):
+    self.assertEqual(
+      self.tile_summary.split_rect((2, 1, 8, 6), lambda tile: tile == (1, 0)),
+      ([(2, 1, 2, 3), (8, 1, 2, 3), (2, 4, 8, 3)], [((1, 0), (4, 1, 4, 3))]))
+
+  def test_split_rect_with_all_tiles_skipped(self):
+    rects, skipped_tiles = self.tile_summary.split_rect((0, 0, 8, 4), lambda tile: True)
+
+    self.assertEqual(rects, [])
+    self.assertEqual(skipped_tiles, [((0, 0), (0, 0, 4, 4)), ((1, 0), (4, 0, 4, 4))])
+
+  def test_add_chunk(self):
+    pixels = np.random.default_rng(0).integers(1, 256, (10, 11, 2), dtype=np.uint8)
+    # Tiles are 4x4 pixels, the rectangle starts at (1, 1) within tile (0, 0).
+    pixels[:3, :3] = [7, 255]
+    pixels[3:7, 3:7, 1] = 0
+    selection = np.full((10, 11), 255, dtype=np.uint8)
+    selection[1, 2] = 128
+    selection[7:, 7:] = 0
+
+    tile_summary = histograms.TileSummary((1, 1, 11, 10), 4, 4)
+    tile_summary.add_chunk((1, 1, 11, 3), pixels[:3], 1, selection[:3])
+    tile_summary.add_chunk((1, 4, 11, 7), pixels[3:], 1, selection[3:])
+
+    self.assertEqual(tile_summary.empty_tiles, {(1, 1), (2, 2)})
+    self.assertEqual(tile_summary.uniform_pixels, {(0, 0): (bytes([7, 255]), 255)})
+    self.assertEqual(tile_summary.nonuniform_selection_tiles, {(0, 0)})
+
+
+class TestPixelChunkReader(unittest.TestCase):
+
+  def test_read_chunk_with_tile_summary_matches_full_read(self):
+    for precision, max_point in [('u8', 255), ('float', 65535)]:
+      layer = _create_layer_with_flat_areas(precision)
+      rect = (0, 0, layer.get_width(), layer.get_height())
+
+      tile_summaries = {
+        'analysis': histograms.get_histogram(
+          layer, 0, max_point, use_sketch=precision == 'float').tile_summary,
+        'native': histograms._scan_content(
+          layer, rect, True, histograms.DEFAULT_MEMORY_BUDGET)[1],
+      }
+
+      for name, tile_summary in tile_summaries.items():
+        with self.subTest(precision=precision, tile_summary=name):
+          self.assertTrue(tile_summary.empty_tiles)
+          self.assertTrue(tile_summary.uniform_pixels)
+
+          pixels, weights = histograms._PixelChunkReader(
+            layer, precision, histograms.DEFAULT_MEMORY_BUDGET).read_chunk(rect)
+          summarized_pixels, summarized_weights = histograms._PixelChunkReader(
+            layer, precision, histograms.DEFAULT_MEMORY_BUDGET, tile_summary=tile_summary,
+          ).read_chunk(rect)
+
+          self.assertLess(len(summarized_pixels), len(pixels))
+          for component_index in range(3):
+            self.assertEqual(
+              self._get_weighted_counts(summarized_pixels[:, component_index], summarized_weights),
+              self._get_weighted_counts(pixels[:, component_index], weights))
+
+  def test_analysis_classifies_tiles_without_cache(self):
+    layer = _create_layer_with_flat_areas('u8')
+    drawable_stats = stats.DrawableStats(layer.get_name(), layer.get_id(), 512 * 256)
+
+    tile_summary = histograms.get_histogram(
+      layer, 0, 255, drawable_stats=drawable_stats).tile_summary
+
+    self.assertEqual(tile_summary.pixel_format, 'RGBA u8')
+    self.assertIn((0, 0), tile_summary.uniform_pixels)
+    self.assertIn((3, 0), tile_summary.empty_tiles)
+    self.assertEqual(drawable_stats.counts['buffer_reads'], 1)
+
+  @staticmethod
+  def _get_weighted_counts(values, weights):
+    unique_values, indices = np.unique(values, return_inverse=True)
+    return dict(zip(unique_values.tolist(), np.bincount(indices, weights=weights).tolist()))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of `levels`, run with the in-memory GIMP stand-in set up by
+`fake_backend`.
+"""
+
+import contextlib
+import unittest
+import unittest.mock as mock
+
+from fake_backend import fake_gimp, run_benchmarks
+
+import numpy as np
+
+import histograms
+import levels
+
+
+_CHANNEL_INPUTS = [(0.1, 0.9), (0.2, 0.8), (0.0, 0.5)]
+
+
+class TestApplyChannelLevels(unittest.TestCase):
+
+  def setUp(self):
+    # Each color component takes all 8-bit values, in a different order for
+    # each component.
+    values = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    self.pixels = np.stack(
+      [values, values.T, values[::-1], np.full((16, 16), 200, dtype=np.uint8)], axis=2)
+
+  def test_known_points_per_channel(self):
+    for use_numpy in [True, False]:
+      with self.subTest(use_numpy=use_numpy), _use_numpy(use_numpy):
+        layer = fake_gimp.FakeLayer(self.pixels.copy(), 'u8')
+
+        levels.apply_channel_levels(layer, _CHANNEL_INPUTS)
+
+        np.testing.assert_array_equal(
+          layer.pixels[..., :3], self._get_expected_pixels(self.pixels[..., :3]))
+        np.testing.assert_array_equal(layer.pixels[..., 3], self.pixels[..., 3])
+
+  def test_channel(self):
+    for use_numpy in [True, False]:
+      with self.subTest(use_numpy=use_numpy), _use_numpy(use_numpy):
+        channel = fake_gimp.FakeChannel(self.pixels[..., :1].copy(), 'u8')
+
+        levels.apply_channel_levels(channel, _CHANNEL_INPUTS[:1])
+
+        np.testing.assert_array_equal(
+          channel.pixels, self._get_expected_pixels(self.pixels[..., :1]))
+
+  def test_values_outside_range_are_kept_in_floating_point_drawable(self):
+    pixels = (self.pixels / 255).astype(np.float32)
+    layer = fake_gimp.FakeLayer(pixels.copy(), 'float')
+
+    levels.apply_channel_levels(layer, _CHANNEL_INPUTS)
+
+    expected_pixels = np.stack(
+      [(pixels[..., index] - low_input) / (high_input - low_input)
+       for index, (low_input, high_input) in enumerate(_CHANNEL_INPUTS)],
+      axis=2)
+    np.testing.assert_allclose(layer.pixels[..., :3], expected_pixels, rtol=1e-6, atol=1e-6)
+    self.assertLess(layer.pixels[..., 0].min(), 0.0)
+    self.assertGreater(layer.pixels[..., 2].max(), 1.0)
+
+  @staticmethod
+  def _get_expected_pixels(pixels):
+    return np.stack(
+      [np.rint(np.clip(
+        (pixels[..., index] / 255 - low_input) / (high_input - low_input), 0.0, 1.0) * 255)
+       for index, (low_input, high_input) in enumerate(_CHANNEL_INPUTS[:pixels.shape[2]])],
+      axis=2).astype(np.uint8)
+
+
+class TestApplyChannelLevelsWithTileSummary(unittest.TestCase):
+
+  def test_output_matches_output_without_tile_summary(self):
+    for precision, max_point in [('u8', 255), ('float', 65535)]:
+      with self.subTest(precision=precision):
+        pixels = run_benchmarks.create_drawable(512, 256, precision, 'cutout').pixels
+        # A column of tiles of a single opaque color.
+        pixels[:, :128] = np.array([0.3, 0.6, 0.9, 1.0]) * (
+          1.0 if precision == 'float' else np.iinfo(pixels.dtype).max)
+
+        layer = fake_gimp.FakeLayer(pixels.copy(), precision)
+        summarized_layer = fake_gimp.FakeLayer(pixels.copy(), precision)
+
+        tile_summary = histograms.get_channel_histograms(
+          summarized_layer, 0, max_point, use_sketch=precision == 'float')[0].tile_summary
+
+        num_read_pixels = self._apply_channel_levels(layer)
+        num_summarized_read_pixels = self._apply_channel_levels(summarized_layer, tile_summary)
+
+        self.assertFalse(np.array_equal(layer.pixels, pixels))
+        self.assertLess(num_summarized_read_pixels, num_read_pixels)
+        np.testing.assert_array_equal(summarized_layer.pixels, layer.pixels)
+
+  def test_tile_summary_of_pixels_merged_by_conversion_is_ignored(self):
+    layer = run_benchmarks.create_drawable(16, 16, 'u8', 'gaussian')
+    image = layer.get_image()
+
+    for pixel_format, precision, expected_result in [
+          (None, fake_gimp.Precision.U8_NON_LINEAR, True),
+          ('RGBA float', fake_gimp.Precision.U8_NON_LINEAR, True),
+          ('RGBA u8', fake_gimp.Precision.U8_LINEAR, True),
+          ('RGBA u8', fake_gimp.Precision.U8_NON_LINEAR, False),
+          ('RGBA u16', fake_gimp.Precision.U32_LINEAR, False)]:
+      with self.subTest(pixel_format=pixel_format, precision=precision):
+        image.precision = precision
+        tile_summary = histograms.TileSummary((0, 0, 16, 16), 128, 64, pixel_format)
+
+        self.assertEqual(
+          levels._has_exact_uniform_tiles(layer, tile_summary, 'RGBA float'), expected_result)
+
+  @staticmethod
+  def _apply_channel_levels(layer, tile_summary=None):
+    with mock.patch.object(levels, '_read_pixels', wraps=levels._read_pixels) as read_pixels:
+      levels.apply_channel_levels(layer, _CHANNEL_INPUTS, tile_summary=tile_summary)
+
+    read_rects = [call.args[1] for call in read_pixels.call_args_list]
+
+    return sum(width * height for _x, _y, width, height in read_rects)
+
+
+@contextlib.contextmanager
+def _use_numpy(use_numpy):
+  orig_np = levels.np
+  if not use_numpy:
+    levels.np = None
+
+  try:
+    yield
+  finally:
+    levels.np = orig_np
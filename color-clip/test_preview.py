@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of `preview`, run with the in-memory GIMP stand-in set up by
+`fake_backend`.
+"""
+
+import threading
+import unittest
+import unittest.mock as mock
+
+from fake_backend import fake_gimp, run_benchmarks
+
+import preview
+import progress
+
+
+class _FakeLayer(fake_gimp.FakeLayer):
+
+  def get_thumbnail(self, _width, _height, _transparency):
+    thumbnail = mock.Mock()
+    thumbnail.read_pixel_bytes.return_value.get_data.return_value = b''
+    return thumbnail
+
+
+class TestColorClipPreview(unittest.TestCase):
+
+  def setUp(self):
+    self.idle_callbacks = []
+    self.idle_callback_added = threading.Event()
+
+    for patcher in [
+          mock.patch.object(progress, 'Gimp'),
+          mock.patch.object(progress, 'GLib'),
+          mock.patch.object(preview.ColorClipPreview, '_get_clipped_thumbnail')]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    progress.GLib.idle_add.side_effect = self._add_idle_callback
+
+    self.drawable = _FakeLayer(
+      run_benchmarks.create_drawable(16, 16, 'u8', 'gaussian').pixels, 'u8')
+
+    self.config = mock.Mock()
+    self.config.get_property.return_value = False
+
+  def test_analysis_runs_in_background(self):
+    analysis_started = threading.Event()
+    analysis_can_finish = threading.Event()
+    main_thread = threading.current_thread()
+
+    def analyze(drawable_progress, return_histograms, histogram_lists):
+      analysis_started.set()
+      analysis_can_finish.wait()
+
+      self.assertIsNot(threading.current_thread(), main_thread)
+      self.assertEqual(len(drawable_progress), 1)
+      self.assertTrue(return_histograms)
+      self.assertIsNone(histogram_lists)
+
+      return [(0.1, 0.9)], [['histogram']]
+
+    color_clip_preview = preview.ColorClipPreview(self.drawable, self.config, analyze)
+
+    # The preview is created while the drawable is still being analyzed.
+    self.assertTrue(analysis_started.wait(5))
+    self.assertIsNone(color_clip_preview._histogram_lists)
+
+    analysis_can_finish.set()
+    self._run_idle_callbacks(color_clip_preview)
+
+    color_clip_preview._get_clipped_thumbnail.assert_called_once_with([(0.1, 0.9)])
+    self.assertEqual(color_clip_preview.stop(), [['histogram']])
+
+  def test_histograms_are_reused_for_new_clip_percentages(self):
+    analyze = mock.Mock(return_value=([(0.1, 0.9)], [['histogram']]))
+
+    color_clip_preview = preview.ColorClipPreview(self.drawable, self.config, analyze)
+    self._run_idle_callbacks(color_clip_preview)
+
+    color_clip_preview._on_config_changed(self.config, None)
+    color_clip_preview.update()
+    self._run_idle_callbacks(color_clip_preview)
+
+    self.assertEqual(analyze.call_args.kwargs['histogram_lists'], [['histogram']])
+
+  def test_changing_analysis_arguments_cancels_analysis(self):
+    def analyze(drawable_progress, return_histograms, histogram_lists):
+      while True:
+        drawable_progress[0].check()
+
+    color_clip_preview = preview.ColorClipPreview(self.drawable, self.config, analyze)
+    analysis_future = color_clip_preview._analysis_future
+
+    color_clip_preview._on_analysis_config_changed(self.config, None)
+
+    self.assertIsInstance(analysis_future.exception(), progress.Canceled)
+    self._run_idle_callbacks(color_clip_preview)
+    color_clip_preview._get_clipped_thumbnail.assert_not_called()
+    self.assertIsNone(color_clip_preview.stop())
+
+  def test_stop_cancels_analysis(self):
+    def analyze(drawable_progress, return_histograms, histogram_lists):
+      while True:
+        drawable_progress[0].check()
+
+    color_clip_preview = preview.ColorClipPreview(self.drawable, self.config, analyze)
+    analysis_future = color_clip_preview._analysis_future
+
+    self.assertIsNone(color_clip_preview.stop())
+    self.assertTrue(analysis_future.done())
+
+  def _add_idle_callback(self, func, *args):
+    self.idle_callbacks.append((func, args))
+    self.idle_callback_added.set()
+
+  def _run_idle_callbacks(self, color_clip_preview):
+    """Runs callbacks scheduled for the main loop once the running analysis
+    finishes.
+    """
+    if color_clip_preview._analysis_future is not None:
+      self.assertTrue(self.idle_callback_added.wait(5))
+
+    self.idle_callback_added.clear()
+    while self.idle_callbacks:
+      func, args = self.idle_callbacks.pop(0)
+      func(*args)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of memoized PDB calls in `procedure`, run with the in-memory GIMP
+stand-in set up by `fake_backend`.
+"""
+
+import unittest
+
+from fake_backend import fake_gimp, run_benchmarks
+
+import procedure
+
+
+class _FakeLayer(fake_gimp.FakeLayer):
+
+  def levels(self, *args):
+    return args
+
+
+class _FakeImage(fake_gimp.Image):
+
+  def convert_precision(self, precision):
+    self.precision = precision
+
+
+class TestPdbCallMemo(unittest.TestCase):
+
+  def setUp(self):
+    self.layers = [
+      _FakeLayer(run_benchmarks.create_drawable(16, 16, 'u8', 'gaussian', seed=seed).pixels, 'u8')
+      for seed in range(2)]
+
+    fake_gimp.counters.reset()
+
+  def test_queries_without_memo(self):
+    self._query(self.layers[0])
+    self._query(self.layers[0])
+
+    self.assertEqual(fake_gimp.counters.histogram_calls, 2)
+    self.assertIsNone(procedure.get_pdb_call_memo_counts())
+
+  def test_hits_and_misses(self):
+    pdb_calls = []
+
+    def run():
+      for layer, end_range in [
+            (self.layers[0], 1.0),
+            (self.layers[0], 1.0),
+            (self.layers[0], 0.5),
+            (self.layers[1], 1.0),
+            (self.layers[1], 1.0)]:
+        self._query(layer, end_range, on_pdb_call=lambda: pdb_calls.append(None))
+
+      return procedure.get_pdb_call_memo_counts()
+
+    self.assertEqual(self._run(run), {'hits': 2, 'misses': 3})
+    self.assertEqual(fake_gimp.counters.histogram_calls, 3)
+    self.assertEqual(len(pdb_calls), 3)
+
+  def test_query_returns_memoized_result(self):
+    def run():
+      return self._query(self.layers[0]), self._query(self.layers[0])
+
+    result, memoized_result = self._run(run)
+
+    self.assertIs(memoized_result, result)
+
+  def test_modifying_drawable_drops_only_its_queries(self):
+    def run():
+      self._query(self.layers[0])
+      self._query(self.layers[1])
+
+      self.assertEqual(procedure.modify_pdb(self.layers[0].levels, 0.1, 0.9), (0.1, 0.9))
+
+      self._query(self.layers[0])
+      self._query(self.layers[1])
+
+      return procedure.get_pdb_call_memo_counts()
+
+    self.assertEqual(self._run(run), {'hits': 1, 'misses': 3})
+
+  def test_modifying_image_drops_all_queries(self):
+    image = _FakeImage(fake_gimp.Precision.U8_NON_LINEAR)
+
+    def run():
+      self._query(self.layers[0])
+      self._query(self.layers[1])
+
+      procedure.modify_pdb(image.convert_precision, fake_gimp.Precision.U8_LINEAR)
+
+      self._query(self.layers[0])
+      self._query(self.layers[1])
+
+      return procedure.get_pdb_call_memo_counts()
+
+    self.assertEqual(self._run(run), {'hits': 0, 'misses': 4})
+    self.assertEqual(image.precision, fake_gimp.Precision.U8_LINEAR)
+
+  def test_nested_run_restores_previous_memo(self):
+    def run_nested():
+      self._query(self.layers[0])
+      return procedure.get_pdb_call_memo_counts()
+
+    def run():
+      self._query(self.layers[0])
+
+      nested_counts = self._run(run_nested)
+
+      # A nested procedure not memoizing PDB calls shares the memo.
+      self.assertEqual(self._run(run_nested, memoize_pdb_calls=False), {'hits': 1, 'misses': 1})
+
+      return nested_counts, procedure.get_pdb_call_memo_counts()
+
+    nested_counts, counts = self._run(run)
+
+    self.assertEqual(nested_counts, {'hits': 0, 'misses': 1})
+    self.assertEqual(counts, {'hits': 1, 'misses': 1})
+    self.assertIsNone(procedure.get_pdb_call_memo_counts())
+
+  def test_memo_is_dropped_on_error(self):
+    def run():
+      self._query(self.layers[0])
+      raise ValueError
+
+    with self.assertRaises(ValueError):
+      self._run(run)
+
+    self.assertIsNone(procedure.get_pdb_call_memo_counts())
+
+  def _query(self, layer, end_range=1.0, on_pdb_call=None):
+    return procedure.query_pdb(
+      layer.histogram, fake_gimp.HistogramChannel.VALUE, 0.0, end_range, on_pdb_call=on_pdb_call)
+
+  @staticmethod
+  def _run(func, memoize_pdb_calls=True):
+    return procedure._run_procedure(func, (), memoize_pdb_calls)
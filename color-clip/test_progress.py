@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of `progress`, run with the in-memory GIMP stand-in set up by
+`fake_backend`.
+"""
+
+import sys
+import unittest
+import unittest.mock as mock
+
+from fake_backend import run_benchmarks
+
+import histograms
+import progress
+import stats
+
+
+class _CancelingTaskProgress(progress.TaskProgress):
+  """Task progress canceling the run once ``num_units_until_cancel`` units
+  are done.
+  """
+
+  def __init__(self, progress_, num_units_until_cancel):
+    super().__init__(progress_)
+
+    self.num_units_until_cancel = num_units_until_cancel
+
+  def advance(self, num_units=1):
+    super().advance(num_units)
+
+    self.num_units_until_cancel -= num_units
+    if self.num_units_until_cancel <= 0:
+      self._progress.cancel()
+
+
+class _FakeDialog:
+
+  def __init__(self):
+    self.is_content_sensitive = True
+    self.is_ok_sensitive = True
+    self.response_handlers = {}
+
+    self._content_area = mock.Mock()
+    self._content_area.set_sensitive.side_effect = self._set_content_sensitive
+
+  def get_content_area(self):
+    return self._content_area
+
+  def set_response_sensitive(self, _response, is_sensitive):
+    self.is_ok_sensitive = is_sensitive
+
+  def connect(self, _signal, handler):
+    handler_id = len(self.response_handlers) + 1
+    self.response_handlers[handler_id] = handler
+    return handler_id
+
+  def disconnect(self, handler_id):
+    del self.response_handlers[handler_id]
+
+  def respond(self):
+    for handler in list(self.response_handlers.values()):
+      handler(self, 'cancel')
+
+  def _set_content_sensitive(self, is_sensitive):
+    self.is_content_sensitive = is_sensitive
+
+
+class TestProgress(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(progress, 'Gimp')
+    self.gimp = patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.progress = progress.Progress('Color Clip', update_interval=0.0)
+
+  def test_fraction_averages_tasks(self):
+    tasks = [self.progress.add_task() for _unused in range(2)]
+
+    self.assertEqual(self.progress.fraction, 0.0)
+
+    tasks[0].start(4)
+    tasks[0].advance()
+    self.assertEqual(self.progress.fraction, 0.125)
+
+    tasks[1].start(2, num_done_units=1)
+    self.assertEqual(self.progress.fraction, 0.375)
+
+    tasks[1].finish()
+    self.assertEqual(self.progress.fraction, 0.625)
+
+    self.gimp.progress_update.assert_called_with(0.625)
+
+  def test_updates_are_limited_by_interval(self):
+    self.progress.update_interval = 3600.0
+    task = self.progress.add_task()
+
+    task.start(10)
+    for _unused in range(5):
+      task.advance()
+
+    self.assertEqual(self.gimp.progress_update.call_count, 1)
+
+    task.finish()
+
+    self.assertEqual(self.gimp.progress_update.call_count, 2)
+    self.gimp.progress_update.assert_called_with(1.0)
+
+  def test_check_raises_once_canceled(self):
+    task = self.progress.add_task()
+
+    task.check()
+    self.assertFalse(task.is_canceled)
+
+    self.progress.cancel()
+
+    self.assertTrue(task.is_canceled)
+    with self.assertRaises(progress.Canceled):
+      task.check()
+
+
+class TestResumeCanceledAnalysis(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(progress, 'Gimp')
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+    self.layer = run_benchmarks.create_drawable(512, 256, 'u8', 'gaussian')
+
+    histograms.clear_histogram_cache()
+    self.addCleanup(histograms.clear_histogram_cache)
+
+  def test_canceled_analysis_continues_where_it_stopped(self):
+    with self.assertRaises(progress.Canceled):
+      self._get_histograms(num_units_until_cancel=3)
+
+    resumed_histograms, num_resumed_reads = self._get_histograms()
+
+    histograms.clear_histogram_cache()
+    expected_histograms, num_reads = self._get_histograms()
+
+    # Both runs scan the drawable to verify the cached contents, after which
+    # only the chunks not processed before canceling are read.
+    self.assertEqual(num_resumed_reads, num_reads - 3)
+    self._assert_histograms_equal(resumed_histograms, expected_histograms)
+
+  def test_analysis_is_not_resumed_without_cache(self):
+    with self.assertRaises(progress.Canceled):
+      self._get_histograms(num_units_until_cancel=3, use_cache=False)
+
+    _histograms, num_reads_after_cancel = self._get_histograms(use_cache=False)
+
+    histograms.clear_histogram_cache()
+    _histograms, num_reads = self._get_histograms(use_cache=False)
+
+    self.assertEqual(num_reads_after_cancel, num_reads)
+
+  def _get_histograms(self, num_units_until_cancel=None, use_cache=True):
+    run_progress = progress.Progress('Color Clip')
+    if num_units_until_cancel is not None:
+      task_progress = _CancelingTaskProgress(run_progress, num_units_until_cancel)
+    else:
+      task_progress = run_progress.add_task()
+
+    drawable_stats = stats.DrawableStats('layer', 1, 512 * 256)
+
+    channel_histograms = histograms.get_channel_histograms(
+      self.layer,
+      0,
+      255,
+      # Small enough to split the drawable into several chunks.
+      memory_budget=512 * 64 * 4,
+      use_cache=use_cache,
+      drawable_stats=drawable_stats,
+      task_progress=task_progress)
+
+    return channel_histograms, drawable_stats.counts['buffer_reads']
+
+  def _assert_histograms_equal(self, channel_histograms, expected_channel_histograms):
+    for histogram, expected_histogram in zip(channel_histograms, expected_channel_histograms):
+      self.assertEqual(histogram.total_count, expected_histogram.total_count)
+      for point in range(256):
+        self.assertEqual(
+          histogram.get_cumulative_count(point), expected_histogram.get_cumulative_count(point))
+
+
+class TestRunInDialog(unittest.TestCase):
+
+  def setUp(self):
+    self.dialog = _FakeDialog()
+    self.gtk = mock.Mock()
+
+    for patcher in [
+          mock.patch.object(sys.modules['gi.repository'], 'Gtk', self.gtk, create=True),
+          mock.patch.object(progress, 'GLib'),
+          mock.patch.object(progress, 'Gimp')]:
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+    self.progress = progress.Progress('Color Clip')
+
+  def test_returns_result_and_disables_dialog(self):
+    def func():
+      self.assertFalse(self.dialog.is_content_sensitive)
+      self.assertFalse(self.dialog.is_ok_sensitive)
+      return 'result'
+
+    self.assertEqual(progress.run_in_dialog(self.dialog, self.progress, func), 'result')
+    self.assertFalse(self.dialog.response_handlers)
+
+  def test_dialog_response_cancels_run(self):
+    task = self.progress.add_task()
+
+    def func():
+      while True:
+        task.check()
+
+    self.gtk.main_iteration_do.side_effect = lambda _blocking: self.dialog.respond()
+
+    with self.assertRaises(progress.Canceled):
+      progress.run_in_dialog(self.dialog, self.progress, func)
+
+    self.assertTrue(self.progress.is_canceled)
+    self.assertFalse(self.dialog.response_handlers)
+
+  def test_exception_is_propagated(self):
+    def func():
+      raise ValueError('invalid region')
+
+    with self.assertRaisesRegex(ValueError, 'invalid region'):
+      progress.run_in_dialog(self.dialog, self.progress, func)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import math
+import unittest
+
+import sketches
+
+if sketches.np is None:
+  raise unittest.SkipTest('NumPy is required by quantile sketches')
+
+np = sketches.np
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+  def setUp(self):
+    self.values = np.random.default_rng(0).lognormal(0.0, 2.0, 100000)
+
+  def test_quantiles_within_relative_accuracy(self):
+    sketch = sketches.QuantileSketch(relative_accuracy=0.01)
+    sketch.add(self.values)
+
+    for quantile in [0.0, 0.01, 0.25, 0.5, 0.75, 0.99, 1.0]:
+      expected_value = np.quantile(self.values, quantile, method='inverted_cdf')
+      self.assertLessEqual(
+        abs(sketch.get_quantile(quantile) - expected_value), 0.01 * expected_value)
+
+  def test_weights(self):
+    sketch = sketches.QuantileSketch()
+    sketch.add(np.array([1.0, 2.0, 3.0]), np.array([1.0, 0.0, 3.0]))
+
+    self.assertEqual(sketch.total_count, 4.0)
+    self.assertAlmostEqual(sketch.get_quantile(0.25), 1.0, delta=0.01)
+    self.assertAlmostEqual(sketch.get_quantile(0.5), 3.0, delta=0.03)
+
+  def test_negative_and_zero_values(self):
+    sketch = sketches.QuantileSketch(min_value=1e-6)
+    sketch.add(np.array([-2.0, -0.5, 0.0, 1e-7, -1e-7, 0.5, np.nan, np.inf]))
+
+    values, counts = sketch.get_buckets()
+
+    self.assertEqual(counts, [1.0, 1.0, 3.0, 1.0])
+    self.assertEqual(values[2], 0.0)
+    self.assertAlmostEqual(values[0], -2.0, delta=2 * sketch.relative_accuracy)
+    self.assertAlmostEqual(values[1], -0.5, delta=0.5 * sketch.relative_accuracy)
+    self.assertAlmostEqual(values[3], 0.5, delta=0.5 * sketch.relative_accuracy)
+    self.assertEqual(sketch.get_quantile(0.0), values[0])
+    self.assertEqual(sketch.get_quantile(0.5), 0.0)
+
+  def test_empty_sketch(self):
+    sketch = sketches.QuantileSketch()
+
+    self.assertIsNone(sketch.get_quantile(0.5))
+    self.assertEqual(sketch.get_buckets(), ([0.0], [0.0]))
+
+  def test_merge_equals_single_sketch(self):
+    values = np.concatenate([self.values, -self.values[:1000], np.zeros(10)])
+
+    sketch = sketches.QuantileSketch()
+    sketch.add(values)
+
+    first_sketch = sketches.QuantileSketch()
+    first_sketch.add(values[:30000])
+    second_sketch = sketches.QuantileSketch()
+    second_sketch.add(values[30000:])
+
+    first_sketch.merge(second_sketch)
+
+    self.assertEqual(first_sketch.get_buckets(), sketch.get_buckets())
+    # The merged sketch is not modified.
+    self.assertEqual(second_sketch.total_count, len(values) - 30000)
+
+  def test_merge_rejects_different_parameters(self):
+    with self.assertRaises(ValueError):
+      sketches.QuantileSketch(relative_accuracy=0.01).merge(
+        sketches.QuantileSketch(relative_accuracy=0.02))
+
+  def test_collapse_lowest_buckets(self):
+    sketch = sketches.QuantileSketch(relative_accuracy=0.01, max_num_buckets=10)
+    sketch.add(self.values)
+
+    self.assertEqual(len(sketch.positive_counts), 10)
+    self.assertEqual(sketch.total_count, len(self.values))
+
+    # Values of the highest magnitudes keep their accuracy.
+    expected_value = np.quantile(self.values, 1.0, method='inverted_cdf')
+    self.assertLessEqual(abs(sketch.get_quantile(1.0) - expected_value), 0.01 * expected_value)
+
+    # Values of the lowest magnitudes are counted in the lowest kept bucket.
+    lowest_key = min(sketch.positive_counts)
+    self.assertEqual(
+      sketch.positive_counts[lowest_key],
+      np.count_nonzero(np.ceil(np.log(self.values) / math.log(sketch.gamma)) <= lowest_key))